@@ -0,0 +1,103 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_codec - compression ratio and throughput of the transfer codecs of
+SPH_binary streams, with and without byte-shuffle
+"""
+import sys, os
+import io
+import zlib
+import lzma
+import numpy as np
+
+from benchlib import DTYPES, makeSPH, timeit
+from pySPH import SPH
+from SPH_binary import SPH_binary
+
+LEVELS = {'zlib': (1, 6, 9), 'lzma': (0, 3, 6)}
+
+
+def plainCompress(buf, codec: str, level: int) -> bytes:
+    ''' plainCompress
+    byte-shuffleせずにcodecで圧縮する(比較用)
+    '''
+    if codec == 'zlib':
+        return zlib.compress(buf, level)
+    return lzma.compress(buf, preset=level)
+
+
+def makeNoisy(n: int, veclen: int, dtype: int, noise: float) -> SPH.SPH:
+    ''' makeNoisy
+    makeSPHの場に相対振幅noiseの乱数を加えたSPHを生成する
+    解析的な場は下位の仮数ビットが規則的で実際の解析結果より圧縮しやすいため、
+    シミュレーション結果に近い仮数の乱雑さを与える
+    '''
+    d = makeSPH(n, veclen, dtype)
+    rng = np.random.default_rng(1)
+    d._data = (d._data * (1.0 + noise * rng.standard_normal(d._data.size)))\
+        .astype(d._data.dtype)
+    return d
+
+
+def bench(sizes: [int], dnames: [str], repeat: int, noise: float):
+    print('{:<24} {:>5} {:>5} {:>8} {:>10} {:>10} {:>10}'.format(
+        'data', 'codec', 'level', 'ratio', 'comp[MB/s]', 'dec[MB/s]',
+        'shuffle'))
+    for n in sizes:
+        for dname in dnames:
+            for veclen, noisy in ((1, False), (3, False), (1, True)):
+                if noisy:
+                    d = makeNoisy(n, veclen, DTYPES[dname], noise)
+                else:
+                    d = makeSPH(n, veclen, DTYPES[dname])
+                tag = '{}/{}/v{}{}'.format(n, dname, veclen,
+                                           '/noisy' if noisy else '')
+                buf = SPH_binary.dataBuffer(d)
+                isz = d._data.dtype.itemsize
+                mb = len(buf) / (1024.0 * 1024.0)
+                for codec, levels in LEVELS.items():
+                    for level in levels:
+                        for shuffle in (True, False):
+                            if shuffle:
+                                comp = lambda: SPH_binary.compress(
+                                    buf, isz, codec, level)
+                            else:
+                                comp = lambda: plainCompress(buf, codec, level)
+                            t_c = timeit(comp, repeat)
+                            cbuf = comp()
+
+                            def decomp():
+                                if shuffle:
+                                    SPH_binary.unshuffle(SPH_binary.readSlab(
+                                        io.BytesIO(cbuf), len(cbuf),
+                                        len(buf), codec), isz)
+                                else:
+                                    SPH_binary.decompressor(codec)\
+                                        .decompress(cbuf)
+                            t_d = timeit(decomp, repeat)
+                            print('{:<24} {:>5} {:>5} {:8.2f} {:10.1f}'\
+                                  ' {:10.1f} {:>10}'.format(
+                                      tag, codec, level, len(buf) / len(cbuf),
+                                      mb / t_c, mb / t_d, str(shuffle)))
+                            continue # end of for(shuffle)
+                        continue # end of for(level)
+                    continue # end of for(codec, levels)
+                continue # end of for(veclen, noisy)
+            continue # end of for(dname)
+        continue # end of for(n)
+    return
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='transfer codec benchmark')
+    parser.add_argument('-n', help='grid sizes of each axis', type=int,
+                        nargs='+', default=[64, 128])
+    parser.add_argument('-d', help='data types', nargs='+',
+                        choices=list(DTYPES.keys()), default=['float32'])
+    parser.add_argument('-r', help='repeat count', type=int, default=3)
+    parser.add_argument('--noise', type=float, default=1e-4,
+                        help='relative noise amplitude of the noisy field')
+    args = parser.parse_args()
+    bench(args.n, args.d, args.r, args.noise)
+    sys.exit(0)
@@ -0,0 +1,106 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_decimate - time SPH_filter.decimate, and check its values against a
+per-window loop and its grid against the window centers, including axes
+whose size is not a multiple of the factor
+"""
+import sys, os
+import numpy as np
+
+from benchlib import timeit
+from pySPH import SPH
+from SPH_filter import SPH_filter
+
+REDUCE = {'mean': np.mean, 'min': np.min, 'max': np.max}
+
+
+def makeBox(dims: [int], org: [float] =(-1.0, 0.5, 2.0),
+            pitch: [float] =(0.1, 0.2, 0.3)) -> SPH.SPH:
+    ''' makeBox
+    dims(x, y, z)格子の、値がx + 2y + 3z(物理座標)のスカラー場のSPHを生成する
+    線形な場のため、'mean'で間引いた値は窓の中心の座標の値になる
+    '''
+    sph = SPH.SPH()
+    sph._dims[:] = dims
+    sph._org[:] = org
+    sph._pitch[:] = pitch
+    sph._veclen = 1
+    sph._dtype = SPH.SPH.DT_DOUBLE
+    x, y, z = [sph._org[i] + sph._pitch[i] * np.arange(dims[i])
+               for i in range(3)]
+    arr = x[None, None, :] + 2.0 * y[None, :, None] + 3.0 * z[:, None, None]
+    sph._data = arr.reshape((-1))
+    return sph
+
+
+def loopDecimate(d: SPH.SPH, factor: int, mode: str) -> np.ndarray:
+    ''' loopDecimate
+    窓毎にループで間引いた値を求める(比較用)
+    '''
+    vol = d._data.reshape((d._dims[2], d._dims[1], d._dims[0]))
+    rng = [range(0, n, factor) for n in reversed(d._dims)]
+    res = np.empty([len(r) for r in rng])
+    for k, k0 in enumerate(rng[0]):
+        for j, j0 in enumerate(rng[1]):
+            for i, i0 in enumerate(rng[2]):
+                res[k, j, i] = REDUCE[mode](vol[k0:k0+factor, j0:j0+factor,
+                                                i0:i0+factor])
+                continue # end of for(i)
+            continue # end of for(j)
+        continue # end of for(k)
+    return res
+
+
+def sameGrid(d: SPH.SPH, lo: SPH.SPH, factor: int) -> bool:
+    ''' sameGrid
+    間引いた格子の最初と最後の格子点が最初と最後の窓の中心にあり、
+    元データの範囲内に収まるか調べる
+    '''
+    for i in range(3):
+        n = d._dims[i]
+        last = factor * (lo._dims[i] - 1)
+        c0 = d._org[i] + d._pitch[i] * (min(factor, n) - 1) * 0.5
+        c1 = d._org[i] + d._pitch[i] * (last + n - 1) * 0.5
+        end = lo._org[i] + lo._pitch[i] * (lo._dims[i] - 1)
+        if not (np.isclose(lo._org[i], c0) and np.isclose(end, c1)):
+            return False
+        if end > d._org[i] + d._pitch[i] * (n - 1) + 1e-12:
+            return False
+        continue # end of for(i)
+    return True
+
+
+def bench(sizes: [[int]], factor: int, repeat: int):
+    print('{:>14} {:>5} {:>12} {:>6} {:>6} {}'.format(
+        'dims', 'mode', 'decimate[s]', 'values', 'grid', 'centers'))
+    for dims in sizes:
+        d = makeBox(dims)
+        for mode in ('mean', 'min', 'max'):
+            lo = SPH_filter.decimate(d, factor, mode)
+            t = timeit(lambda: SPH_filter.decimate(d, factor, mode), repeat)
+            ref = loopDecimate(d, factor, mode)
+            values = np.allclose(lo._data.reshape(ref.shape), ref)
+            grid = sameGrid(d, lo, factor)
+            # with full windows only, every point is at its window center
+            centers = '-'
+            if mode == 'mean' and all([n % factor == 0 for n in dims]):
+                at = makeBox(lo._dims, lo._org, lo._pitch)
+                centers = str(np.allclose(lo._data, at._data))
+            print('{:>14} {:>5} {:12.4f} {:>6} {:>6} {}'.format(
+                'x'.join([str(n) for n in dims]), mode, t, str(values),
+                str(grid), centers))
+            continue # end of for(mode)
+        continue # end of for(dims)
+    return
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='decimate benchmark')
+    parser.add_argument('-f', help='decimation factor', type=int, default=2)
+    parser.add_argument('-r', help='repeat count', type=int, default=3)
+    args = parser.parse_args()
+    bench([[64, 64, 64], [65, 33, 17], [63, 40, 5], [1, 7, 2]], args.f,
+          args.r)
+    sys.exit(0)
@@ -0,0 +1,109 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_divide - compare SPH_filter.divideShareEdge copy/view modes with the
+per-row loop implementation, and check that all of them give the same blocks
+"""
+import sys, os
+import time
+import numpy as np
+
+from benchlib import makeSPH, timeit
+from pySPH import SPH
+from SPH_filter import SPH_filter
+
+
+def legacyDivideShareEdge(d: SPH.SPH, div: []) -> []:
+    ''' legacyDivideShareEdge
+    以前のSPH_filter.divideShareEdgeと同じ、行毎にコピーするループで分割する
+    (比較用)
+    '''
+    sb_lst = []
+    sbDim = [int(d._dims[i] / div[i]) + (1 if div[i] != 1 else 0)
+             for i in range(3)]
+    sbDimE = [d._dims[i] - (sbDim[i] -1) * (div[i] - 1) for i in range(3)]
+    newOrg = list(d._org)
+    newOrgIdx = [0, 0, 0]
+    newDims = [0, 0, 0]
+    for k in range(div[2]):
+        newOrg[1] = d._org[1]
+        newOrgIdx[1] = 0
+        newDims[2] = sbDimE[2] if k == div[2] -1 else sbDim[2]
+        for j in range(div[1]):
+            newOrg[0] = d._org[0]
+            newOrgIdx[0] = 0
+            newDims[1] = sbDimE[1] if j == div[1] -1 else sbDim[1]
+            for i in range(div[0]):
+                newDims[0] = sbDimE[0] if i == div[0] -1 else sbDim[0]
+                sph = SPH.SPH()
+                sph._dims[:] = newDims[:]
+                sph._org[:] = newOrg[:]
+                sph._veclen = d._veclen
+                sph._data = np.zeros(newDims[0] * newDims[1] * newDims[2]
+                                     * d._veclen, dtype=d._data.dtype)
+                for kk in range(newDims[2]):
+                    for jj in range(newDims[1]):
+                        sst_idx = d._dims[0]*d._dims[1]*(kk+newOrgIdx[2]) \
+                            + d._dims[0]*(jj+newOrgIdx[1]) + newOrgIdx[0]
+                        sst_idx = sst_idx * d._veclen
+                        sed_idx = sst_idx + newDims[0] * d._veclen
+                        dst_idx = sph._dims[0]*sph._dims[1]*kk + sph._dims[0]*jj
+                        dst_idx = dst_idx * d._veclen
+                        ded_idx = dst_idx + newDims[0] * d._veclen
+                        sph._data[dst_idx:ded_idx] = d._data[sst_idx:sed_idx]
+                sb_lst.append(sph)
+                newOrg[0] += d._pitch[0] * (newDims[0] - 1)
+                newOrgIdx[0] += (newDims[0] - 1)
+            newOrg[1] += d._pitch[1] * (newDims[1] - 1)
+            newOrgIdx[1] += (newDims[1] - 1)
+        newOrg[2] += d._pitch[2] * (newDims[2] - 1)
+        newOrgIdx[2] += (newDims[2] - 1)
+    return sb_lst
+
+
+def sameBlocks(ref: [], lst: []) -> bool:
+    ''' sameBlocks
+    2つの分割結果の格子サイズ、原点、データが一致するか調べる
+    '''
+    if len(ref) != len(lst):
+        return False
+    for r, b in zip(ref, lst):
+        if r._dims != b._dims or r._org != b._org or r._veclen != b._veclen:
+            return False
+        if not np.array_equal(r._data, np.reshape(b._data, (-1))):
+            return False
+    return True
+
+
+def bench(n: int, repeat: int):
+    print('{:>6} {:>9} {:>12} {:>12} {:>12} {}'.format(
+        'veclen', 'div', 'loop[s]', 'copy[s]', 'view[s]', 'match'))
+    for veclen in (1, 3):
+        d = makeSPH(n, veclen, SPH.SPH.DT_SINGLE)
+        for div in ([2, 2, 2], [4, 3, 2], [1, 1, 5], [8, 8, 8]):
+            ref = legacyDivideShareEdge(d, div)
+            cpy = SPH_filter.divideShareEdge(d, div)
+            viw = SPH_filter.divideShareEdge(d, div, view=True)
+            match = sameBlocks(ref, cpy) and sameBlocks(ref, viw) and \
+                all(np.shares_memory(b._data, d._data) for b in viw)
+            t_loop = timeit(lambda: legacyDivideShareEdge(d, div), 1)
+            t_copy = timeit(lambda: SPH_filter.divideShareEdge(d, div), repeat)
+            t_view = timeit(lambda: SPH_filter.divideShareEdge(d, div, True),
+                            repeat)
+            print('{:>6} {:>9} {:12.4f} {:12.4f} {:12.6f} {}'.format(
+                veclen, 'x'.join([str(x) for x in div]),
+                t_loop, t_copy, t_view, match))
+            continue # end of for(div)
+        continue # end of for(veclen)
+    return
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='divideShareEdge benchmark')
+    parser.add_argument('-n', help='grid size of each axis', type=int,
+                        default=128)
+    parser.add_argument('-r', help='repeat count', type=int, default=3)
+    args = parser.parse_args()
+    bench(args.n, args.r)
+    sys.exit(0)
@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_isosurf_index - compare SPH_isosurf.generate over the whole block with
+the brick-index version on a field whose isosurface is sparse
+"""
+import sys, os
+import time
+import numpy as np
+from scipy.spatial import cKDTree
+
+import benchlib
+from pySPH import SPH
+from SPH_isosurf import SPH_isosurf
+
+
+def makeBlobs(n: int, nblob: int) -> SPH.SPH:
+    ''' makeBlobs
+    n^3格子に、nblob個の小さなガウス分布の塊を置いたスカラー場のSPHを生成する
+    '''
+    ax = np.linspace(-1.0, 1.0, n)
+    z, y, x = np.meshgrid(ax, ax, ax, indexing='ij')
+    rng = np.random.default_rng(1)
+    arr = np.zeros((n, n, n))
+    for c in rng.uniform(-0.8, 0.8, (nblob, 3)):
+        r2 = (x - c[0])**2 + (y - c[1])**2 + (z - c[2])**2
+        arr += np.exp(-r2 / 0.005)
+    sph = SPH.SPH()
+    sph._dims[:] = [n, n, n]
+    sph._org[:] = [-1.0, -1.0, -1.0]
+    sph._pitch[:] = [2.0/(n-1)] * 3
+    sph._veclen = 1
+    sph._dtype = SPH.SPH.DT_SINGLE
+    sph._data = arr.astype(np.float32).reshape((-1))
+    return sph
+
+
+def area(v, f) -> float:
+    a = v[f[:,1]] - v[f[:,0]]
+    b = v[f[:,2]] - v[f[:,0]]
+    return 0.5 * float(np.linalg.norm(np.cross(a, b), axis=1).sum())
+
+
+def normalDiff(v0, n0, v1, n1) -> float:
+    ''' normalDiff
+    v1の各頂点に最も近いv0の頂点との法線の差の最大値を求める
+    (頂点数が異なる場合はNaN)
+    '''
+    if len(v0) != len(v1):
+        return float('nan')
+    _, ix = cKDTree(v0).query(v1)
+    return float(np.abs(np.asarray(n1) - np.asarray(n0)[ix]).max())
+
+
+def timeit(func, repeat: int):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        res = func()
+        t = time.perf_counter() - t0
+        best = t if best is None else min(best, t)
+    return (best, res)
+
+
+def bench(sizes: [int], nblob: int, value: float, repeat: int):
+    print('{:>6} {:>12} {:>12} {:>12} {:>9} {:>8} {:>15} {:>9} {}'.format(
+        'n', 'full[s]', 'index[s]', 'bricked[s]', 'active', 'speedup',
+        'verts', 'area_diff', 'normal_diff'))
+    for n in sizes:
+        d = makeBlobs(n, nblob)
+        t_full, (v0, f0, n0) = timeit(
+            lambda: SPH_isosurf.generate(d, value), repeat)
+        t_idx, idx = timeit(lambda: SPH_isosurf.brickIndex(d), repeat)
+        t_brk, (v1, f1, n1) = timeit(
+            lambda: SPH_isosurf.generate(d, value, idx), repeat)
+        nact = len(SPH_isosurf.activeBricks(idx, value))
+        print('{:>6} {:12.4f} {:12.4f} {:12.4f} {:>9} {:8.1f} {:>15} {:9.3g}'
+              ' {:.3g}'.format(
+                  n, t_full, t_idx, t_brk, '{}/{}'.format(nact, idx[1].size),
+                  t_full / t_brk, '{}/{}'.format(len(v1), len(v0)),
+                  abs(area(v0, f0) - area(v1, f1)),
+                  normalDiff(v0, n0, v1, n1)))
+        continue # end of for(n)
+    return
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='brick index benchmark')
+    parser.add_argument('-n', help='grid sizes of each axis', type=int,
+                        nargs='+', default=[64, 128, 256])
+    parser.add_argument('-b', help='number of blobs', type=int, default=8)
+    parser.add_argument('-v', help='isovalue', type=float, default=0.5)
+    parser.add_argument('-r', help='repeat count', type=int, default=3)
+    args = parser.parse_args()
+    bench(args.n, args.b, args.v, args.r)
+    sys.exit(0)
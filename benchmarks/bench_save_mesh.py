@@ -0,0 +1,70 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_save_mesh - compare SPH_isosurf.saveOBJ with the per-line writer, and
+the binary PLY / npz writers
+"""
+import sys, os
+import time
+import tempfile
+import numpy as np
+
+from benchlib import makeSPH, timeit
+from pySPH import SPH
+from SPH_isosurf import SPH_isosurf
+
+
+def legacySaveOBJ(f, verts, faces, normals):
+    ''' legacySaveOBJ
+    以前のSPH_isosurf.saveOBJと同じ、1行ずつformatしてwriteするループ(比較用)
+    '''
+    f.write('o SPH_isosurf\n')
+    for v in verts:
+        f.write('v {} {} {}\n'.format(*v))
+    for vn in normals:
+        f.write('vn {} {} {}\n'.format(*vn))
+    for tri in faces:
+        f.write('f {}//{} {}//{} {}//{}\n'.format(
+            tri[0]+1,tri[0]+1,tri[1]+1,tri[1]+1,tri[2]+1,tri[2]+1))
+    return
+
+
+def bench(sizes: [int], repeat: int):
+    tmpdir = tempfile.mkdtemp(prefix='bench_save_mesh_')
+    ref_p = os.path.join(tmpdir, 'ref.obj')
+    paths = {ext: os.path.join(tmpdir, 'mesh' + ext)
+             for ext in ('.obj', '.ply', '.npz')}
+    print('{:>6} {:>9} {:>12} {:>12} {:>12} {:>12} {:>8} {}'.format(
+        'n', 'tris', 'legacy[s]', 'obj[s]', 'ply[s]', 'npz[s]', 'speedup',
+        'match'))
+    for n in sizes:
+        d = makeSPH(n, 1, SPH.SPH.DT_SINGLE)
+        v, f, nv = SPH_isosurf.generate(d, 0.3)
+
+        def legacy():
+            with open(ref_p, 'w') as fp:
+                legacySaveOBJ(fp, v, f, nv)
+        t_leg = timeit(legacy, 1)
+        t = {ext: timeit(lambda: SPH_isosurf.saveMesh(p, v, f, nv), repeat)
+             for ext, p in paths.items()}
+        with open(ref_p, 'rb') as a, open(paths['.obj'], 'rb') as b:
+            match = a.read() == b.read()
+        print('{:>6} {:>9} {:12.4f} {:12.4f} {:12.4f} {:12.4f} {:8.1f} {}'\
+              .format(n, len(f), t_leg, t['.obj'], t['.ply'], t['.npz'],
+                      t_leg / t['.obj'], match))
+        continue # end of for(n)
+    for p in [ref_p] + list(paths.values()):
+        os.remove(p)
+    os.rmdir(tmpdir)
+    return
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='mesh writer benchmark')
+    parser.add_argument('-n', help='grid sizes of each axis', type=int,
+                        nargs='+', default=[64, 128, 256])
+    parser.add_argument('-r', help='repeat count', type=int, default=3)
+    args = parser.parse_args()
+    bench(args.n, args.r)
+    sys.exit(0)
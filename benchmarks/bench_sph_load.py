@@ -0,0 +1,108 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_sph_load - compare SPH.load bulk reader with the per-voxel loop reader
+"""
+import sys, os
+import time
+import struct
+import tempfile
+import numpy as np
+
+from benchlib import makeSPH
+from pySPH import SPH
+
+
+def legacyLoad(path: str) -> SPH.SPH:
+    ''' legacyLoad
+    以前のSPH.loadと同じ、1ボクセルずつstruct.unpackするループでSPHファイルを読み込む
+    (比較用)
+    '''
+    sph = SPH.SPH()
+    ifp = open(path, 'rb')
+    bo = '<'
+    header = ifp.read(16)
+    buff = struct.unpack(bo+'iiii', header)
+    if buff[1] not in (1, 2):
+        bo = '>'
+        buff = struct.unpack(bo+'iiii', header)
+    svType, dType = buff[1], buff[2]
+    sph._veclen = 1 if svType == 1 else 3
+    sph._dtype = dType
+    if dType == 1:
+        buff = struct.unpack(bo+'iiiii', ifp.read(20))
+        sph._dims[:] = buff[1:4]
+        ifp.read(20 + 20 + 16)
+    else:
+        ifp.read(4)
+        sph._dims[:] = struct.unpack(bo+'qqq', ifp.read(24))
+        ifp.read(4 + 32 + 32 + 24)
+    ifp.read(4)
+
+    dimSz = sph._dims[0] * sph._dims[1] * sph._dims[2]
+    packStr = ('f' if dType == 1 else 'd') * sph._veclen
+    dlen = struct.calcsize(packStr)
+    sph._data = np.array(0, dtype=np.float32 if dType == 1 else np.float64)
+    sph._data.resize(dimSz*sph._veclen)
+    vals = struct.unpack(bo+packStr, ifp.read(dlen))
+    sph._min = list(vals)
+    sph._max = list(vals)
+    for l in range(sph._veclen):
+        sph._data[l] = vals[l]
+    for i in range(1, dimSz):
+        vals = struct.unpack(bo+packStr, ifp.read(dlen))
+        for l in range(sph._veclen):
+            sph._data[i*sph._veclen + l] = vals[l]
+            if sph._min[l] > vals[l]:
+                sph._min[l] = vals[l]
+            elif sph._max[l] < vals[l]:
+                sph._max[l] = vals[l]
+    ifp.close()
+    return sph
+
+
+def bench(n: int, repeat: int):
+    tmpdir = tempfile.mkdtemp(prefix='bench_sph_load_')
+    print('{:>8} {:>6} {:>12} {:>12} {:>8} {}'.format(
+        'dtype', 'veclen', 'loop[s]', 'bulk[s]', 'speedup', 'match'))
+    for dtype, dname in ((SPH.SPH.DT_SINGLE, 'float32'),
+                         (SPH.SPH.DT_DOUBLE, 'float64')):
+        for veclen in (1, 3):
+            path = os.path.join(tmpdir, '{}_{}.sph'.format(dname, veclen))
+            makeSPH(n, veclen, dtype).save(path)
+
+            t0 = time.perf_counter()
+            ref = legacyLoad(path)
+            t_loop = time.perf_counter() - t0
+
+            t_bulk = None
+            for _ in range(repeat):
+                sph = SPH.SPH()
+                t0 = time.perf_counter()
+                sph.load(path)
+                t = time.perf_counter() - t0
+                t_bulk = t if t_bulk is None else min(t_bulk, t)
+
+            match = sph._dims == ref._dims and \
+                sph._veclen == ref._veclen and \
+                sph._data.dtype == ref._data.dtype and \
+                sph._data.tobytes() == ref._data.tobytes() and \
+                sph._min == ref._min and sph._max == ref._max
+            print('{:>8} {:>6} {:12.4f} {:12.4f} {:8.1f} {}'.format(
+                dname, veclen, t_loop, t_bulk, t_loop / t_bulk, match))
+            os.remove(path)
+            continue # end of for(veclen)
+    os.rmdir(tmpdir)
+    return
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='SPH.load benchmark')
+    parser.add_argument('-n', help='grid size of each axis', type=int,
+                        default=64)
+    parser.add_argument('-r', help='repeat count of bulk reader', type=int,
+                        default=3)
+    args = parser.parse_args()
+    bench(args.n, args.r)
+    sys.exit(0)
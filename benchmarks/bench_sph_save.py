@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_sph_save - compare SPH.save bulk writers with the per-row loop writer
+"""
+import sys, os
+import time
+import struct
+import tempfile
+
+from benchlib import makeSPH
+from pySPH import SPH
+
+
+def legacySave(sph: SPH.SPH, path: str):
+    ''' legacySave
+    以前のSPH.saveと同じ、X方向の1行ずつstruct.packするループでSPHファイルを書き出す
+    (比較用、ヘッダーは現在のSPH.saveで書き出したものをコピーする)
+    '''
+    sph.save(path)
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        nbytes = sph._dims[0] * sph._dims[1] * sph._dims[2] * sph._veclen \
+            * (8 if sph._dtype == SPH.SPH.DT_DOUBLE else 4)
+        f.seek(-(nbytes + 8), os.SEEK_END)
+        hsize = f.tell()
+        f.seek(0)
+        header = f.read(hsize)
+    dimVX = sph._veclen * sph._dims[0]
+    dfmt = ('%dd' if sph._dtype == SPH.SPH.DT_DOUBLE else '%df') % dimVX
+    with open(path, 'wb') as ofp:
+        ofp.write(header)
+        ofp.write(struct.pack('i', nbytes))
+        k = 0
+        for i in range(sph._dims[2]):
+            for j in range(sph._dims[1]):
+                ofp.write(struct.pack(dfmt, *sph._data[k:k+dimVX]))
+                k = k + dimVX
+        ofp.write(struct.pack('i', nbytes))
+    return
+
+
+def bench(n: int, repeat: int):
+    tmpdir = tempfile.mkdtemp(prefix='bench_sph_save_')
+    ref = os.path.join(tmpdir, 'ref.sph')
+    out = os.path.join(tmpdir, 'out.sph')
+    print('{:>8} {:>6} {:>12} {:>12} {:>12} {}'.format(
+        'dtype', 'veclen', 'loop[s]', 'bulk[s]', 'writev[s]', 'match'))
+    for dtype, dname in ((SPH.SPH.DT_SINGLE, 'float32'),
+                         (SPH.SPH.DT_DOUBLE, 'float64')):
+        for veclen in (1, 3):
+            sph = makeSPH(n, veclen, dtype)
+            t0 = time.perf_counter()
+            legacySave(sph, ref)
+            t_loop = time.perf_counter() - t0
+            with open(ref, 'rb') as f:
+                ref_b = f.read()
+
+            res = []
+            match = True
+            for writev in (False, True):
+                best = None
+                for _ in range(repeat):
+                    t0 = time.perf_counter()
+                    sph.save(out, writev=writev)
+                    t = time.perf_counter() - t0
+                    best = t if best is None else min(best, t)
+                with open(out, 'rb') as f:
+                    match = match and f.read() == ref_b
+                res.append(best)
+            print('{:>8} {:>6} {:12.4f} {:12.4f} {:12.4f} {}'.format(
+                dname, veclen, t_loop, res[0], res[1], match))
+            continue # end of for(veclen)
+    os.remove(ref)
+    os.remove(out)
+    os.rmdir(tmpdir)
+    return
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='SPH.save benchmark')
+    parser.add_argument('-n', help='grid size of each axis', type=int,
+                        default=64)
+    parser.add_argument('-r', help='repeat count of bulk writers', type=int,
+                        default=3)
+    args = parser.parse_args()
+    bench(args.n, args.r)
+    sys.exit(0)
@@ -0,0 +1,64 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_vector_mag - compare SPH_filter.vectorMag/extractScalar with the
+per-voxel loop implementation on 3-component float32 fields
+"""
+import sys, os
+import time
+import numpy as np
+
+from benchlib import makeSPH, timeit
+from pySPH import SPH
+from SPH_filter import SPH_filter
+
+
+def legacyVectorMag(d: SPH.SPH) -> np.ndarray:
+    ''' legacyVectorMag
+    以前のSPH_filter.vectorMagと同じ、1ボクセルずつnp.linalg.normを呼ぶループ
+    (比較用、データ部のみ返す)
+    '''
+    dimSz = d._dims[0] * d._dims[1] * d._dims[2]
+    res = np.zeros(dimSz, dtype=d._data.dtype)
+    for i in range(dimSz):
+        idx = i * d._veclen
+        res[i] = np.linalg.norm(d._data[idx:idx+d._veclen], ord=2)
+    return res
+
+
+def bench(sizes: [int], repeat: int):
+    print('{:>6} {:>12} {:>12} {:>12} {:>12} {:>12} {}'.format(
+        'n', 'loop[s]', 'mag[s]', 'mag_out[s]', 'view[s]', 'extract[s]',
+        'max_err'))
+    for n in sizes:
+        d = makeSPH(n, 3, SPH.SPH.DT_SINGLE)
+        dimSz = n * n * n
+        buf = np.empty(dimSz, dtype=np.float32)
+        blk = SPH_filter.divideShareEdge(d, [2, 2, 2], view=True)[0]
+
+        ref = legacyVectorMag(d) if n <= 64 else None
+        t_loop = timeit(lambda: legacyVectorMag(d), 1) if n <= 64 else None
+        t_mag = timeit(lambda: SPH_filter.vectorMag(d), repeat)
+        t_out = timeit(lambda: SPH_filter.vectorMag(d, out=buf), repeat)
+        t_view = timeit(lambda: SPH_filter.vectorMag(blk), repeat)
+        t_ext = timeit(lambda: SPH_filter.extractScalar(d, 1, out=buf), repeat)
+        err = '-'
+        if ref is not None:
+            mag = SPH_filter.vectorMag(d)._data
+            err = '{:.3g}'.format(float(np.abs(mag - ref).max()))
+        print('{:>6} {:>12} {:12.4f} {:12.4f} {:12.4f} {:12.4f} {}'.format(
+            n, '{:.4f}'.format(t_loop) if t_loop is not None else '-',
+            t_mag, t_out, t_view, t_ext, err))
+        continue # end of for(n)
+    return
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='vectorMag benchmark')
+    parser.add_argument('-n', help='grid sizes of each axis', type=int,
+                        nargs='+', default=[32, 64, 128, 256])
+    parser.add_argument('-r', help='repeat count', type=int, default=5)
+    args = parser.parse_args()
+    bench(args.n, args.r)
+    sys.exit(0)
@@ -0,0 +1,191 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchlib - synthetic SPH data, timers and result/baseline handling shared by
+the benchmarks
+"""
+import sys, os
+import time
+import json
+import platform
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'python'))
+from pySPH import SPH
+
+DTYPES = {'float32': SPH.SPH.DT_SINGLE, 'float64': SPH.SPH.DT_DOUBLE}
+
+
+def makeSPH(n: int, veclen: int, dtype: int, phase: float =0.0) -> SPH.SPH:
+    ''' makeSPH
+    n^3格子の解析的なスカラー/ベクトル場を持つSPHを生成する
+    スカラー場はcos(4r + phase)、ベクトル場は(-y, x, sin(3z + phase))で、
+    phaseを変えることで時系列の各ステップを作ることができる。
+    '''
+    ax = np.linspace(-1.0, 1.0, n)
+    z, y, x = np.meshgrid(ax, ax, ax, indexing='ij')
+    if veclen == 1:
+        r = np.sqrt(x*x + y*y + z*z)
+        arr = np.cos(4.0 * r + phase)
+    else:
+        arr = np.stack([-y, x, np.sin(3.0 * z + phase)], axis=-1)
+    sph = SPH.SPH()
+    sph._dims[:] = [n, n, n]
+    sph._org[:] = [-1.0, -1.0, -1.0]
+    sph._pitch[:] = [2.0/(n-1)] * 3
+    sph._veclen = veclen
+    sph._dtype = dtype
+    ftype = np.float32 if dtype == SPH.SPH.DT_SINGLE else np.float64
+    sph._data = arr.astype(ftype).reshape((-1))
+    return sph
+
+
+def makeSeries(outdir: str, n: int, veclen: int, dtype: int,
+               nsteps: int) -> [str]:
+    ''' makeSeries
+    makeSPHの場をphaseを変えながらnsteps個のSPHファイルとしてoutdirに書き出す
+
+    Returns
+    -------
+    [str]: 書き出したSPHファイルのパスのリスト(ステップ順)
+    '''
+    os.makedirs(outdir, exist_ok=True)
+    paths = []
+    for i in range(nsteps):
+        sph = makeSPH(n, veclen, dtype, phase=0.25 * i)
+        sph._step = i
+        sph._time = float(i)
+        path = os.path.join(outdir, 'step{:04d}.sph'.format(i))
+        if not sph.save(path):
+            raise IOError('save failed: {}'.format(path))
+        paths.append(path)
+        continue # end of for(i)
+    return paths
+
+
+def timeit(func, repeat: int) -> float:
+    ''' timeit
+    funcをrepeat回実行し、最短の実行時間[s]を返す
+    '''
+    return min(timeRuns(func, repeat))
+
+
+def timeRuns(func, repeat: int, setup=None) -> [float]:
+    ''' timeRuns
+    funcをrepeat回実行し、各回の実行時間[s]のリストを返す
+    setupが指定された場合は、各回の前に(計測せずに)実行する
+    '''
+    runs = []
+    for _ in range(max(1, repeat)):
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - t0)
+        continue # end of for
+    return runs
+
+
+class BenchResults:
+    ''' BenchResults
+    ベンチマークケース毎の計測結果を保持し、JSONへの保存、
+    ベースライン(以前に保存した結果)との比較を行うクラスです。
+    各ケースの代表値は最短の実行時間('best')です。
+    '''
+    def __init__(self, args: dict =None) -> None:
+        self._results = {}
+        self._meta = {
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'args': args if args else {},
+        }
+        return
+
+    @property
+    def results(self):
+        return self._results
+
+    def add(self, name: str, runs: [float], **info) -> None:
+        ''' add
+        ケースnameの計測結果(各回の実行時間[s])を登録し、1行表示する
+
+        Parameters
+        ----------
+        name: str
+          ケース名
+        runs: [float]
+          各回の実行時間[s]
+        info: dict
+          付加情報(データサイズ等、JSONに記録される)
+        '''
+        srt = sorted(runs)
+        ent = {'best': srt[0], 'median': srt[len(srt)//2], 'runs': runs}
+        ent.update(info)
+        self._results[name] = ent
+        print('{:<44} {:12.6f} {:12.6f}'.format(name, ent['best'],
+                                               ent['median']))
+        sys.stdout.flush()
+        return
+
+    def save(self, path: str) -> None:
+        ''' save
+        計測結果をJSONファイルに保存する
+        '''
+        dname = os.path.dirname(path)
+        if dname:
+            os.makedirs(dname, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'meta': self._meta, 'results': self._results}, f,
+                      indent=2)
+        return
+
+    @staticmethod
+    def load(path: str) -> dict:
+        ''' load
+        saveで保存したJSONファイルから計測結果を読み込む(static method)
+
+        Returns
+        -------
+        dict: ケース名 -> 計測結果
+        '''
+        with open(path) as f:
+            return json.load(f)['results']
+
+    def compare(self, baseline: dict, threshold: float) -> [str]:
+        ''' compare
+        ベースラインと共通のケースについて最短の実行時間の比を表示し、
+        1 + thresholdを超えて遅くなったケースを返す
+
+        Parameters
+        ----------
+        baseline: dict
+          loadで読み込んだベースラインの計測結果
+        threshold: float
+          許容する遅くなる割合(0.2なら20%)
+
+        Returns
+        -------
+        [str]: 遅くなったケース名のリスト
+        '''
+        regressions = []
+        print('{:<44} {:>12} {:>12} {:>8}'.format(
+            'case', 'baseline[s]', 'current[s]', 'ratio'))
+        for name, ent in self._results.items():
+            if name not in baseline:
+                print('{:<44} {:>12} {:12.6f} {:>8}'.format(
+                    name, '-', ent['best'], 'new'))
+                continue
+            base = baseline[name]['best']
+            ratio = ent['best'] / base if base > 0 else float('inf')
+            mark = ''
+            if ratio > 1.0 + threshold:
+                mark = ' REGRESSION'
+                regressions.append(name)
+            print('{:<44} {:12.6f} {:12.6f} {:8.2f}{}'.format(
+                name, base, ent['best'], ratio, mark))
+            continue # end of for(name, ent)
+        return regressions
@@ -0,0 +1,203 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+run_suite - timed benchmark cases of the TB -> TB2C_server -> visualize
+pipeline on synthetic SPH data, with JSON results and baseline comparison
+"""
+import sys, os
+import io
+import json
+import shutil
+import tempfile
+import threading
+import urllib.request
+
+from benchlib import DTYPES, makeSPH, makeSeries, timeRuns, BenchResults
+from pySPH import SPH
+from SPH_filter import SPH_filter
+from SPH_isosurf import SPH_isosurf
+
+ISOVALUE = 0.3
+DIVS = ([2, 2, 2], [4, 4, 4])
+
+
+def benchData(res: BenchResults, n: int, dname: str, repeat: int,
+              tmpdir: str) -> None:
+    ''' benchData
+    SPH.load/save、vectorMag、divideShareEdge、SPH_isosurf.generate、
+    saveOBJのケースを計測する
+    '''
+    dtype = DTYPES[dname]
+    for veclen in (1, 3):
+        sph = makeSPH(n, veclen, dtype)
+        tag = '{}/{}/v{}'.format(n, dname, veclen)
+        path = os.path.join(tmpdir, 'bench.sph')
+        nbytes = sph._data.nbytes
+        res.add('sph_save/' + tag,
+                timeRuns(lambda: sph.save(path), repeat), bytes=nbytes)
+        res.add('sph_load/' + tag,
+                timeRuns(lambda: SPH.SPH().load(path), repeat), bytes=nbytes)
+        res.add('sph_load_mmap/' + tag,
+                timeRuns(lambda: SPH.SPH().load(path, mmap=True), repeat),
+                bytes=nbytes)
+        os.remove(path)
+        for div in DIVS:
+            dtag = '{}/{}'.format(tag, 'x'.join([str(x) for x in div]))
+            res.add('divide_view/' + dtag, timeRuns(
+                lambda: SPH_filter.divideShareEdge(sph, div, view=True),
+                repeat))
+            res.add('divide_copy/' + dtag, timeRuns(
+                lambda: SPH_filter.divideShareEdge(sph, div), repeat))
+            continue # end of for(div)
+        if veclen == 1:
+            runs = timeRuns(lambda: SPH_isosurf.generate(sph, ISOVALUE),
+                            repeat)
+            v, f, nv = SPH_isosurf.generate(sph, ISOVALUE)
+            res.add('isosurf_generate/' + tag, runs, triangles=len(f))
+            idx = SPH_isosurf.brickIndex(sph)
+            res.add('isosurf_index/' + tag,
+                    timeRuns(lambda: SPH_isosurf.brickIndex(sph), repeat))
+            res.add('isosurf_bricked/' + tag, timeRuns(
+                lambda: SPH_isosurf.generate(sph, ISOVALUE, idx), repeat))
+            res.add('save_obj/' + tag, timeRuns(
+                lambda: SPH_isosurf.saveOBJ(io.StringIO(), v, f, nv),
+                repeat), triangles=len(f))
+        else:
+            res.add('vector_mag/' + tag,
+                    timeRuns(lambda: SPH_filter.vectorMag(sph), repeat))
+        continue # end of for(veclen)
+    return
+
+
+def startServer(server_class, handler_class, nworkers: int =4):
+    ''' startServer
+    ログ出力を抑止したハンドラーでHTTPサーバを127.0.0.1の空きポートに起動する
+
+    Returns
+    -------
+    (server, str): サーバとそのURL
+    '''
+    class QuietHandler(handler_class):
+        def log_message(self, format, *args):
+            return
+    httpd = server_class(('127.0.0.1', 0), QuietHandler, nworkers=nworkers)
+    th = threading.Thread(target=httpd.serve_forever)
+    th.daemon = True
+    th.start()
+    return (httpd, 'http://127.0.0.1:{}/'.format(httpd.server_address[1]))
+
+
+def benchVisualize(res: BenchResults, n: int, dname: str, repeat: int,
+                   tmpdir: str, procs: int) -> None:
+    ''' benchVisualize
+    プロセス内で起動したTBとTB2C_serverに対し、/visualizeリクエスト全体
+    (TBからのデータ取得、分割、等値面生成、3D-Tiles出力)を計測する
+    各回は異なるステップを要求するため、データ取得はキャッシュされない
+    '''
+    import TB, TB2C_server
+    from utilHttp import PooledHTTPServer
+
+    for veclen in (1, 3):
+        tag = '{}/{}/v{}'.format(n, dname, veclen)
+        sdir = os.path.join(tmpdir, 'series_v{}'.format(veclen))
+        files = makeSeries(sdir, n, veclen, DTYPES[dname], repeat)
+        TB.g_tb = TB.TB()
+        if not TB.g_tb.loadFromFilelist(files, ''):
+            raise RuntimeError('TB: load failed')
+        tb_httpd, tb_url = startServer(PooledHTTPServer, TB.TBReqHandler)
+
+        for div in DIVS:
+            app = TB2C_server.TB2C_server()
+            TB2C_server.g_app = app
+            app._out_dir = os.path.join(tmpdir, 'out')
+            app._div[:] = div
+            app.setupProcPool(procs)
+            app.connectTB(tb_url)
+            vis_httpd, vis_url = startServer(
+                PooledHTTPServer, TB2C_server.TB2C_server_ReqHandler)
+            steps = iter(range(repeat))
+
+            def post():
+                data = {'step': next(steps), 'vistype': 'isosurf',
+                        'visparam': {'value': ISOVALUE}}
+                req = urllib.request.Request(
+                    vis_url + 'visualize', json.dumps(data).encode(),
+                    {'Content-Type': 'application/json'})
+                with urllib.request.urlopen(req) as r:
+                    if r.headers.get('X-TB2C-Block-Errors'):
+                        raise RuntimeError('block errors: {}'.format(
+                            r.headers.get('X-TB2C-Block-Errors')))
+                    return json.loads(r.read())
+            res.add('visualize/{}/{}'.format(
+                tag, 'x'.join([str(x) for x in div])),
+                    timeRuns(post, repeat), procs=procs)
+            vis_httpd.shutdown()
+            vis_httpd.server_close()
+            app.closeProcPool()
+            shutil.rmtree(app._out_dir, ignore_errors=True)
+            continue # end of for(div)
+        tb_httpd.shutdown()
+        tb_httpd.server_close()
+        shutil.rmtree(sdir, ignore_errors=True)
+        continue # end of for(veclen)
+    return
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='TB2C benchmark suite: runs the timed cases on synthetic'
+        ' SPH data, writes JSON results and compares them with a baseline')
+    parser.add_argument('-n', help='grid sizes of each axis', type=int,
+                        nargs='+', default=[64, 128])
+    parser.add_argument('-d', help='data types', nargs='+',
+                        choices=list(DTYPES.keys()), default=['float32'])
+    parser.add_argument('-r', help='repeat count of each case', type=int,
+                        default=3)
+    parser.add_argument('-o', help='path of the JSON results', type=str,
+                        default='bench_results.json')
+    parser.add_argument('-b', help='path of the baseline JSON results',
+                        type=str, default=None)
+    parser.add_argument('-t', help='regression threshold'\
+                        + ' (0.2: 20%% slower than the baseline)',
+                        type=float, default=0.2)
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='write the results to the baseline path (-b)')
+    parser.add_argument('--procs', help='worker processes of TB2C_server',
+                        type=int, default=1)
+    parser.add_argument('--no-visualize', action='store_true',
+                        help='skip the /visualize cases')
+    args = parser.parse_args()
+
+    res = BenchResults(vars(args))
+    tmpdir = tempfile.mkdtemp(prefix='tb2c_bench_')
+    print('{:<44} {:>12} {:>12}'.format('case', 'best[s]', 'median[s]'))
+    try:
+        for n in args.n:
+            for dname in args.d:
+                benchData(res, n, dname, args.r, tmpdir)
+                if not args.no_visualize:
+                    benchVisualize(res, n, dname, args.r, tmpdir, args.procs)
+                continue # end of for(dname)
+            continue # end of for(n)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    res.save(args.o)
+    print('results written to {}'.format(args.o))
+
+    if args.b:
+        if args.update_baseline:
+            res.save(args.b)
+            print('baseline written to {}'.format(args.b))
+            sys.exit(0)
+        try:
+            baseline = BenchResults.load(args.b)
+        except Exception as e:
+            print('can not load baseline {}: {}'.format(args.b, str(e)))
+            sys.exit(1)
+        regressions = res.compare(baseline, args.t)
+        if regressions:
+            print('{} case(s) regressed more than {:.0%}'.format(
+                len(regressions), args.t))
+            sys.exit(1)
+    sys.exit(0)
@@ -0,0 +1,654 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SPH_binary
+"""
+
+import sys, os
+import struct
+import json
+import zlib
+import lzma
+from collections import deque
+import numpy as np
+from pySPH import SPH
+
+
+class SPH_binary:
+    ''' SPH_binary
+    SPHデータをバイナリ形式(application/octet-stream)で送受信するための
+    エンコード/デコード実装クラスです。
+    バイナリ形式は以下の構成です。
+      magic(4byte: 'SPHB') + ヘッダー長(uint32, little endian) +
+      ヘッダー(JSON, 8byte境界までスペースでパディング) + データ部(_dataそのまま)
+    ヘッダーにはdims/org/pitch/step/time/dtype/veclen/min/maxと、
+    データ部のnumpy dtype文字列('format')が格納されます(min/maxは確定して
+    いない場合(mmapで未計算)はnullとなり、受信側で必要時に計算されます)。
+    ストリーム形式では、データ部はZ方向のスラブ毎のフレームに分割されます。
+      フレーム = フレームヘッダー(k0: uint32, nk: uint32, nbytes: uint64,
+                 little endian) + スラブのデータ(Z方向k0からnk面分, nbytesバイト)
+    データ部はnk=0のフレーム(終端)で終わります。
+    ストリーム形式のスラブのデータは圧縮できます(codec: 'zlib', 'lzma')。
+    圧縮したスラブは要素のバイト毎に並べ替えた(byte-shuffle)後に圧縮され、
+    フレームヘッダーのnbytesは圧縮後のバイト数になります。HTTPでは
+    Accept-Encoding/Content-Encodingの'sph-shuffle-{codec}'で指定されます。
+    '''
+    MAGIC = b'SPHB'
+    CONTENT_TYPE = 'application/octet-stream'
+    FRAME = struct.Struct('<IIQ')
+    SLAB_BYTES = 8 * 1024 * 1024
+    CODECS = ('zlib', 'lzma')
+    CODEC_LEVELS = {'zlib': 1, 'lzma': 0} # default level (lzma: preset)
+    ENCODING_PREFIX = 'sph-shuffle-'
+    READ_BYTES = 1024 * 1024 # size of compressed pieces read at once
+
+    @staticmethod
+    def header(d: SPH.SPH) -> bytes:
+        ''' header
+        SPHデータのバイナリ形式のヘッダー部を生成する(static method)
+
+        Parameters
+        ----------
+        d: SPH.SPH
+          送信するSPHデータ
+
+        Returns
+        -------
+        bytes: magic、ヘッダー長を含むヘッダー部
+        '''
+        hd = {
+            'dims': list(d._dims),
+            'org': list(d._org),
+            'pitch': list(d._pitch),
+            'step': d._step,
+            'time': d._time,
+            'dtype': d._dtype,
+            'veclen': d._veclen,
+            'min': list(d._vmin) if d._vmin is not None else None,
+            'max': list(d._vmax) if d._vmax is not None else None,
+            'format': d._data.dtype.str,
+        }
+        hb = json.dumps(hd).encode('utf-8')
+        pad = (8 - (len(hb) + 8) % 8) % 8
+        hb += b' ' * pad
+        return SPH_binary.MAGIC + struct.pack('<I', len(hb)) + hb
+
+    @staticmethod
+    def dataBuffer(d: SPH.SPH) -> memoryview:
+        ''' dataBuffer
+        SPHデータのデータ部をコピーせずにバイト列として参照する(static method)
+        _dataが連続配列でない場合のみ連続配列にコピーされます。
+
+        Parameters
+        ----------
+        d: SPH.SPH
+          送信するSPHデータ
+
+        Returns
+        -------
+        memoryview: データ部のバイト列
+        '''
+        arr = np.ascontiguousarray(d._data).reshape((-1))
+        return memoryview(arr.view(np.uint8))
+
+    @staticmethod
+    def slabPlanes(d: SPH.SPH, slab_bytes: int =0) -> int:
+        ''' slabPlanes
+        1フレームに格納するZ方向の面数を求める(static method)
+
+        Parameters
+        ----------
+        d: SPH.SPH
+          送信するSPHデータ
+        slab_bytes: int
+          1フレームのデータの目安のバイト数(省略時はSLAB_BYTES)
+
+        Returns
+        -------
+        int: 1フレームの面数(>0)
+        '''
+        if slab_bytes <= 0:
+            slab_bytes = SPH_binary.SLAB_BYTES
+        plane = d._dims[0] * d._dims[1] * d._veclen * d._data.dtype.itemsize
+        return max(1, slab_bytes // max(1, plane))
+
+    @staticmethod
+    def frames(d: SPH.SPH, nk: int):
+        ''' frames
+        SPHデータのデータ部をnk面毎のフレームに分割する(static method)
+        スラブのデータは_dataをコピーせずに参照します(_dataが連続配列でない
+        場合を除く)。最後に終端フレーム(nk=0)を生成します。
+
+        Parameters
+        ----------
+        d: SPH.SPH
+          送信するSPHデータ
+        nk: int
+          1フレームの面数
+
+        Returns
+        -------
+        generator: (フレームヘッダー: bytes, スラブのデータ: memoryview)
+        '''
+        body = SPH_binary.dataBuffer(d)
+        plane = d._dims[0] * d._dims[1] * d._veclen * d._data.dtype.itemsize
+        nz = d._dims[2]
+        for k0 in range(0, nz, nk):
+            n = min(nk, nz - k0)
+            yield (SPH_binary.FRAME.pack(k0, n, n * plane),
+                   body[k0*plane:(k0+n)*plane])
+            continue # end of for(k0)
+        yield (SPH_binary.FRAME.pack(nz, 0, 0), memoryview(b''))
+        return
+
+    @staticmethod
+    def shuffle(buf, itemsize: int) -> np.ndarray:
+        ''' shuffle
+        要素(itemsizeバイト)の配列のバイト列を、要素の各バイト毎に並べ替える
+        (byte-shuffle, static method)
+        値が滑らかに変化する場、特に指数部、上位バイトが連続するため、
+        圧縮率が向上します。
+
+        Parameters
+        ----------
+        buf: bytes-like
+          要素の配列のバイト列
+        itemsize: int
+          要素のバイト数
+
+        Returns
+        -------
+        numpy.ndarray: 並べ替えたバイト列(uint8, 連続配列)
+        '''
+        src = np.frombuffer(buf, dtype=np.uint8)
+        return np.ascontiguousarray(src.reshape((-1, itemsize)).T)
+
+    @staticmethod
+    def unshuffle(buf, itemsize: int, out=None) -> np.ndarray:
+        ''' unshuffle
+        shuffleしたバイト列を元の並びに戻す(static method)
+
+        Parameters
+        ----------
+        buf: bytes-like
+          shuffleしたバイト列
+        itemsize: int
+          要素のバイト数
+        out: bytes-like
+          格納先(省略時は新たに確保)
+
+        Returns
+        -------
+        numpy.ndarray: 元の並びのバイト列(uint8)
+        '''
+        src = np.frombuffer(buf, dtype=np.uint8).reshape((itemsize, -1))
+        if out is None:
+            return np.ascontiguousarray(src.T).reshape((-1))
+        dst = np.frombuffer(out, dtype=np.uint8)
+        dst.reshape((-1, itemsize))[...] = src.T
+        return dst
+
+    @staticmethod
+    def compress(buf, itemsize: int, codec: str, level: int =None) -> bytes:
+        ''' compress
+        バイト列をshuffleしてからcodecで圧縮する(static method)
+
+        Parameters
+        ----------
+        buf: bytes-like
+          要素の配列のバイト列
+        itemsize: int
+          要素のバイト数
+        codec: str
+          'zlib'または'lzma'
+        level: int
+          圧縮レベル(省略時はCODEC_LEVELS[codec])
+
+        Returns
+        -------
+        bytes: 圧縮したデータ
+        '''
+        if level is None:
+            level = SPH_binary.CODEC_LEVELS[codec]
+        data = SPH_binary.shuffle(buf, itemsize)
+        if codec == 'zlib':
+            return zlib.compress(data, level)
+        if codec == 'lzma':
+            return lzma.compress(data, preset=level)
+        raise ValueError('unknown codec: {}'.format(codec))
+
+    @staticmethod
+    def decompressor(codec: str):
+        ''' decompressor
+        codecの逐次展開オブジェクトを生成する(static method)
+
+        Parameters
+        ----------
+        codec: str
+          'zlib'または'lzma'
+
+        Returns
+        -------
+        object: decompress(data)とeofを持つ展開オブジェクト
+        '''
+        if codec == 'zlib':
+            return zlib.decompressobj()
+        if codec == 'lzma':
+            return lzma.LZMADecompressor()
+        raise ValueError('unknown codec: {}'.format(codec))
+
+    @staticmethod
+    def acceptEncoding(codecs) -> str:
+        ''' acceptEncoding
+        codecのリストからAccept-Encodingヘッダーの値を生成する(static method)
+
+        Parameters
+        ----------
+        codecs: [str]
+          受け入れるcodec(優先順)
+
+        Returns
+        -------
+        str: Accept-Encodingヘッダーの値
+        '''
+        return ', '.join([SPH_binary.ENCODING_PREFIX + c for c in codecs])
+
+    @staticmethod
+    def selectCodec(accept: str) -> str:
+        ''' selectCodec
+        Accept-Encoding(またはContent-Encoding)ヘッダーの値から、対応している
+        codecを選択する(static method)
+        q=0が指定されたものは除かれ、qの大きいもの、先に書かれたものが
+        優先されます。
+
+        Parameters
+        ----------
+        accept: str
+          ヘッダーの値(Noneも可)
+
+        Returns
+        -------
+        str: codec、None: 対応しているものがない(圧縮しない)
+        '''
+        if not accept:
+            return None
+        cands = []
+        for i, item in enumerate(accept.split(',')):
+            token, *params = [x.strip() for x in item.split(';')]
+            q = 1.0
+            for prm in params:
+                if prm.startswith('q='):
+                    try:
+                        q = float(prm[2:])
+                    except ValueError:
+                        q = 0.0
+            codec = token.lower()[len(SPH_binary.ENCODING_PREFIX):] \
+                if token.lower().startswith(SPH_binary.ENCODING_PREFIX) \
+                else None
+            if codec in SPH_binary.CODECS and q > 0.0:
+                cands.append((-q, i, codec))
+            continue # end of for(i, item)
+        if not cands:
+            return None
+        return min(cands)[2]
+
+    @staticmethod
+    def encodeFrames(d: SPH.SPH, nk: int, codec: str =None,
+                     level: int =None, pool=None, ahead: int =2):
+        ''' encodeFrames
+        framesの各フレームのスラブのデータをcodecで圧縮する(static method)
+        poolが指定された場合は、ahead個先までのフレームをpoolで並行して
+        圧縮するため、生成されたフレームの送信と後続のフレームの圧縮が
+        重なります(zlib, lzmaは圧縮中にGILを解放します)。
+        codecがNoneの場合はframesと同じです。
+
+        Parameters
+        ----------
+        d: SPH.SPH
+          送信するSPHデータ
+        nk: int
+          1フレームの面数
+        codec: str
+          'zlib', 'lzma'、None: 圧縮しない
+        level: int
+          圧縮レベル(省略時はCODEC_LEVELS[codec])
+        pool: concurrent.futures.Executor
+          圧縮を実行するExecutor(省略時は逐次圧縮)
+        ahead: int
+          先行して圧縮するフレーム数
+
+        Returns
+        -------
+        generator: (フレームヘッダー: bytes, スラブのデータ: bytes-like)
+        '''
+        if codec is None:
+            yield from SPH_binary.frames(d, nk)
+            return
+        itemsize = d._data.dtype.itemsize
+        def encode(fh, body):
+            k0, n, nbytes = SPH_binary.FRAME.unpack(fh)
+            if n == 0:
+                return (fh, body) # end of frames
+            cbuf = SPH_binary.compress(body, itemsize, codec, level)
+            return (SPH_binary.FRAME.pack(k0, n, len(cbuf)), cbuf)
+        if pool is None:
+            for fh, body in SPH_binary.frames(d, nk):
+                yield encode(fh, body)
+            return
+        futs = deque()
+        for fh, body in SPH_binary.frames(d, nk):
+            futs.append(pool.submit(encode, fh, body))
+            if len(futs) > ahead:
+                yield futs.popleft().result()
+            continue # end of for(fh, body)
+        while futs:
+            yield futs.popleft().result()
+        return
+
+    @staticmethod
+    def parseHeader(hb: bytes) -> (SPH.SPH, np.dtype):
+        ''' parseHeader
+        ヘッダー(JSON部)を解析し、データ部を持たないSPHデータを生成する(static method)
+
+        Parameters
+        ----------
+        hb: bytes
+          ヘッダー(JSON部)
+
+        Returns
+        -------
+        SPH.SPH: データ部を持たないSPHデータ
+        numpy.dtype: データ部のdtype
+        '''
+        hd = json.loads(bytes(hb).decode('utf-8'))
+        sph = SPH.SPH()
+        sph._dims[:] = hd['dims']
+        sph._org[:] = hd['org']
+        sph._pitch[:] = hd['pitch']
+        sph._step = hd['step']
+        sph._time = hd['time']
+        sph._dtype = hd['dtype']
+        sph._veclen = hd['veclen']
+        sph._min = hd['min']
+        sph._max = hd['max']
+        return (sph, np.dtype(hd['format']))
+
+    @staticmethod
+    def setData(sph: SPH.SPH, buf, fmt: np.dtype, offset: int =0) -> bool:
+        ''' setData
+        バッファbufをコピーせずにSPHデータのデータ部として設定する(static method)
+        データ部のバイトオーダーがネイティブでない場合のみ変換(コピー)されます。
+
+        Parameters
+        ----------
+        sph: SPH.SPH
+          データ部を設定するSPHデータ
+        buf: bytes-like
+          データ部を含むバッファ
+        fmt: numpy.dtype
+          データ部のdtype
+        offset: int
+          バッファ中のデータ部の開始位置
+
+        Returns
+        -------
+        bool: True=成功、False=失敗
+        '''
+        cnt = sph._dims[0] * sph._dims[1] * sph._dims[2] * sph._veclen
+        try:
+            arr = np.frombuffer(buf, dtype=fmt, count=cnt, offset=offset)
+        except ValueError:
+            return False
+        if not fmt.isnative:
+            arr = arr.astype(fmt.newbyteorder('='))
+        sph._data = arr
+        return True
+
+    @staticmethod
+    def fromBinary(buf) -> SPH.SPH:
+        ''' fromBinary
+        メモリ上のバイナリ形式データからSPHデータを復元する(static method)
+        データ部はbufを参照します(コピーしません)。
+
+        Parameters
+        ----------
+        buf: bytes-like
+          バイナリ形式データ
+
+        Returns
+        -------
+        SPH.SPH: 復元されたSPHデータ、None: 失敗
+        '''
+        mv = memoryview(buf)
+        if len(mv) < 8 or bytes(mv[0:4]) != SPH_binary.MAGIC:
+            return None
+        hlen = struct.unpack('<I', mv[4:8])[0]
+        sph, fmt = SPH_binary.parseHeader(mv[8:8+hlen])
+        if not SPH_binary.setData(sph, buf, fmt, 8+hlen):
+            return None
+        return sph
+
+    @staticmethod
+    def readFrom(f) -> SPH.SPH:
+        ''' readFrom
+        ストリーム(ファイル、HTTPレスポンス等)からバイナリ形式データを読み込み、
+        SPHデータを復元する(static method)
+        データ部は確保したバッファに直接読み込まれます(中間コピーなし)。
+
+        Parameters
+        ----------
+        f: typing.IO
+          readintoをサポートするストリーム
+
+        Returns
+        -------
+        SPH.SPH: 復元されたSPHデータ、None: 失敗
+        '''
+        res = SPH_binary.readHeader(f)
+        if res is None:
+            return None
+        sph, fmt = res
+        cnt = sph._dims[0] * sph._dims[1] * sph._dims[2] * sph._veclen
+        buf = SPH_binary.readExact(f, cnt * fmt.itemsize)
+        if buf is None:
+            return None
+        if not SPH_binary.setData(sph, buf, fmt):
+            return None
+        return sph
+
+    @staticmethod
+    def readHeader(f) -> (SPH.SPH, np.dtype):
+        ''' readHeader
+        ストリームからmagic、ヘッダー長、ヘッダーを読み込み、データ部を持たない
+        SPHデータを生成する(static method)
+
+        Parameters
+        ----------
+        f: typing.IO
+          readintoをサポートするストリーム
+
+        Returns
+        -------
+        (SPH.SPH, numpy.dtype): データ部を持たないSPHデータとデータ部のdtype、
+          None: 失敗
+        '''
+        head = SPH_binary.readExact(f, 8)
+        if head is None or bytes(head[0:4]) != SPH_binary.MAGIC:
+            return None
+        hlen = struct.unpack('<I', head[4:8])[0]
+        hb = SPH_binary.readExact(f, hlen)
+        if hb is None:
+            return None
+        return SPH_binary.parseHeader(hb)
+
+    @staticmethod
+    def readFrames(f, sph: SPH.SPH, fmt: np.dtype, codec: str =None):
+        ''' readFrames
+        ストリームからフレームを順に読み込み、SPHデータのデータ部に格納する
+        (static method)
+        データ部(ネイティブバイトオーダー)は最初に確保され、各スラブは直接
+        その位置に読み込まれます。1フレーム読み込む毎に、それまでに受信した
+        Z方向の面数を返すジェネレーターです。
+        codecが指定された場合、圧縮されたスラブは受信しながら
+        READ_BYTES毎に逐次展開されます(readSlabを参照)。
+
+        Parameters
+        ----------
+        f: typing.IO
+          readintoをサポートするストリーム
+        sph: SPH.SPH
+          readHeaderで生成したSPHデータ
+        fmt: numpy.dtype
+          データ部のdtype
+        codec: str
+          スラブの圧縮方式('zlib', 'lzma')、None: 圧縮なし
+
+        Returns
+        -------
+        generator: 受信済みのZ方向の面数
+          途中でストリームが終了した場合、フレームが不正な場合はIOErrorを送出します。
+        '''
+        nz = sph._dims[2]
+        plane = sph._dims[0] * sph._dims[1] * sph._veclen
+        sph._data = np.empty(plane * nz, dtype=fmt.newbyteorder('='))
+        dst = memoryview(sph._data.view(np.uint8))
+        pb = plane * fmt.itemsize
+        kend = 0
+        while True:
+            fh = SPH_binary.readExact(f, SPH_binary.FRAME.size)
+            if fh is None:
+                raise IOError('stream ended at plane {}'.format(kend))
+            k0, nk, nbytes = SPH_binary.FRAME.unpack(fh)
+            if nk == 0:
+                break
+            if k0 != kend or k0 + nk > nz or \
+               (codec is None and nbytes != nk * pb):
+                raise IOError('invalid frame: k0={}, nk={}, nbytes={}'\
+                              .format(k0, nk, nbytes))
+            if codec is not None:
+                buf = SPH_binary.readSlab(f, nbytes, nk * pb, codec)
+                if buf is not None:
+                    if fmt.isnative:
+                        SPH_binary.unshuffle(buf, fmt.itemsize,
+                                             dst[k0*pb:(k0+nk)*pb])
+                    else:
+                        sph._data[k0*plane:(k0+nk)*plane] = np.frombuffer(
+                            SPH_binary.unshuffle(buf, fmt.itemsize),
+                            dtype=fmt)
+            elif fmt.isnative:
+                buf = SPH_binary.readExact(f, nbytes, dst[k0*pb:(k0+nk)*pb])
+            else:
+                buf = SPH_binary.readExact(f, nbytes)
+                if buf is not None:
+                    sph._data[k0*plane:(k0+nk)*plane] \
+                        = np.frombuffer(buf, dtype=fmt)
+            if buf is None:
+                raise IOError('stream ended at plane {}'.format(kend))
+            kend = k0 + nk
+            yield kend
+            continue # end of while
+        if kend != nz:
+            raise IOError('stream ended at plane {}'.format(kend))
+        return
+
+    @staticmethod
+    def readSlab(f, nbytes: int, size: int, codec: str) -> np.ndarray:
+        ''' readSlab
+        ストリームから圧縮されたスラブのデータ(nbytesバイト)を、READ_BYTES毎に
+        読み込みながら逐次展開する(static method)
+
+        Parameters
+        ----------
+        f: typing.IO
+          readをサポートするストリーム
+        nbytes: int
+          圧縮されたデータのバイト数
+        size: int
+          展開後のバイト数
+        codec: str
+          圧縮方式('zlib', 'lzma')
+
+        Returns
+        -------
+        numpy.ndarray: 展開したデータ(shuffleされたバイト列)、
+          None: 途中でストリームが終了した
+          展開後のサイズが一致しない場合はIOErrorを送出します。
+        '''
+        dec = SPH_binary.decompressor(codec)
+        out = np.empty(size, dtype=np.uint8)
+        pos = 0
+        left = nbytes
+        try:
+            while left > 0:
+                piece = f.read(min(left, SPH_binary.READ_BYTES))
+                if not piece:
+                    return None
+                left -= len(piece)
+                res = dec.decompress(piece)
+                if pos + len(res) > size:
+                    raise IOError('decompressed slab exceeds {}'.format(size))
+                out[pos:pos+len(res)] = np.frombuffer(res, dtype=np.uint8)
+                pos += len(res)
+                continue # end of while
+        except (zlib.error, lzma.LZMAError) as e:
+            raise IOError('decompress failed: {}'.format(str(e)))
+        if pos != size or not dec.eof:
+            raise IOError('decompressed slab size {} != {}'.format(pos, size))
+        return out
+
+    @staticmethod
+    def readStream(f, codec: str =None) -> SPH.SPH:
+        ''' readStream
+        ストリーム形式のデータを全て読み込み、SPHデータを復元する(static method)
+
+        Parameters
+        ----------
+        f: typing.IO
+          readintoをサポートするストリーム
+        codec: str
+          スラブの圧縮方式('zlib', 'lzma')、None: 圧縮なし
+
+        Returns
+        -------
+        SPH.SPH: 復元されたSPHデータ、None: 失敗
+        '''
+        res = SPH_binary.readHeader(f)
+        if res is None:
+            return None
+        sph, fmt = res
+        try:
+            for _ in SPH_binary.readFrames(f, sph, fmt, codec):
+                pass
+        except IOError:
+            return None
+        return sph
+
+    @staticmethod
+    def readExact(f, size: int, buf: memoryview =None) -> bytearray:
+        ''' readExact
+        ストリームからsizeバイトを読み込む(static method)
+
+        Parameters
+        ----------
+        f: typing.IO
+          readintoをサポートするストリーム
+        size: int
+          読み込むバイト数
+        buf: memoryview
+          読み込み先(省略時は新たにbytearrayを確保)
+
+        Returns
+        -------
+        bytearray|memoryview: 読み込んだデータ、None: 途中でストリームが終了した
+        '''
+        if buf is None:
+            buf = bytearray(size)
+        mv = memoryview(buf)
+        pos = 0
+        while pos < size:
+            n = f.readinto(mv[pos:size])
+            if not n:
+                return None
+            pos += n
+            continue # end of while
+        return buf
@@ -15,7 +15,73 @@ import _pickle as pickle
 class SPH_filter:
 
     @staticmethod
-    def extractScalar(d: SPH.SPH, dataIdx: int) -> SPH.SPH:
+    def vecArray(d: SPH.SPH) -> np.ndarray:
+        ''' vecArray
+        SPHデータの_dataを、最後の軸がベクトル成分となる配列として参照する(static method)
+        _dataが1次元の場合は(N, veclen)、divideShareEdge(view=True)による
+        ビューの場合は(z, y, x, veclen)の形状になります(いずれもコピーしません)。
+
+        Parameters
+        ----------
+        d: SPH.SPH
+          SPHデータ
+
+        Returns
+        -------
+        numpy.ndarray: 最後の軸がベクトル成分の配列
+        '''
+        arr = d._data
+        if arr.ndim == 1:
+            return arr.reshape((-1, d._veclen))
+        if d._veclen == 1 and arr.shape[-1] != 1:
+            return arr[..., np.newaxis]
+        return arr
+
+    @staticmethod
+    def scalarOut(d: SPH.SPH, out: np.ndarray =None) -> SPH.SPH:
+        ''' scalarOut
+        dと同じ格子を持つ、スカラーのSPHデータを生成する(static method)
+        データ部はoutを使用します(省略時は新たに確保します)。
+        min/maxは参照時に計算されます。
+
+        Parameters
+        ----------
+        d: SPH.SPH
+          元のSPHデータ
+        out: numpy.ndarray
+          データ部として使用する、格子点数の要素を持つ連続配列
+
+        Returns
+        -------
+        SPH.SPH: スカラーのSPHデータ、None: 失敗
+        '''
+        dimSz = d._dims[0] * d._dims[1] * d._dims[2]
+        if dimSz < 1:
+            return None
+        ftype = np.float64 if d._dtype == SPH.SPH.DT_DOUBLE else np.float32
+        if out is None:
+            out = np.empty(dimSz, dtype=ftype)
+        elif out.size != dimSz or out.dtype != ftype or \
+             not out.flags['C_CONTIGUOUS']:
+            return None
+
+        sph = SPH.SPH()
+        sph._dims[:] = d._dims[:]
+        sph._org[:] = d._org[:]
+        sph._pitch[:] = d._pitch[:]
+        sph._veclen = 1
+        sph._step = d._step
+        sph._time = d._time
+        sph._dtype = SPH.SPH.DT_DOUBLE if d._dtype == SPH.SPH.DT_DOUBLE \
+                     else SPH.SPH.DT_SINGLE
+        sph._data = out.reshape((-1))
+        sph._min = None
+        sph._max = None
+        return sph
+
+    @staticmethod
+    def extractScalar(d: SPH.SPH, dataIdx: int,
+                      out: np.ndarray =None) -> SPH.SPH:
         ''' extractScalar
         ベクトルデータを持つSPHからスカラーのSPHを生成する(static method)
 
@@ -25,6 +91,8 @@ class SPH_filter:
           vectorデータを持つSPHデータ
         dataIdx: int
           抽出するスカラーデータのインデックス番号
+        out: numpy.ndarray
+          結果を格納する配列(省略時は新たに確保、繰り返し呼び出す際の再利用向け)
 
         Returns
         -------
@@ -35,37 +103,16 @@ class SPH_filter:
         if dataIdx < 0 or dataIdx >= d._veclen:
             return None
 
-        sph = SPH.SPH()
-        sph._dims[:] = d._dims[:]
-        sph._org[:] = d._org[:]
-        sph._pitch[:] = d._pitch[:]
-        sph._veclen = 1
-        sph._step = d._step
-        sph._time = d._time
-        if d._dtype == SPH.SPH.DT_DOUBLE:
-            sph._dtype = SPH.SPH.DT_DOUBLE
-            sph._data = np.array(0, dtype=np.float64)
-        else:
-            sph._dtype = SPH.SPH.DT_SINGLE
-            sph._data = np.array(0, dtype=np.float32)
-        dimSz = sph._dims[0] * sph._dims[1] * sph._dims[2]
-        if dimSz < 1:
+        sph = SPH_filter.scalarOut(d, out)
+        if sph is None:
             return None
-        sph._data.resize(dimSz)
-
-        val = d._data[dataIdx]
-        sph._min = [val]
-        sph._max = [val]
-        for i in range(dimSz):
-            val  = d._data[i*self._datalen + dataIdx]
-            sph._data[i] = val
-            if val < sph._min[0]: sph._min[0] = val
-            if val > sph._max[0]: sph._max[0] = val
-            continue # end of for(i)
+        arr = SPH_filter.vecArray(d)
+        np.copyto(sph._data.reshape(arr.shape[:-1]), arr[..., dataIdx],
+                  casting='same_kind')
         return sph
 
     @staticmethod
-    def vectorMag(d: SPH.SPH) -> SPH.SPH:
+    def vectorMag(d: SPH.SPH, out: np.ndarray =None) -> SPH.SPH:
         ''' vectorMag
         ベクトルデータを持つSPHからベクトルのノルムをスカラーとして持つSPHを生成する(static method)
 
@@ -73,6 +120,8 @@ class SPH_filter:
         ----------
         d: SPH.SPH
           vectorデータを持つSPHデータ
+        out: numpy.ndarray
+          結果を格納する配列(省略時は新たに確保、繰り返し呼び出す際の再利用向け)
 
         Returns
         -------
@@ -81,42 +130,21 @@ class SPH_filter:
         if d._veclen < 1:
             return None
 
-        sph = SPH.SPH()
-        sph._dims[:] = d._dims[:]
-        sph._org[:] = d._org[:]
-        sph._pitch[:] = d._pitch[:]
-        sph._veclen = 1
-        sph._step = d._step
-        sph._time = d._time
-        if d._dtype == SPH.SPH.DT_DOUBLE:
-            sph._dtype = SPH.SPH.DT_DOUBLE
-            sph._data = np.array(0, dtype=np.float64)
-        else:
-            sph._dtype = SPH.SPH.DT_SINGLE
-            sph._data = np.array(0, dtype=np.float32)
-        dimSz = sph._dims[0] * sph._dims[1] * sph._dims[2]
-        if dimSz < 1:
+        sph = SPH_filter.scalarOut(d, out)
+        if sph is None:
             return None
-        sph._data.resize(dimSz)
-
-        vl = np.linalg.norm(d._data[0:d._veclen], ord=2)
-        sph._min = [vl]
-        sph._max = [vl]
-        for i in range(dimSz):
-            idx = i * d._veclen
-            vl = np.linalg.norm(d._data[idx:idx+d._veclen], ord=2)
-            sph._data[i] = vl
-            if vl < sph._min[0]: sph._min[0] = vl
-            if vl > sph._max[0]: sph._max[0] = vl
-            continue # end of for(i)
+        arr = SPH_filter.vecArray(d)
+        res = sph._data.reshape(arr.shape[:-1])
+        np.einsum('...i,...i->...', arr, arr, out=res, dtype=res.dtype,
+                  casting='same_kind')
+        np.sqrt(res, out=res)
         return sph
 
     @staticmethod
-    def divideShareEdge(d: SPH.SPH, div: []) -> []:
-        ''' divideShareEdge
-        SPHデータについて、隣接格子点を共有した分割を行う(static method)
-        格子サイズが5の次元を2分割する場合、分割されたデータの格子サイズは(3, 3)になる.
-        分割されたデータの格子サイズは1以上でならなければならない.
+    def blockRanges(d: SPH.SPH, div: []) -> []:
+        ''' blockRanges
+        divideShareEdgeによる各分割データの範囲を求める(static method)
+        分割データはX軸方向が最も速く変化する順(i, j, kの順)に並びます。
 
         Parameters
         ----------
@@ -127,19 +155,18 @@ class SPH_filter:
 
         Returns
         -------
-        SPH.SPH[]: 分割されたSPHデータのリスト、空のリスト=失敗
+        [(float[3], int[3], int[3])]: 分割データの(原点座標, 原点の格子インデックス,
+          格子サイズ)のリスト、空のリスト=失敗
         '''
-        sb_lst = []
-        if d._veclen < 1:
-            return sb_lst
+        rng_lst = []
         if div[0] < 1 or div[1] < 1 or div[2] < 1:
-            return sb_lst
+            return rng_lst
         sbDim = [int(d._dims[i] / div[i]) + (1 if div[i] != 1 else 0) for i in range(3)]
         if sbDim[0] < 1 or sbDim[1] < 1 or sbDim[2] < 1:
-            return sb_lst
+            return rng_lst
         sbDimE = [d._dims[i] - (sbDim[i] -1) * (div[i] - 1) for i in range(3)]
         if sbDimE[0] < 1 or sbDimE[1] < 1 or sbDimE[2] < 1:
-            return sb_lst
+            return rng_lst
 
         newOrg = list(d._org)
         newOrgIdx = [0, 0, 0]
@@ -156,39 +183,7 @@ class SPH_filter:
 
                 for i in range(div[0]):
                     newDims[0] = sbDimE[0] if i == div[0] -1 else sbDim[0]
-
-                    sph = SPH.SPH()
-                    sph._dims[:] = newDims[:]
-                    sph._org[:] = newOrg[:]
-                    sph._pitch[:] = d._pitch[:]
-                    sph._veclen = d._veclen
-                    sph._step = d._step
-                    sph._time = d._time
-                    sph._dtype = d._dtype
-                    sph._min = list(d._min)
-                    sph._max = list(d._max)
-                    if d._dtype == SPH.SPH.DT_DOUBLE:
-                        sph._data = np.array(0, dtype=np.float64)
-                    else:
-                        sph._data = np.array(0, dtype=np.float32)
-                    dimSz = sph._dims[0] * sph._dims[1] * sph._dims[2] * d._veclen
-                    sph._data.resize(dimSz)
-
-                    for kk in range(newDims[2]):
-                        for jj in range(newDims[1]):
-                            sst_idx = d._dims[0]*d._dims[1]*(kk+newOrgIdx[2]) \
-                                + d._dims[0]*(jj+newOrgIdx[1]) + newOrgIdx[0]
-                            sst_idx = sst_idx * d._veclen
-                            sed_idx = sst_idx + newDims[0] * d._veclen
-                            
-                            dst_idx = sph._dims[0]*sph._dims[1]*kk + sph._dims[0]*jj
-                            dst_idx = dst_idx * d._veclen
-                            ded_idx = dst_idx + newDims[0] * d._veclen
-
-                            sph._data[dst_idx:ded_idx] = d._data[sst_idx:sed_idx]
-                            continue # jj
-                        continue # kk
-                    sb_lst.append(sph)
+                    rng_lst.append((list(newOrg), list(newOrgIdx), list(newDims)))
 
                     newOrg[0] += d._pitch[0] * (newDims[0] - 1)
                     newOrgIdx[0] += (newDims[0] - 1)
@@ -202,8 +197,219 @@ class SPH_filter:
             newOrgIdx[2] += (newDims[2] - 1)
             continue # k
 
+        return rng_lst
+
+    @staticmethod
+    def divideShareEdge(d: SPH.SPH, div: [], view: bool =False) -> []:
+        ''' divideShareEdge
+        SPHデータについて、隣接格子点を共有した分割を行う(static method)
+        格子サイズが5の次元を2分割する場合、分割されたデータの格子サイズは(3, 3)になる.
+        分割されたデータの格子サイズは1以上でならなければならない.
+        view=Trueの場合、分割されたデータの_dataは元データの_dataを参照する
+        (コピーしない)形状(z, y, x)または(z, y, x, veclen)のビューになる.
+        view=Falseの場合は、1次元の連続配列にコピーされる.
+
+        Parameters
+        ----------
+        d: SPH.SPH
+          分割するSPHデータ
+        div: int[3]
+          各軸方向の分割数(>0)
+        view: bool
+          True=元データのビューを参照する、False=コピーする
+
+        Returns
+        -------
+        SPH.SPH[]: 分割されたSPHデータのリスト、空のリスト=失敗
+        '''
+        sb_lst = []
+        if d._veclen < 1:
+            return sb_lst
+        rng_lst = SPH_filter.blockRanges(d, div)
+        if not rng_lst:
+            return sb_lst
+        vol = d._data.reshape((d._dims[2], d._dims[1], d._dims[0], d._veclen))
+        if d._veclen == 1:
+            vol = vol[..., 0]
+
+        for org, orgIdx, dims in rng_lst:
+            sph = SPH.SPH()
+            sph._dims[:] = dims[:]
+            sph._org[:] = org[:]
+            sph._pitch[:] = d._pitch[:]
+            sph._veclen = d._veclen
+            sph._step = d._step
+            sph._time = d._time
+            sph._dtype = d._dtype
+            sph._min = list(d._vmin) if d._vmin is not None else None
+            sph._max = list(d._vmax) if d._vmax is not None else None
+            sub = vol[orgIdx[2]:orgIdx[2]+dims[2],
+                      orgIdx[1]:orgIdx[1]+dims[1],
+                      orgIdx[0]:orgIdx[0]+dims[0]]
+            if view:
+                sph._data = sub
+            else:
+                sph._data = sub.copy().reshape((-1))
+            sb_lst.append(sph)
+            continue # end of for(org, orgIdx, dims)
+
         return sb_lst
     
+    @staticmethod
+    def subset(d: SPH.SPH, roi: [] =None, stride: [] =None,
+               comp: int =None) -> SPH.SPH:
+        ''' subset
+        SPHデータから、インデックス空間の範囲(ROI)、各軸方向の間引き間隔、
+        ベクトル成分を指定して部分データを切り出す(static method)
+        _org/_pitch/_dimsは切り出した範囲に合わせて設定され、min/maxは参照時に
+        計算されます。
+
+        Parameters
+        ----------
+        d: SPH.SPH
+          切り出すSPHデータ
+        roi: int[6]
+          範囲(i0, i1, j0, j1, k0, k1)、両端を含む(省略時は全体)
+        stride: int[3]
+          各軸方向の間引き間隔(>0、省略時は1)
+        comp: int
+          切り出すベクトル成分のインデックス番号(省略時は全成分)
+
+        Returns
+        -------
+        SPH.SPH: 切り出したSPHデータ、None: 失敗(範囲外の指定など)
+        '''
+        if roi is None:
+            roi = [0, d._dims[0]-1, 0, d._dims[1]-1, 0, d._dims[2]-1]
+        if stride is None:
+            stride = [1, 1, 1]
+        if len(roi) != 6 or len(stride) != 3:
+            return None
+        for i in range(3):
+            if roi[i*2] < 0 or roi[i*2+1] >= d._dims[i] or \
+               roi[i*2] > roi[i*2+1] or stride[i] < 1:
+                return None
+        if comp is not None and (comp < 0 or comp >= d._veclen):
+            return None
+
+        arr = SPH_filter.vecArray(d).reshape(
+            (d._dims[2], d._dims[1], d._dims[0], d._veclen))
+        sub = arr[roi[4]:roi[5]+1:stride[2],
+                  roi[2]:roi[3]+1:stride[1],
+                  roi[0]:roi[1]+1:stride[0]]
+        if comp is not None:
+            sub = sub[..., comp:comp+1]
+
+        sph = SPH.SPH()
+        sph._dims[:] = [sub.shape[2], sub.shape[1], sub.shape[0]]
+        sph._org[:] = [d._org[i] + d._pitch[i] * roi[i*2] for i in range(3)]
+        sph._pitch[:] = [d._pitch[i] * stride[i] for i in range(3)]
+        sph._veclen = sub.shape[3]
+        sph._step = d._step
+        sph._time = d._time
+        sph._dtype = d._dtype
+        sph._data = np.ascontiguousarray(sub).reshape((-1))
+        sph._min = None
+        sph._max = None
+        return sph
+
+    @staticmethod
+    def decimateGrid(d: SPH.SPH, factor: int =2) -> ([int], [float], [float]):
+        ''' decimateGrid
+        SPHデータをdecimateで間引いた場合の格子点数、原点、格子間隔を求める
+        (static method)
+        新しい格子点は、最初の窓の中心から最後の窓(端の残りの点の窓)の中心までに
+        等間隔に置かれます。
+
+        Parameters
+        ----------
+        d: SPH.SPH
+          間引くSPHデータ(データ部は参照しない)
+        factor: int
+          間引き率(>0)
+
+        Returns
+        -------
+        ([int], [float], [float]): 格子点数、原点、格子間隔
+        '''
+        dims, org, pitch = [], [], []
+        for i in range(3):
+            n = d._dims[i]
+            m = (n + factor - 1) // factor
+            # centers of the first and the last (possibly partial) windows
+            c0 = (min(factor, n) - 1) * 0.5
+            c1 = (factor * (m - 1) + n - 1) * 0.5
+            dims.append(m)
+            org.append(d._org[i] + d._pitch[i] * c0)
+            if m > 1:
+                pitch.append(d._pitch[i] * (c1 - c0) / (m - 1))
+            else:
+                pitch.append(d._pitch[i] * factor)
+            continue # end of for(i)
+        return (dims, org, pitch)
+
+    @staticmethod
+    def decimate(d: SPH.SPH, factor: int =2, mode: str ='mean') -> SPH.SPH:
+        ''' decimate
+        SPHデータの各軸方向の格子点数を1/factorに間引いた、低解像度のSPHデータを
+        生成する(static method)
+        各軸方向にfactor点ずつの窓(端では残りの点)の値を、modeに従い平均('mean')、
+        最小値('min')、最大値('max')のいずれかで1点にまとめます。
+        'min'/'max'は、元データの値の範囲を保存する間引きになります。
+        新しい格子点は、最初の窓の中心から最後の窓(端の残りの点の窓)の中心までに
+        等間隔に置かれるため(decimateGrid)、間引いたデータは元データの範囲内に
+        収まります。格子点数がfactorで割り切れる軸では、各格子点は窓の中心に
+        置かれ、_pitchはfactor倍になります。
+
+        Parameters
+        ----------
+        d: SPH.SPH
+          間引くSPHデータ
+        factor: int
+          間引き率(>0)
+        mode: str
+          'mean', 'min', 'max'のいずれか
+
+        Returns
+        -------
+        SPH.SPH: 間引いたSPHデータ、None: 失敗
+        '''
+        ufuncs = {'mean': np.add, 'min': np.minimum, 'max': np.maximum}
+        if factor < 1 or mode not in ufuncs:
+            return None
+        if d._dims[0] * d._dims[1] * d._dims[2] < 1:
+            return None
+        ftype = np.float64 if d._dtype == SPH.SPH.DT_DOUBLE else np.float32
+
+        res = SPH_filter.vecArray(d).reshape(
+            (d._dims[2], d._dims[1], d._dims[0], d._veclen))
+        cnt = 1.0
+        for ax in range(3):
+            n = res.shape[ax]
+            idx = np.arange(0, n, factor)
+            if mode == 'mean':
+                res = np.add.reduceat(res, idx, axis=ax, dtype=np.float64)
+                shp = [1, 1, 1, 1]
+                shp[ax] = idx.size
+                cnt = cnt * np.diff(np.append(idx, n)).reshape(shp)
+            else:
+                res = ufuncs[mode].reduceat(res, idx, axis=ax)
+            continue # end of for(ax)
+        if mode == 'mean':
+            res = res / cnt
+
+        sph = SPH.SPH()
+        sph._dims[:], sph._org[:], sph._pitch[:] \
+            = SPH_filter.decimateGrid(d, factor)
+        sph._veclen = d._veclen
+        sph._step = d._step
+        sph._time = d._time
+        sph._dtype = d._dtype
+        sph._data = np.ascontiguousarray(res, dtype=ftype).reshape((-1))
+        sph._min = None
+        sph._max = None
+        return sph
+
     @staticmethod
     def toJSON(d: SPH.SPH) -> str:
         ''' toJSON
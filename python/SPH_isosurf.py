@@ -11,11 +11,121 @@ from skimage import measure
 
 
 class SPH_isosurf:
+    ''' SPH_isosurf
+    スカラーのSPHデータに対して等値面を生成するクラスです。
+    ブリックインデックス(brickIndex)は、格子を各軸方向にBRICKセルずつの
+    ブリックに分け、各ブリックの値の最小値・最大値を保持したものです。
+    隣接するブリックは境界の格子点を共有するため、等値面を含むセルは必ず
+    いずれかのブリックの[min, max]に含まれます。
+    インデックスを指定した等値面生成では、[min, max]が閾値を含むブリック
+    (アクティブなブリック)についてのみmarching cubesを実行します。
+    '''
+    BRICK = 16
+    DENSE_RATIO = 0.5
 
     @staticmethod
-    def generate(d: SPH.SPH, value: float) -> ([float], [int], [float]):
+    def brickIndex(d: SPH.SPH, brick: int =BRICK) -> (int, np.ndarray,
+                                                        np.ndarray):
+        ''' brickIndex
+        スカラーのSPHデータのブリックインデックスを生成する(static method)
+        ブリック(kb, jb, ib)は、格子点[ib*brick, min((ib+1)*brick, nx-1)]
+        (y, zも同様)の範囲を持ちます。NaNは無視されます。
+
+        Parameters
+        ----------
+        d: SPH.SPH
+          スカラーSPHデータ
+        brick: int
+          1ブリックの各軸方向のセル数(省略時はBRICK)
+
+        Returns
+        -------
+        (int, numpy.ndarray, numpy.ndarray): ブリックのセル数、
+          ブリック毎の最小値、最大値(shapeはブリック数の(z, y, x))、
+          None: 失敗(ベクトルデータ、いずれかの軸の格子点数が2未満)
+        '''
+        if d._veclen != 1 or brick < 1 or min(d._dims) < 2:
+            return None
+        vol = d._data.reshape([d._dims[2], d._dims[1], d._dims[0]])
+        res = []
+        for ufunc in (np.fmin, np.fmax):
+            arr = vol
+            for ax in range(3):
+                n = arr.shape[ax]
+                nb = (n - 2) // brick + 1
+                q = min(nb, n // brick)
+                # brick個ずつの格子点をまとめる(端の残りは別に)
+                pre = (slice(None),) * ax
+                red = []
+                if q > 0:
+                    head = arr[pre + (slice(0, q * brick),)]
+                    shp = arr.shape[:ax] + (q, brick) + arr.shape[ax+1:]
+                    red.append(ufunc.reduce(head.reshape(shp), axis=ax+1))
+                if q < nb:
+                    tail = arr[pre + (slice(q * brick, n),)]
+                    red.append(ufunc.reduce(tail, axis=ax, keepdims=True))
+                red = np.concatenate(red, axis=ax) if len(red) > 1 else red[0]
+                # 次のブリックとの境界の面を含める
+                bnd = np.minimum(np.arange(1, nb + 1) * brick, n - 1)
+                arr = ufunc(red, np.take(arr, bnd, axis=ax))
+                continue # end of for(ax)
+            res.append(arr)
+            continue # end of for(ufunc)
+        return (brick, res[0], res[1])
+
+    @staticmethod
+    def indexRange(index: (int, np.ndarray, np.ndarray)) -> (float, float):
+        ''' indexRange
+        ブリックインデックスから、データ全体の値の範囲を求める(static method)
+
+        Parameters
+        ----------
+        index: (int, numpy.ndarray, numpy.ndarray)
+          brickIndexで生成したブリックインデックス
+
+        Returns
+        -------
+        (float, float): 最小値、最大値(全てNaNの場合はNaN)
+        '''
+        _, bmin, bmax = index
+        if np.all(np.isnan(bmin)):
+            return (np.nan, np.nan)
+        return (float(np.nanmin(bmin)), float(np.nanmax(bmax)))
+
+    @staticmethod
+    def activeBricks(index: (int, np.ndarray, np.ndarray),
+                     value: float) -> np.ndarray:
+        ''' activeBricks
+        [min, max]がvalueを含むブリックを求める(static method)
+
+        Parameters
+        ----------
+        index: (int, numpy.ndarray, numpy.ndarray)
+          brickIndexで生成したブリックインデックス
+        value: float
+          等値面の閾値
+
+        Returns
+        -------
+        numpy.ndarray: アクティブなブリックの(kb, jb, ib)のリスト
+        '''
+        _, bmin, bmax = index
+        return np.argwhere((bmin <= value) & (value <= bmax))
+
+    @staticmethod
+    def generate(d: SPH.SPH, value: float,
+                 index: (int, np.ndarray, np.ndarray) =None) \
+                 -> ([float], [int], [float]):
         ''' generate
         スカラーのSPHデータに対して等値面を生成する(static method)
+        indexが指定された場合は、アクティブなブリック毎にmarching cubesを実行し、
+        結果を連結します。各ブリックは周囲に1格子点広げた範囲で実行し、
+        ブリック内のセルの三角形のみを残すため、ブリックの境界上の頂点の法線も
+        両側のセルから求まります。境界上で重複する頂点はweldVerticesで
+        まとめられ、結果はデータ全体に対して実行した場合と(頂点の順序を除き)
+        一致します。
+        アクティブなブリックの割合がDENSE_RATIOを超える場合は、データ全体に
+        対して1度だけ実行します。
 
         Parameters
         ----------
@@ -23,6 +133,8 @@ class SPH_isosurf:
           スカラーSPHデータ
         value: float
           等値面の閾値
+        index: (int, numpy.ndarray, numpy.ndarray)
+          brickIndexで生成したブリックインデックス(省略時は使用しない)
 
         Returns
         -------
@@ -36,16 +148,114 @@ class SPH_isosurf:
         
         vol = d._data.reshape([d._dims[2], d._dims[1], d._dims[0]])
         spc = (d._pitch[2], d._pitch[1], d._pitch[0])
-        vv, faces, nv, _ = measure.marching_cubes(vol, value, spacing=spc)
+        bricks = None
+        if index is not None:
+            bricks = SPH_isosurf.activeBricks(index, value)
+            if len(bricks) > index[1].size * SPH_isosurf.DENSE_RATIO:
+                bricks = None
+        if bricks is None:
+            vv, faces, nv, _ = measure.marching_cubes(vol, value, spacing=spc)
+        else:
+            bs = index[0]
+            shp = np.array(vol.shape)
+            vl, fl, nl = [], [], []
+            nvert = 0
+            for org in bricks * bs:
+                lo = np.maximum(org - 1, 0)
+                hi = np.minimum(org + bs + 2, shp)
+                sub = vol[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+                try:
+                    bv, bf, bn, _ = measure.marching_cubes(sub, value)
+                except RuntimeError: # value == min or max, but no surface
+                    continue
+                # keep the triangles of the cells in the brick
+                cell = np.floor(bv[bf].mean(axis=1)).astype(np.int64) + lo
+                end = np.minimum(org + bs, shp - 1)
+                bf = bf[np.all((cell >= org) & (cell < end), axis=1)]
+                if len(bf) < 1:
+                    continue
+                used = np.unique(bf)
+                remap = np.empty(len(bv), dtype=bf.dtype)
+                remap[used] = np.arange(len(used))
+                vl.append(bv[used] + lo)
+                fl.append(remap[bf] + nvert)
+                nl.append(bn[used])
+                nvert += len(used)
+                continue # end of for(org)
+            if nvert < 1:
+                return (np.empty((0, 3)), np.empty((0, 3), dtype=np.int32),
+                        np.empty((0, 3)))
+            vv, faces, nv = SPH_isosurf.weldVertices(
+                np.concatenate(vl), np.concatenate(fl), np.concatenate(nl))
+            vv = vv * spc
         verts = vv[:, [2,1,0]] + d._org
         normals = nv[:, [2,1,0]]
 
         return (verts, faces, normals)
 
+    @staticmethod
+    def weldVertices(gv: np.ndarray, faces: np.ndarray, normals: np.ndarray) \
+        -> (np.ndarray, np.ndarray, np.ndarray):
+        ''' weldVertices
+        格子のインデックス座標の頂点のうち、同じ格子の辺の上にあるもの
+        (ブリックの境界で重複した頂点)を1つにまとめる(static method)
+        marching cubesの頂点は格子の辺の上にあり、辺方向以外の座標は整数のため、
+        辺(始点の格子点と方向)で同一の頂点を判定します。
+
+        Parameters
+        ----------
+        gv: numpy.ndarray
+          頂点の(z, y, x)インデックス座標の配列
+        faces: numpy.ndarray
+          三角形の頂点番号の配列
+        normals: numpy.ndarray
+          頂点の法線ベクトルの配列
+
+        Returns
+        -------
+        (numpy.ndarray, numpy.ndarray, numpy.ndarray): まとめた頂点、三角形、法線
+        '''
+        base = np.floor(gv)
+        frac = gv != base
+        axis = np.where(frac.any(axis=1), np.argmax(frac, axis=1), 3)
+        key = np.column_stack([base.astype(np.int64), axis])
+        _, first, inv = np.unique(key, axis=0, return_index=True,
+                                  return_inverse=True)
+        inv = inv.reshape((-1)).astype(faces.dtype)
+        return (gv[first], inv[faces], normals[first])
+
+    OBJ_CHUNK = 65536
+
+    @staticmethod
+    def meshArrays(verts:[float], faces:[int], normals:[float]) \
+        -> (np.ndarray, np.ndarray, np.ndarray):
+        ''' meshArrays
+        等値面の頂点、三角形、法線のリストを(n, 3)のnumpy配列にする(static method)
+        numpy配列の場合はコピーしません。
+
+        Parameters
+        ----------
+        verts: float[]
+          等値面の頂点リスト
+        faces: int[]
+          等値面の三角形の頂点リスト
+        normals: float[]
+          等値面の頂点の法線ベクトルリスト
+
+        Returns
+        -------
+        (numpy.ndarray, numpy.ndarray, numpy.ndarray): 頂点、三角形、法線の配列
+        '''
+        return tuple([np.asarray(a).reshape((-1, 3))
+                      for a in (verts, faces, normals)])
+
     @staticmethod
     def saveOBJ(f: typing.IO, verts:[float], faces:[int], normals:[float]):
         ''' saveOBJ
         generateで生成された等値面をOBJファイルに出力する(static method)
+        OBJ_CHUNK行ずつまとめて文字列化し、1回のwriteで出力します。
+        数値の書式は'{}'.format(値)と同じです(float32の値はfloatとして
+        最短の表現で出力されます)。
 
         Parameters
         ----------
@@ -58,13 +268,123 @@ class SPH_isosurf:
         normals: float[]
           等値面の頂点の法線ベクトルリスト
         '''
+        verts, faces, normals = SPH_isosurf.meshArrays(verts, faces, normals)
         f.write('o SPH_isosurf\n')
-        for v in verts:
-            f.write('v {} {} {}\n'.format(*v))
-        for vn in normals:
-            f.write('vn {} {} {}\n'.format(*vn))
-        for tri in faces:
-            f.write('f {}//{} {}//{} {}//{}\n'.format(
-                tri[0]+1,tri[0]+1,tri[1]+1,tri[1]+1,tri[2]+1,tri[2]+1))
+        for fmt, arr, ofs in (('v {} {} {}\n', verts, 0),
+                              ('vn {} {} {}\n', normals, 0),
+                              ('f {0}//{0} {1}//{1} {2}//{2}\n', faces, 1)):
+            if arr.dtype.kind == 'f':
+                arr = arr.astype(np.float64, copy=False)
+            for i in range(0, len(arr), SPH_isosurf.OBJ_CHUNK):
+                blk = arr[i:i+SPH_isosurf.OBJ_CHUNK]
+                if ofs:
+                    blk = blk + ofs # faces only: adding 0 turns -0.0 into 0.0
+                cols = blk.T.tolist()
+                f.write(''.join(map(fmt.format, *cols)))
+                continue # end of for(i)
+            continue # end of for(fmt, arr, ofs)
         return
+
+    @staticmethod
+    def savePLY(f: typing.BinaryIO, verts:[float], faces:[int],
+                normals:[float]):
+        ''' savePLY
+        generateで生成された等値面をバイナリ形式(little endian)の
+        PLYファイルに出力する(static method)
+        頂点は座標と法線(float32)、面は頂点数(uchar)と頂点インデックス(int32)
+        を持ちます。
+
+        Parameters
+        ----------
+        f: typing.BinaryIO
+          PLYファイル(バイナリモード)
+        verts: float[]
+          等値面の頂点リスト
+        faces: int[]
+          等値面の三角形の頂点リスト
+        normals: float[]
+          等値面の頂点の法線ベクトルリスト
+        '''
+        verts, faces, normals = SPH_isosurf.meshArrays(verts, faces, normals)
+        vtx = np.empty(len(verts), dtype=[('p', '<f4', 3), ('n', '<f4', 3)])
+        vtx['p'] = verts
+        vtx['n'] = normals
+        tri = np.empty(len(faces), dtype=[('c', 'u1'), ('i', '<i4', 3)])
+        tri['c'] = 3
+        tri['i'] = faces
+        header = '\n'.join([
+            'ply', 'format binary_little_endian 1.0', 'comment SPH_isosurf',
+            'element vertex {}'.format(len(vtx)),
+            'property float x', 'property float y', 'property float z',
+            'property float nx', 'property float ny', 'property float nz',
+            'element face {}'.format(len(tri)),
+            'property list uchar int vertex_indices', 'end_header', ''])
+        f.write(header.encode('ascii'))
+        f.write(vtx.tobytes())
+        f.write(tri.tobytes())
+        return
+
+    @staticmethod
+    def saveNPZ(f: typing.BinaryIO, verts:[float], faces:[int],
+                normals:[float], compress:bool =False):
+        ''' saveNPZ
+        generateで生成された等値面を、'verts', 'faces', 'normals'の配列を持つ
+        numpyの.npzファイルに出力する(static method)
+        配列のdtypeはgenerateの出力のままです。
+
+        Parameters
+        ----------
+        f: typing.BinaryIO
+          .npzファイル(バイナリモード)またはパス
+        verts: float[]
+          等値面の頂点リスト
+        faces: int[]
+          等値面の三角形の頂点リスト
+        normals: float[]
+          等値面の頂点の法線ベクトルリスト
+        compress: bool
+          Trueの場合は圧縮する(省略時はFalse)
+        '''
+        verts, faces, normals = SPH_isosurf.meshArrays(verts, faces, normals)
+        save = np.savez_compressed if compress else np.savez
+        save(f, verts=verts, faces=faces, normals=normals)
+        return
+
+    @staticmethod
+    def saveMesh(path: str, verts:[float], faces:[int],
+                 normals:[float]) -> bool:
+        ''' saveMesh
+        generateで生成された等値面を、pathの拡張子('.obj', '.ply', '.npz')に
+        応じた形式で出力する(static method)
+
+        Parameters
+        ----------
+        path: str
+          出力ファイルのパス
+        verts: float[]
+          等値面の頂点リスト
+        faces: int[]
+          等値面の三角形の頂点リスト
+        normals: float[]
+          等値面の頂点の法線ベクトルリスト
+
+        Returns
+        -------
+        bool: True=成功、False=失敗(未対応の拡張子、出力エラー)
+        '''
+        ext = os.path.splitext(path)[1].lower()
+        writers = {'.obj': ('w', SPH_isosurf.saveOBJ),
+                   '.ply': ('wb', SPH_isosurf.savePLY),
+                   '.npz': ('wb', SPH_isosurf.saveNPZ)}
+        if ext not in writers:
+            print('SPH_isosurf.saveMesh: unsupported format: {}'.format(path))
+            return False
+        mode, writer = writers[ext]
+        try:
+            with open(path, mode) as f:
+                writer(f, verts, faces, normals)
+        except Exception as e:
+            print('SPH_isosurf.saveMesh: failed: {}'.format(str(e)))
+            return False
+        return True
     
@@ -7,6 +7,10 @@ __author__ = "Yoshikawa, Hiroyuki <yoh@fujitsu.com>"
 __version__ = "0.1.0"
 
 import sys, os
+import time
+import threading
+import socket
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from pySPH import SPH
 from TSDataSPH import TSDataSPH
@@ -25,9 +29,54 @@ class TB(object):
         self._tsdata = TSDataSPH()
         self._lastErr = None
         self._id = TB.__seq; TB.__seq += 1
+        self._codecs = None # None: all codecs of SPH_binary
+        self._codecLevel = None
+        self._encPool = None
         return
 
-    def loadFromJSON(self, json_path: str) -> bool:
+    def setupCompression(self, codecs: [] =None, level: int =None,
+                         nthreads: int =0) -> None:
+        ''' setupCompression
+        ストリーム形式の'/data'の転送圧縮の設定を行います。
+        圧縮はクライアントがAccept-Encodingで要求した場合のみ行われます。
+
+        Parameters
+        ----------
+        codecs: [str]
+          使用を許可するcodec(None: SPH_binary.CODECSの全て、[]: 圧縮しない)
+        level: int
+          圧縮レベル(None: codec毎の既定値)
+        nthreads: int
+          送信と並行してフレームを圧縮するスレッド数(0: 送信スレッドで圧縮)
+        '''
+        self._codecs = codecs
+        self._codecLevel = level
+        if self._encPool:
+            self._encPool.shutdown(wait=False)
+        self._encPool = ThreadPoolExecutor(max_workers=nthreads) \
+            if nthreads > 0 else None
+        return
+
+    def selectCodec(self, accept: str) -> str:
+        ''' selectCodec
+        Accept-Encodingヘッダーの値から、使用を許可されたcodecを選択します。
+
+        Parameters
+        ----------
+        accept: str
+          Accept-Encodingヘッダーの値
+
+        Returns
+        -------
+        str: codec、None: 圧縮しない
+        '''
+        codec = SPH_binary.selectCodec(accept)
+        if self._codecs is not None and codec not in self._codecs:
+            return None
+        return codec
+
+    def loadFromJSON(self, json_path: str, mmap: bool =False,
+                     nworkers: int =1) -> bool:
         ''' loadFromJSON
         JSONファイルから時系列SPHデータを読み込みます。
         JSONファイルは、以下の形式であることを想定しています。
@@ -45,6 +94,10 @@ class TB(object):
         ----------
         json_path: str
           JSONファイルのパス
+        mmap: bool
+          SPHファイルのデータ部をメモリマップするかどうか(省略時はFalse)
+        nworkers: int
+          SPHファイルの読み込みスレッド数(省略時は1)
         
         Returns
         -------
@@ -89,29 +142,32 @@ class TB(object):
             continue # end of for(o)
 
         # load SPH files
-        if not self._tsdata.setupFiles(file_lst, basedir):
+        if not self._tsdata.setupFiles(file_lst, basedir, mmap=mmap,
+                                       nworkers=nworkers):
             self._lastErr = 'load SPH file failed'
             return False
 
         # adjust step and time
-        for i in range(len(step_lst)):
-            if step_lst[i] != None:
-                self._tsdata._stepList[i] = step_lst[i]
-            if time_lst[i] != None:
-                self._tsdata._timeList[i] = time_lst[i]
-            continue # end of for(i)
-        for i in range(1,len(self._tsdata._stepList)):
-            if self._tsdata._stepList[i] <= self._tsdata._stepList[i-1]:
-                self._tsdata._stepList[i] = self._tsdata._stepList[i-1] + 1
-            if self._tsdata._timeList[i] <= self._tsdata._timeList[i-1]:
-                self._tsdata._timeList[i] = self._tsdata._timeList[i-1] + 1.0
-            self._tsdata._dataList[i]._step = self._tsdata._stepList[i]
-            self._tsdata._dataList[i]._time = self._tsdata._timeList[i]
-            continue # end of for(i)
+        with self._tsdata.lock:
+            for i in range(len(step_lst)):
+                if step_lst[i] != None:
+                    self._tsdata._stepList[i] = step_lst[i]
+                if time_lst[i] != None:
+                    self._tsdata._timeList[i] = time_lst[i]
+                continue # end of for(i)
+            for i in range(1,len(self._tsdata._stepList)):
+                if self._tsdata._stepList[i] <= self._tsdata._stepList[i-1]:
+                    self._tsdata._stepList[i] = self._tsdata._stepList[i-1] + 1
+                if self._tsdata._timeList[i] <= self._tsdata._timeList[i-1]:
+                    self._tsdata._timeList[i] = self._tsdata._timeList[i-1] + 1.0
+                self._tsdata._dataList[i]._step = self._tsdata._stepList[i]
+                self._tsdata._dataList[i]._time = self._tsdata._timeList[i]
+                continue # end of for(i)
 
         return True
 
-    def loadFromFilelist(self, fnlist: [], basedir: str ='.') -> bool:
+    def loadFromFilelist(self, fnlist: [], basedir: str ='.',
+                         mmap: bool =False, nworkers: int =1) -> bool:
         ''' loadFromFilelist
         SPHファイルのリストを時系列データとして読み込みます。
 
@@ -121,56 +177,139 @@ class TB(object):
           SPHファイルのパスのリスト
         basedir: str
           SPHファイルが存在するディレクトリ(省略時は'.')
+        mmap: bool
+          SPHファイルのデータ部をメモリマップするかどうか(省略時はFalse)
+        nworkers: int
+          SPHファイルの読み込みスレッド数(省略時は1)
 
         Returns
         -------
         bool: True=成功、False=失敗
         '''
         # load SPH files
-        if not self._tsdata.setupFiles(fnlist, basedir):
+        if not self._tsdata.setupFiles(fnlist, basedir, mmap=mmap,
+                                       nworkers=nworkers):
             self._lastErr = 'load SPH file failed'
             return False
         return True
 
+    def metaData(self, cwd: str =None) -> dict:
+        ''' metaData
+        保持している時系列データのメタデータを返します。
+
+        Parameters
+        ----------
+        cwd: str
+          URIから取り除くカレントディレクトリ(省略時は取り除かない)
+
+        Returns
+        -------
+        dict: メタデータ
+        '''
+        # mmapで確定していないmin/maxはバックグラウンドで計算され、
+        # 計算中のvrangeは反映済みのステップのみの値となる('vrange_pending')
+        mm, mmv, npend = self._tsdata.currentMinMax()
+        with self._tsdata.lock:
+            metad = {}
+            metad['id'] = self._id
+            first_path = self._tsdata._fileList[0]
+            if cwd and first_path.startswith(cwd):
+                first_path = first_path.replace(cwd, '')
+            metad['uri'] = 'file:/' + first_path
+            metad['type'] = 'SPH'
+            metad['dims'] = list(self._tsdata._dims)
+            metad['datalen'] = self._tsdata._datalen
+            metad['bbox'] = [list(self._tsdata._bbox[0]),
+                             list(self._tsdata._bbox[1])]
+            metad['steps'] = len(self._tsdata._stepList)
+            metad['fingerprints'] = list(self._tsdata.fingerprints)
+            metad['levels'] = self._tsdata.numLevels
+            metad['pyramid'] = self._tsdata.pyramidMode
+            metad['timerange'] = [self._tsdata._timeList[0],
+                                  self._tsdata._timeList[-1]]
+            if self._tsdata._datalen > 1:
+                metad['vrange'] = mmv
+            else:
+                metad['vrange'] = mm[0] if mm else None
+            metad['vrange_pending'] = npend
+        return metad
+
+    def metricFamilies(self) -> []:
+        ''' metricFamilies
+        保持している時系列データのメトリクス(保持しているステップ数、バイト数、
+        ピラミッドの段のヒット率等)を返します。
+
+        Returns
+        -------
+        [(str, str, str, [])]: HTTPMetrics.renderに渡すメトリクスのリスト
+        '''
+        stat = self._tsdata.residentStats()
+        nreq = stat['pyramid_hits'] + stat['pyramid_misses']
+        return [
+            ('resident_steps', 'gauge', 'time steps held in the buffer',
+             [('', None, stat['steps'])]),
+            ('resident_bytes', 'gauge',
+             'bytes of step data held in memory or memory-mapped',
+             [('', {'kind': 'memory'}, stat['bytes']),
+              ('', {'kind': 'mapped'}, stat['mapped_bytes'])]),
+            ('pyramid_bytes', 'gauge',
+             'bytes of pyramid levels held in memory or memory-mapped',
+             [('', {'kind': 'memory'}, stat['pyramid_bytes']),
+              ('', {'kind': 'mapped'}, stat['pyramid_mapped_bytes'])]),
+        ] + HTTPMetrics.cacheFamilies({'pyramid': {
+            'hits': stat['pyramid_hits'],
+            'misses': stat['pyramid_misses'],
+            'evictions': 0,
+            'hit_ratio': (stat['pyramid_hits'] / nreq) if nreq > 0 else 0.0,
+            'entries': stat['pyramid_entries'],
+            'bytes': stat['pyramid_bytes'] + stat['pyramid_mapped_bytes']}})
+
     
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from http.server import SimpleHTTPRequestHandler
 from urllib.parse import parse_qs, urlparse
 from SPH_filter import SPH_filter
+from SPH_binary import SPH_binary
+from utilHttp import PooledHTTPServer
+from utilMetrics import HTTPMetrics, MetricsHandlerMixin
 
 g_tb = None
 
-class TBReqHandler(SimpleHTTPRequestHandler):
+class TBReqHandler(MetricsHandlerMixin, SimpleHTTPRequestHandler):
     ''' TBReqHandler
     Temporal Buffer用のHTTPリクエストハンドラー実装クラスです。
-    '''    
+    PooledHTTPServerにより複数のリクエストが並行して処理されるため、
+    時系列データへのアクセスはTSDataのロックを介して行います。
+    リクエスト数、処理時間等はパス毎にサーバのHTTPMetricsに集計されます。
+    '''
+    METRICS_PATHS = ('/', '/data', '/metrics', '/quit')
+
     def do_GET(self):
         ''' do_GET
         GETメソッド用のリクエストハンドラー
         要求されたパスが'/'の場合はメタデータを返し、'/quit'の場合は終了します。
+        '/metrics'の場合は、リクエストと保持しているデータのメトリクスを
+        Prometheusのテキスト形式で返します。
         要求パスが'/data'の場合は、指定されたstepのデータを返します。
+        '/data'のクエリに'format=bin'が指定された場合は、JSONではなく
+        SPH_binary形式(application/octet-stream)でデータを返します。
+        'format=stream'が指定された場合は、SPH_binaryのストリーム形式で、
+        Z方向のスラブ毎のフレームをHTTP/1.1のchunked転送で返します。
+        1フレームの面数は'slab'で指定できます(省略時は約8MB毎)。
+        ストリーム形式でAccept-Encodingに'sph-shuffle-zlib'または
+        'sph-shuffle-lzma'が含まれる場合は、各スラブをbyte-shuffleして圧縮し、
+        Content-Encodingにそれを示して返します。
+        '/data'のクエリに'roi=i0,i1,j0,j1,k0,k1'(インデックス範囲、両端を含む)、
+        'stride=sx,sy,sz'(または全軸共通の'stride=s')、'comp=c'(ベクトル成分)が
+        指定された場合は、その部分データのみを返します。
+        'level=N'が指定された場合は、ピラミッドのN段目(各軸方向に1/2^Nに間引いた)
+        データを返します(部分データの指定はN段目の格子のインデックスになります)。
         '''
         _cwd = os.getcwd()
         parsed_path = urlparse(self.path)
         if parsed_path.path == '/':
             # メタデータ要求 --- メタデータを返す
-            metad = {}
-            metad['id'] = g_tb._id
-            first_path = g_tb._tsdata._fileList[0]
-            if first_path.startswith(_cwd):
-                first_path = first_path.replace(_cwd, '')
-            metad['uri'] = 'file:/' + first_path
-            metad['type'] = 'SPH'
-            metad['dims'] = g_tb._tsdata._dims
-            metad['datalen'] = g_tb._tsdata._datalen
-            metad['bbox'] = g_tb._tsdata._bbox
-            metad['steps'] = len(g_tb._tsdata._stepList)
-            metad['timerange'] = [g_tb._tsdata._timeList[0],
-                                  g_tb._tsdata._timeList[-1]]
-            if g_tb._tsdata._datalen > 1:
-                metad['vrange'] = g_tb._tsdata._minMaxVeclen
-            else:
-                metad['vrange'] = g_tb._tsdata._minMaxList[0]
-            
+            metad = g_tb.metaData(_cwd)
+
         elif parsed_path.path in ('/data', '/data/'):
             # データ要求 --- 指定されたstepのデータを返す
             qs = parse_qs(parsed_path.query)
@@ -186,7 +325,7 @@ class TBReqHandler(SimpleHTTPRequestHandler):
                 self.wfile.write(bytes(msg, 'utf-8'))
                 return
             if did != g_tb._id or \
-               step < 0 or step >= len(g_tb._tsdata._stepList):
+               step < 0 or step >= g_tb._tsdata.numSteps:
                 if did != g_tb._id:
                     msg = 'invalid id specified: {}.'.format(did)
                 else:
@@ -201,7 +340,20 @@ class TBReqHandler(SimpleHTTPRequestHandler):
             metad = {}
             metad['type'] = 'SPH'
             metad['step'] = step
-            sph = g_tb._tsdata.getDataIdx(step)
+            try:
+                level = int(qs.get('level', ['0'])[0])
+            except ValueError:
+                level = -1
+            if level < 0 or level >= g_tb._tsdata.numLevels:
+                msg = 'invalid level specified: {}.'.format(
+                    qs.get('level', [''])[0])
+                self.send_response(412)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-length', len(msg))
+                self.end_headers()
+                self.wfile.write(bytes(msg, 'utf-8'))
+                return
+            sph = g_tb._tsdata.getDataLevel(step, level)
             if sph == None:
                 msg = 'can not get data of step {}.'.format(step)
                 self.send_response(404)
@@ -210,17 +362,61 @@ class TBReqHandler(SimpleHTTPRequestHandler):
                 self.end_headers()
                 self.wfile.write(bytes(msg, 'utf-8'))
                 return
+            try:
+                roi, stride, comp = TBReqHandler.parseSubset(qs)
+                if roi or stride or comp is not None:
+                    sph = SPH_filter.subset(sph, roi, stride, comp)
+            except ValueError:
+                sph = None
+            if sph is None:
+                msg = 'invalid roi, stride or comp specified.'
+                self.send_response(412)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-length', len(msg))
+                self.end_headers()
+                self.wfile.write(bytes(msg, 'utf-8'))
+                return
+            if qs.get('format', [''])[0] == 'bin':
+                # バイナリ形式 --- ヘッダーに続けて_dataをそのまま送る
+                head = SPH_binary.header(sph)
+                body = SPH_binary.dataBuffer(sph)
+                self.send_response(200)
+                self.send_header('Content-Type', SPH_binary.CONTENT_TYPE)
+                self.send_header('Content-length', len(head) + len(body))
+                self.end_headers()
+                self.wfile.write(head)
+                self.wfile.write(body)
+                return
+            if qs.get('format', [''])[0] == 'stream':
+                # ストリーム形式 --- ヘッダーに続けてスラブ毎のフレームを送る
+                try:
+                    nk = int(qs['slab'][0])
+                except:
+                    nk = 0
+                if nk < 1:
+                    nk = SPH_binary.slabPlanes(sph)
+                self.sendStream(sph, nk, g_tb.selectCodec(
+                    self.headers.get('Accept-Encoding')))
+                return
+            if level > 0:
+                metad['level'] = level
             metad['data'] = SPH_filter.toJSON(sph)
 
+        elif parsed_path.path == '/metrics':
+            # メトリクス要求
+            self.sendMetrics('tb', g_tb.metricFamilies())
+            return
+
         elif parsed_path.path == '/quit':
             # 停止要求
-            msg = 'ok'.format(prog)
+            msg = 'ok'
             self.send_response(200)
             self.send_header('Content-Type', 'text/plain')
             self.send_header('Content-length', len(msg))
             self.end_headers()
             self.wfile.write(bytes(msg, 'utf-8'))
-            sys.exit(0)
+            self.server.shutdownLater()
+            return
 
         else:
             msg = 'invalid URL specified.'
@@ -242,14 +438,112 @@ class TBReqHandler(SimpleHTTPRequestHandler):
         return
     
 
-def load_monitor(prog:str ='TB'):
+    @staticmethod
+    def parseSubset(qs:dict) -> ([int], [int], int):
+        ''' parseSubset
+        '/data'のクエリから部分データの指定(roi, stride, comp)を取り出します(static method)
+
+        Parameters
+        ----------
+        qs: dict
+          parse_qsで解析したクエリ
+
+        Returns
+        -------
+        [int]: roi(i0, i1, j0, j1, k0, k1)、None: 指定なし
+        [int]: stride(sx, sy, sz)、None: 指定なし
+        int: comp、None: 指定なし
+          書式が不正な場合はValueErrorを送出します。
+        '''
+        roi = stride = comp = None
+        if 'roi' in qs:
+            roi = [int(x) for x in qs['roi'][0].split(',')]
+            if len(roi) != 6:
+                raise ValueError('roi')
+        if 'stride' in qs:
+            stride = [int(x) for x in qs['stride'][0].split(',')]
+            if len(stride) == 1:
+                stride = stride * 3
+            if len(stride) != 3:
+                raise ValueError('stride')
+        if 'comp' in qs:
+            comp = int(qs['comp'][0])
+        return (roi, stride, comp)
+
+    def sendChunk(self, *bufs):
+        ''' sendChunk
+        bufsを連結したデータを、chunked転送の1チャンクとして送信します。
+        空のデータの場合は終端チャンクになります。
+
+        Parameters
+        ----------
+        bufs: bytes-like
+          送信するデータ
+        '''
+        size = sum([len(b) for b in bufs])
+        self.wfile.write(b'%x\r\n' % size)
+        for b in bufs:
+            self.wfile.write(b)
+        self.wfile.write(b'\r\n')
+        return
+
+    def sendStream(self, sph, nk:int, codec:str =None):
+        ''' sendStream
+        SPHデータをSPH_binaryのストリーム形式で、1フレーム1チャンクの
+        chunked転送により返します(送信後は接続を閉じます)。
+        codecが指定された場合は各スラブを圧縮して送ります。TBの圧縮スレッドが
+        設定されている場合は、後続のフレームの圧縮と送信が並行して行われます。
+        クライアントが受信を中止した場合(TB2C_serverの先読みの中止等)は、
+        送信を打ち切ります。
+
+        Parameters
+        ----------
+        sph: SPH.SPH
+          送信するSPHデータ
+        nk: int
+          1フレームの面数
+        codec: str
+          スラブの圧縮方式('zlib', 'lzma')、None: 圧縮しない
+        '''
+        self.protocol_version = 'HTTP/1.1'
+        # フレーム毎の小さな書き込みがNagleアルゴリズムで遅延しないようにする
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_response(200)
+        self.send_header('Content-Type', SPH_binary.CONTENT_TYPE)
+        self.send_header('Transfer-Encoding', 'chunked')
+        if codec:
+            self.send_header('Content-Encoding',
+                             SPH_binary.ENCODING_PREFIX + codec)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            self.sendChunk(SPH_binary.header(sph))
+            for fh, body in SPH_binary.encodeFrames(
+                    sph, nk, codec, g_tb._codecLevel, g_tb._encPool):
+                self.sendChunk(fh, body)
+            self.sendChunk()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped receiving (e.g. a cancelled prefetch)
+            self.close_connection = True
+        return
+    
+
+def load_monitor(prog:str ='TB', loader:threading.Thread =None):
     global g_tb
     while True:
-        sys.stdout.write('{}: loading: {} steps done\r'\
-                         .format(prog, g_tb._tsdata.numSteps))
-        time.sleep(0.5)
-        if not g_tb._tsdata.is_working:
-            break
+        sys.stdout.write('{}: loading: {}/{} steps done\r'\
+                         .format(prog, g_tb._tsdata.numLoaded,
+                                 g_tb._tsdata.numFiles))
+        sys.stdout.flush()
+        if loader:
+            loader.join(0.5)
+            if not loader.is_alive():
+                break
+        else:
+            time.sleep(0.5)
+            if not g_tb._tsdata.is_working:
+                break
     if g_tb._tsdata.is_ready:
         print('\n{}: loaded {} steps.'.format(prog, g_tb._tsdata.numSteps))
     else:
@@ -258,21 +552,52 @@ def load_monitor(prog:str ='TB'):
    
     
 def usage(prog:str ='TB'):
-    print('usage: {} [-p port] [-j input.json | -l file0.sph file1.sph ...]'\
-          .format(prog))
+    print('usage: {} [-p port] [-w workers] [-n loaders] [-m]'.format(prog)
+          + ' [-L levels] [--pyramid {mean,min,max}] [--pyramid-files]'
+          + ' [--pyramid-build] [--minmax-build]'
+          + ' [--compress-level N] [--compress-threads N]'
+          + ' [--no-compress]'
+          + ' [-j input.json | -l file0.sph file1.sph ...]')
     return
 
     
 if __name__ == '__main__':
-    import threading
-    import time
     import argparse
     prog = 'TB'
 
     # parse argv
     parser = argparse.ArgumentParser(description='Temporal Buffer prototype',
-      usage='%(prog)s [-p port] [-j input.json | -l file0.sph file1.sph ...]')
+      usage='%(prog)s [-p port] [-w workers] [-n loaders] [-m]'\
+        + ' [-L levels] [--pyramid {mean,min,max}] [--pyramid-files]'\
+        + ' [--pyramid-build] [--minmax-build]'\
+        + ' [--compress-level N] [--compress-threads N]'\
+        + ' [--no-compress]'\
+        + ' [-j input.json | -l file0.sph file1.sph ...]')
     parser.add_argument('-p', help='port number', type=int, default='4001')
+    parser.add_argument('-w', help='number of HTTP worker threads', type=int,
+                        default=4)
+    parser.add_argument('-n', help='number of sph file loader threads',
+                        type=int, default=4)
+    parser.add_argument('-m', help='memory-map data of sph files',
+                        action='store_true')
+    parser.add_argument('-L', help='number of pyramid levels (1: no pyramid)',
+                        type=int, default=1)
+    parser.add_argument('--pyramid', help='decimation mode of pyramid levels',
+                        choices=TSDataSPH.PYRAMID_MODES, default='mean')
+    parser.add_argument('--pyramid-files', action='store_true',
+                        help='store pyramid levels as .sph.L<n> files')
+    parser.add_argument('--pyramid-build', action='store_true',
+                        help='build pyramid levels at load time')
+    parser.add_argument('--minmax-build', action='store_true',
+                        help='calculate min/max of all sph files at load time'\
+                        + ' and write .minmax sidecar files (with -m)')
+    parser.add_argument('--compress-level', type=int, default=None,
+                        help='compression level of /data streams'\
+                        + ' (default: zlib 1, lzma 0)')
+    parser.add_argument('--compress-threads', type=int, default=2,
+                        help='threads compressing frames ahead of sending')
+    parser.add_argument('--no-compress', action='store_true',
+                        help='never compress /data streams')
     parser.add_argument('-j', help='path of input.json')
     parser.add_argument('-l', help='pathes of input sph files', nargs='*')
     args = parser.parse_args()
@@ -283,41 +608,66 @@ if __name__ == '__main__':
 
     # prepare Temporal Buffer
     g_tb = TB()
+    if not g_tb._tsdata.setupPyramid(args.L, args.pyramid,
+                                     'file' if args.pyramid_files
+                                     else 'memory'):
+        print('{}: invalid number of pyramid levels: {}'.format(prog, args.L))
+        sys.exit(1)
+    g_tb.setupCompression([] if args.no_compress else None,
+                          args.compress_level, args.compress_threads)
 
     # invoke loading thread
     if args.j != None:
-        tbt = threading.Thread(target=g_tb.loadFromJSON, args=([args.j]))
+        tbt = threading.Thread(target=g_tb.loadFromJSON, args=([args.j]),
+                               kwargs={'mmap': args.m, 'nworkers': args.n})
     else:
-        tbt = threading.Thread(target=g_tb.loadFromFilelist, args=([args.l]))
+        tbt = threading.Thread(target=g_tb.loadFromFilelist, args=([args.l]),
+                               kwargs={'mmap': args.m, 'nworkers': args.n})
     tbt.setDaemon(True)
     tbt.start()
 
     # prepare monitoring thread
-    lmt = threading.Thread(target=load_monitor, args=([prog]))
+    lmt = threading.Thread(target=load_monitor, args=([prog, tbt]))
     lmt.setDaemon(True)
     lmt.start()
 
-    while True:
-        if not g_tb._tsdata.is_working:
-            break
-        time.sleep(0.5)
-        continue
-    if g_tb._tsdata.is_ready:
+    tbt.join()
+    lmt.join()
+    if not g_tb._tsdata.is_ready:
         sys.exit(1)
+    if args.minmax_build:
+        print('{}: calculating min/max of {} steps.'\
+              .format(prog, g_tb._tsdata.numSteps))
+        g_tb._tsdata.resolveMinMax(args.n, save=True)
+    elif g_tb._tsdata.numMinMaxPending > 0:
+        print('{}: WARNING: {} steps have no .minmax sidecar file; their'\
+              ' min/max is calculated in the background ({} threads) and'\
+              ' vrange is partial until done. Run with --minmax-build once'\
+              ' to write the sidecar files.'\
+              .format(prog, g_tb._tsdata.numMinMaxPending, args.n))
+        g_tb._tsdata.resolveMinMaxAsync(args.n)
+    if args.pyramid_build and g_tb._tsdata.numLevels > 1:
+        print('{}: building {} pyramid levels ...'\
+              .format(prog, g_tb._tsdata.numLevels - 1))
+        if not g_tb._tsdata.buildPyramid(args.n):
+            print('{}: build pyramid failed.'.format(prog))
+            sys.exit(1)
     
     # invoke HTTP server
     host = '0.0.0.0'
     port = args.p
     try:
-        httpd = HTTPServer((host, port), TBReqHandler)
+        httpd = PooledHTTPServer((host, port), TBReqHandler, nworkers=args.w)
     except Exception as e:
         print('{}: invoke httpd failed: {}'.format(prog, str(e)))
         sys.exit(1)
-    print('{}: serving started at port#{}'.format(prog, port))
+    print('{}: serving started at port#{} ({} workers)'\
+          .format(prog, port, httpd.nworkers))
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
-        sys.exit(0)
+        pass
+    httpd.server_close()
 
     #tbt.join()
     #lmt.join()
@@ -6,6 +6,7 @@ TB2C_client
 import sys, os
 import json
 import time
+import threading
 import urllib.request
 try:
     import wx # need to install via pip3 (wxPython)
@@ -33,8 +34,11 @@ class TB2C_App(wx.App):
     ''' TB2C_App
     TB2C clientのプロトタイプAppクラスです。
     wxPythonのAppクラスを継承しています。
+    TB2Cサーバ、ChOWDERへの更新要求はバックグラウンドの更新スレッドで処理され、
+    UIスレッドはブロックされません。
     '''
     REQ_NONE, REQ_UPDDATA, REQ_UPDVIEW = (0, 1, 2)
+    CHOWDER_TIMEOUT = 30.0 # [sec]
     
     def OnInit(self):
         ''' OnInit
@@ -45,14 +49,22 @@ class TB2C_App(wx.App):
         self.SetAppName('TB2C_client')
         self._metaDic = None
         self._lastErr = None
+        self._lastTimings = None
 
         self._tb2c_serv_url = None
+        self._lod = 0 # level of detail of the preview (0: no preview)
 
         self._chowder = chowder.ChOWDER()
         self._chowder_host = None
         self._chowder_loginkey = None
         self._chowder_id = None
 
+        # background update worker
+        self._upd_cv = threading.Condition()
+        self._upd_req = None
+        self._upd_dataSeq = 0
+        self._upd_th = None
+
         # toplevel frame
         self._frame = wx.Frame(None, title='TB2C client', size=(800, 500))
         fileMenu = wx.Menu()
@@ -269,37 +281,130 @@ class TB2C_App(wx.App):
             self._chowder_id = None
             #self._chowder.wait_until_close()
         try:
-            self._chowder.connect(hostnm)
-        except Exception as e:
-            self._lastErr = str(e)
-            return False
+            self._chowder.connect(hostnm, TB2C_App.CHOWDER_TIMEOUT)
         
-        login_req = chowder.JSONRPC('Login')
-        login_req['params']['id'] = 'APIUser'
-        login_req['params']['password'] = pswd
-        def login_callback(err, result):
+            login_req = chowder.JSONRPC('Login')
+            login_req['params']['id'] = 'APIUser'
+            login_req['params']['password'] = pswd
+            result = self._chowder.send_json(login_req).result(
+                TB2C_App.CHOWDER_TIMEOUT)
             self._chowder_loginkey = result['loginkey']
-        self._chowder.send_json(login_req, login_callback)
 
-        import thumb_data
-        content_req = chowder.add3DTilesContent(self._chowder, [],
-                                                thumb_data._data)
-        while not self._chowder.is_done(content_req):
-            time.sleep(0.05)
+            import thumb_data
+            content_req = chowder.add3DTilesContent(self._chowder, [],
+                                                    thumb_data._data)
+            self._chowder.wait(content_req, TB2C_App.CHOWDER_TIMEOUT)
+        except Exception as e:
+            self._lastErr = 'ChOWDER: {}'.format(str(e) or type(e).__name__)
+            return False
         self._chowder_host = hostnm
         self._chowder_id = content_req['params']['id']
 
         self.updateRequest(TB2C_App.REQ_UPDDATA)
         return True
 
+    def requestVisualize(self, step:int, value:float, lod:int =0) -> []:
+        ''' requestVisualize
+        TB2Cサーバに等値面の作成を依頼し、レイヤーリストを取得します。
+        更新スレッドから呼び出されるため、UIを参照しません。
+
+        Parameters
+        ----------
+        step: int
+          タイムステップインデックス番号
+        value: float
+          等値面の値
+        lod: int
+          詳細度(0: 元の解像度、N: 1/2**Nに間引いたデータによるプレビュー)
+
+        Returns
+        -------
+        []: レイヤーリスト、None: 失敗(self._lastErrにエラーメッセージを登録)
+          レスポンスヘッダー'X-TB2C-Timings'の段階毎の所要時間等は
+          self._lastTimingsに登録されます(ない場合はNone)。
+        '''
+        self._lastTimings = None
+        url = self._tb2c_serv_url + 'visualize'
+        data = {
+            'step': step,
+            'vistype': 'isosurf',
+            'visparam': {'value': value}
+        }
+        if lod > 0:
+            data['visparam']['lod'] = lod
+        head = {'Content-Type': 'application/json'}
+        req = urllib.request.Request(url, json.dumps(data).encode(), head)
+        try:
+            with urllib.request.urlopen(req) as res:
+                res_bin = res.read()
+                timings = res.headers.get('X-TB2C-Timings')
+            res_str = res_bin.decode()
+            layerList = json.loads(res_str)
+        except Exception as e:
+            self._lastErr = str(e)
+            return None
+        if timings:
+            try:
+                self._lastTimings = json.loads(timings)
+            except:
+                pass
+        return layerList
+
+    def updateLayers(self, layerList:[]) -> bool:
+        ''' updateLayers
+        ChOWDERに3D-Tilesのレイヤーリストの更新を依頼し、応答を待ちます。
+
+        Parameters
+        ----------
+        layerList: []
+          レイヤーリスト
+
+        Returns
+        -------
+        bool: True=成功(ChOWDERに未接続の場合を含む)、
+          False=失敗(self._lastErrにエラーメッセージを登録)
+        '''
+        if self._chowder_host and self._chowder_id:
+            content_req = chowder.update3DTilesContent(self._chowder,
+                                                       self._chowder_id,
+                                                       layerList)
+            return self.waitChOWDER(content_req)
+        return True
+
+    def waitChOWDER(self, req:dict) -> bool:
+        ''' waitChOWDER
+        ChOWDERに送ったリクエストの応答を最大CHOWDER_TIMEOUT秒待ちます。
+
+        Parameters
+        ----------
+        req: dict
+          リクエスト
+
+        Returns
+        -------
+        bool: True=成功、False=失敗(エラー応答、切断、タイムアウト。
+          self._lastErrにエラーメッセージを登録)
+        '''
+        try:
+            self._chowder.wait(req, TB2C_App.CHOWDER_TIMEOUT)
+        except Exception as e:
+            self._lastErr = 'ChOWDER: {}: {}'.format(
+                req['method'], str(e) or type(e).__name__)
+            return False
+        return True
+
     def updateRequest(self, flag) -> bool:
         ''' updateRequest
-        データ更新処理を行います。
+        データ更新処理を要求します(UIスレッドから呼び出します)。
         flagのTB2C_App.REQ_UPDDATAビットがONの場合は、TB2Cサーバに等値面の再作成を
         依頼し、ChOWDERに表示更新を依頼します。これは、タイムステップまたは等値面の値が
         変更された場合にコールされます。
         flagのTB2C_App.REQ_UPDVIEWビットがONの場合は、ChOWDERへの表示更新依頼のみを
         行います。これは視界が変更された場合にコールされます。
+        タイムステップ、等値面の値、カメラ行列はこの時点の値が使用され、
+        処理は更新スレッド(updateWorker)で行われます。未処理の要求は最新の1件に
+        まとめられ(flagはORされます)、処理中のデータ更新の結果は、より新しい
+        データ更新の要求があれば破棄されます。
 
         Parameters
         ----------
@@ -308,55 +413,143 @@ class TB2C_App(wx.App):
 
         Returns
         -------
-        bool: True=成功、False=失敗(self._lastErrにエラーメッセージを登録)
+        bool: True=要求した、False=失敗(self._lastErrにエラーメッセージを登録)
         '''
-        layerList = None
-        upd_start = None
+        if flag & TB2C_App.REQ_UPDDATA and not self._tb2c_serv_url:
+            self._lastErr = 'not connected to TB2C server'
+            return False
+        req = {'flag': flag,
+               'camera': self._canvas.GetMatrix().m_v.tolist()}
+        with self._upd_cv:
+            if flag & TB2C_App.REQ_UPDDATA:
+                self._upd_dataSeq += 1
+                req.update({'step': self.stepIdx, 'value': self.isoval,
+                            'lod': self._lod, 'seq': self._upd_dataSeq})
+            if self._upd_req is not None:
+                # 未処理の要求にまとめる
+                prev = self._upd_req
+                req['flag'] |= prev['flag']
+                if not flag & TB2C_App.REQ_UPDDATA and \
+                   prev['flag'] & TB2C_App.REQ_UPDDATA:
+                    req.update({k: prev[k]
+                                for k in ('step', 'value', 'lod', 'seq')})
+            self._upd_req = req
+            if self._upd_th is None:
+                self._upd_th = threading.Thread(target=self.updateWorker)
+                self._upd_th.daemon = True
+                self._upd_th.start()
+            self._upd_cv.notify()
+        return True
+
+    def isStale(self, req:dict) -> bool:
+        ''' isStale
+        データ更新の要求reqより新しいデータ更新が要求されているかを返します。
+
+        Parameters
+        ----------
+        req: dict
+          更新要求
+
+        Returns
+        -------
+        bool: True=より新しい要求がある
+        '''
+        with self._upd_cv:
+            return req['seq'] != self._upd_dataSeq
+
+    def updateWorker(self) -> None:
+        ''' updateWorker
+        バックグラウンドで更新要求を処理するスレッドの処理です。
+        処理結果はwx.CallAfterでUIスレッドのupdateDoneに通知されます。
+        '''
+        while True:
+            with self._upd_cv:
+                while self._upd_req is None:
+                    self._upd_cv.wait()
+                req = self._upd_req
+                self._upd_req = None
+            upd_start = None
+            ok = self.processUpdate(req)
+            if ok and req['flag'] & TB2C_App.REQ_UPDDATA and \
+               not req.get('dropped'):
+                upd_start = req['start']
+            wx.CallAfter(self.updateDone, ok, upd_start, req.get('timings'))
+            continue # end of while
+
+    def processUpdate(self, req:dict) -> bool:
+        ''' processUpdate
+        1件の更新要求を処理します(更新スレッドから呼び出されます)。
+        self._lodが1以上の場合は、まず間引いたデータによるプレビューの等値面で
+        表示を更新した後、元の解像度の等値面で表示を更新します。
+        より新しいデータ更新が要求された場合は、取得したレイヤーリストを
+        ChOWDERに送らずに終了します。
+        TB2Cサーバが返した最後の所要時間等は(詳細度と共に)req['timings']に
+        登録されます。
+
+        Parameters
+        ----------
+        req: dict
+          更新要求(updateRequestで作成)
+
+        Returns
+        -------
+        bool: True=成功(破棄した場合はreq['dropped']=True)、
+          False=失敗(self._lastErrにエラーメッセージを登録)
+        '''
+        flag = req['flag']
+        req['start'] = time.time()
         if flag & TB2C_App.REQ_UPDDATA:
-            if not self._tb2c_serv_url:
-                self._lastErr = 'not connected to TB2C server'
-                return False
-            #print('UPDATE DATA')
-            # request TB2C_server to visualize
-            url = self._tb2c_serv_url + 'visualize'
-            data = {
-                'step': self.stepIdx,
-                'vistype': 'isosurf',
-                'visparam': {'value': self.isoval}
-            }
-            head = {'Content-Type': 'application/json'}
-            req = urllib.request.Request(url, json.dumps(data).encode(), head)
-            upd_start = time.time()
-            try:
-                with urllib.request.urlopen(req) as res:
-                    res_bin = res.read()
-                res_str = res_bin.decode()
-                layerList = json.loads(res_str)
-            except Exception as e:
-                self._lastErr = str(e)
-                return False
-            # request ChOWDER to update 3d-tiles data
-            if self._chowder_host and self._chowder_id:
-                content_req = chowder.update3DTilesContent(self._chowder,
-                                                           self._chowder_id,
-                                                           layerList)
-                while not self._chowder.is_done(content_req):
-                    time.sleep(0.05)
-                
+            lods = [req['lod'], 0] if req['lod'] > 0 else [0]
+            for lod in lods:
+                # request TB2C_server to visualize
+                layerList = self.requestVisualize(req['step'], req['value'],
+                                                  lod)
+                if layerList is None:
+                    return False
+                req['timings'] = (self._lastTimings, lod)
+                if self.isStale(req):
+                    req['dropped'] = True
+                    return True
+                # request ChOWDER to update 3d-tiles data
+                if not self.updateLayers(layerList):
+                    return False
+                continue # end of for(lod)
+
         if flag & (TB2C_App.REQ_UPDDATA | TB2C_App.REQ_UPDVIEW):
             if not self._chowder_host or not self._chowder_id:
                 self._lastErr = 'not connected to ChOWDER'
                 return False
-            #print('UPDATE VIEW')
-            CM = self._canvas.GetMatrix()
             content_req = chowder.updateCamera(self._chowder, self._chowder_id,
-                                               CM.m_v.tolist())
-            while not self._chowder.is_done(content_req):
-                time.sleep(0.05)
+                                               req['camera'])
+            if not self.waitChOWDER(content_req):
+                return False
+        return True
+
+    def updateDone(self, ok:bool, upd_start:float =None,
+                   timings:tuple =None) -> None:
+        ''' updateDone
+        更新要求の処理完了時にUIスレッドで呼び出されます。
+        TB2Cサーバが返した所要時間等はUI panelに表示されます。
+
+        Parameters
+        ----------
+        ok: bool
+          処理結果
+        upd_start: float
+          データ更新の開始時刻(データ更新でない場合はNone)
+        timings: tuple
+          (TB2Cサーバが返した所要時間等, 詳細度)、None: データ更新なし
+        '''
+        if timings:
+            self._uiPanel.setTimings(*timings)
+        if not ok:
+            print('{}: update failed: {}'.format(self.GetAppName(),
+                                                 self._lastErr))
+            return
         if upd_start:
             print('{}: update elapsed time = {:.3f}[sec]'.format(
                 self.GetAppName(), time.time() - upd_start))
-        return True
+        return
          
 
 #-----------------------------------------------------------------------------
@@ -366,15 +559,18 @@ if __name__ == '__main__':
 
     # parse argv
     parser = argparse.ArgumentParser(description='TB2C client',
-      usage='%(prog)s [-s http://localhost:4000/] [-c localhost]')
+      usage='%(prog)s [-s http://localhost:4000/] [-c localhost] [-L lod]')
     parser.add_argument('-s', help='URL of TB2C_server to connect',
                         type=str, default=None)
     parser.add_argument('-c', help='hostname|IP address of ChOWDER server',
                         type=str, default=None)
+    parser.add_argument('-L', help='level of detail of the preview'\
+                        + ' isosurface (0: no preview)', type=int, default=0)
     args = parser.parse_args()
 
     # prepare App
     app = TB2C_App()
+    app._lod = max(0, args.L)
     if args.s:
         if not app.connectTB2CSrv(args.s):
             print('TB2C_client: Error: {}'.format(app.lastError))
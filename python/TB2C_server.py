@@ -6,13 +6,22 @@ TB2C_server
 import sys, os
 import numpy as np
 import json
+import time
+import threading
+import queue
+import multiprocessing
 import urllib.request
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from concurrent.futures import ProcessPoolExecutor
+from http.server import SimpleHTTPRequestHandler
 from urllib.parse import parse_qs, urlparse
 
 import TB2C_visualize
 from pySPH import SPH
 from SPH_filter import SPH_filter
+from SPH_binary import SPH_binary
+from utilHttp import PooledHTTPServer
+from utilCache import LRUCache, DiskLRUCache
+from utilMetrics import HTTPMetrics, MetricsHandlerMixin
 
 #-----------------------------------------------------------------------------
 g_app = None # global instance of TB2C_server
@@ -20,8 +29,28 @@ g_app = None # global instance of TB2C_server
 class TB2C_server:
     ''' TB2C_server
     TB2C serverのプロトタイプ実装クラスです。
+    TBから取得したデータ(と間引いたピラミッドの各段)は、(データID, タイムステップ,
+    部分データの指定, 段)をキーとするバイト数制限付きのLRUキャッシュ(_cache)に
+    保持され、要求毎にビューとして分割されます。
+    メタデータと直近のデータ(_last_step, _last_sph_list)は_lockで、
+    可視化処理(_vis)は_vis_lockで保護されます。
+    setupProcPoolで設定した場合、分割された各ブロックの等値面生成は
+    プロセスプール(_pool)で並行して実行されます。
+    生成した等値面は、setupIsosurfCacheで設定した場合、(データ, タイムステップ,
+    等値面の値, 分割数)をキーとするディスクキャッシュ(_isocache)に保持されます。
+    可視化処理の各段階(TBからの取得、デコード、分割、等値面生成、出力等)の
+    所要時間は、ブロック毎の頂点数、三角形数と共に可視化の付加情報
+    ('timings')として返されます。
+    setupPrefetchで設定した場合、可視化要求に応答した後、前後のタイムステップの
+    データをバックグラウンドで先読みし(_pf_*)、キャッシュに格納します。
     '''
-    def __init__(self):
+    ISOCACHE_DIR = 'isocache'
+    INDEX_CACHE_BYTES = 64 * 1024 * 1024
+    PARTIAL_KEEP = 2 # uncached results with block errors kept on disk
+
+    def __init__(self, cache_bytes:int =1024*1024*1024):
+        self._lock = threading.RLock()
+        self._vis_lock = threading.Lock()
         self._vis = None
         self._meta_dic = None
         self._tb_uri = None
@@ -29,7 +58,34 @@ class TB2C_server:
         self._out_dir = '.'
         self._last_step = -1
         self._last_sph_list = []
+        self._cache = LRUCache(cache_bytes)
+        self._index_cache = LRUCache(TB2C_server.INDEX_CACHE_BYTES)
+        self._isocache = None
+        self._partial_dirs = []
         self._obj23dt_ver = None
+        self._native = True
+        self._pool = None
+        self._nprocs = 1
+        self._stream = True
+        self._codec = None # compression of the data fetched from TB
+        self._lod_mode = 'mean'
+        self._refine_cv = threading.Condition()
+        self._refine_req = None
+        self._refine_run = None # (step, value, subset) being refined
+        self._refine_cancel = threading.Event()
+        self._refine_th = None
+        self._stage_totals = {}
+        self._vis_count = 0
+        self._inflight = {} # key -> threading.Event of the fetch in progress
+        self._pf_cv = threading.Condition()
+        self._pf_window = 0
+        self._pf_center = None # (step, subset)
+        self._pf_lods = set()
+        self._pf_queue = []
+        self._pf_fetched = set()
+        self._pf_stats = {'fetched': 0, 'cancelled': 0, 'failed': 0,
+                          'used': 0}
+        self._pf_th = None
         return
     
     @property
@@ -48,6 +104,10 @@ class TB2C_server:
     def out_dir(self):
         return self._out_dir
 
+    @property
+    def cache(self):
+        return self._cache
+
     def connectTB(self, uri:str):
         ''' connectTB
         URIで指定されたデータソースに接続し、メタデータを読み込み、
@@ -64,16 +124,307 @@ class TB2C_server:
         res_str = res_bin.decode()
         res_dic = json.loads(res_str)
         res_dic['vistype'] = ['isosurf']
-        self._meta_dic = res_dic
-        self._tb_uri = uri
-        self._last_step = -1
-        self._last_sph_list = []
+        with self._lock:
+            self._meta_dic = res_dic
+            self._tb_uri = uri
+            self._last_step = -1
+            self._last_sph_list = []
+            self._cache.clear()
+            self._index_cache.clear()
+        with self._pf_cv:
+            self._pf_center = None
+            self._pf_queue = []
+            self._pf_fetched.clear()
+        return
+
+    @staticmethod
+    def addTiming(timings:dict, stage:str, t0:float) -> float:
+        ''' addTiming
+        timingsのstageに、t0(time.perf_counter()の値)からの経過時間[s]を
+        加算します(static method)。timingsがNoneの場合は何もしません。
+
+        Parameters
+        ----------
+        timings: dict
+          段階名をキーとする所要時間[s]の辞書
+        stage: str
+          段階名
+        t0: float
+          開始時刻(time.perf_counter()の値)
+
+        Returns
+        -------
+        float: 現在時刻(time.perf_counter()の値、次の段階の開始時刻)
+        '''
+        t = time.perf_counter()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + (t - t0)
+        return t
+
+    @staticmethod
+    def timingInfo(timings:dict, stat_lst:[dict] =None,
+                   cached:bool =False) -> dict:
+        ''' timingInfo
+        段階毎の所要時間と、ブロック毎の統計値(TB2C_visualize.isosurfBlockの
+        戻り値)から、可視化の付加情報'timings'を作成します(static method)
+
+        Parameters
+        ----------
+        timings: dict
+          段階名をキーとする所要時間[s]の辞書
+        stat_lst: [dict]
+          ブロック毎の統計値のリスト(処理されなかったブロックはNone)
+        cached: bool
+          等値面キャッシュから返したか
+
+        Returns
+        -------
+        dict: 'stages': 段階名をキーとする所要時間[s]、'verts', 'tris':
+          頂点数、三角形数の合計、'blocks': ブロック数、'max_block':
+          三角形数が最大のブロックの[ブロック番号, 頂点数, 三角形数](ブロックが
+          ない場合はNone)、'cached': 等値面キャッシュから返したか
+          レスポンスヘッダーに格納するため、大きさは分割数によりません
+          (ブロック毎の値はblockStatsを参照)。
+        '''
+        total = TB2C_visualize.TB2C_visualize.sumStats(
+            stat_lst if stat_lst else [])
+        # ordered as processed: data, blocks, then the elapsed times
+        stages = {k: t for k, t in timings.items()
+                  if k not in ('generate', 'total')}
+        for stage, t in total['times'].items():
+            stages[stage] = stages.get(stage, 0.0) + t
+        for stage in ('generate', 'total'):
+            if stage in timings:
+                stages[stage] = timings[stage]
+        blocks = TB2C_server.blockStats(stat_lst)
+        imax = max(range(len(blocks)), key=lambda i: blocks[i][1]) \
+            if blocks else None
+        return {
+            'stages': {k: round(t, 6) for k, t in stages.items()},
+            'verts': total['verts'],
+            'tris': total['tris'],
+            'blocks': len(blocks),
+            'max_block': [imax] + blocks[imax] if blocks else None,
+            'cached': cached,
+        }
+
+    @staticmethod
+    def blockStats(stat_lst:[dict] =None) -> [[int]]:
+        ''' blockStats
+        ブロック毎の統計値から、ブロック毎の[頂点数, 三角形数]のリストを
+        作成します(static method)
+
+        Parameters
+        ----------
+        stat_lst: [dict]
+          ブロック毎の統計値のリスト(処理されなかったブロックはNone)
+
+        Returns
+        -------
+        [[int]]: ブロック毎の[頂点数, 三角形数]のリスト
+        '''
+        return [[st['verts'], st['tris']] if st else [0, 0]
+                for st in (stat_lst if stat_lst else [])]
+
+    def beginFetch(self, key:tuple) -> (SPH.SPH, threading.Event):
+        ''' beginFetch
+        keyのデータがキャッシュに存在すればそれを返します。存在しない場合は、
+        取得中(_inflight)として登録し、登録したEventを返します(呼び出し側は
+        取得後にendFetchを呼び出す必要があります)。他のスレッドが同じkeyを
+        取得中の場合は、その終了を待ってからキャッシュを確認し直します。
+        キャッシュのヒット/ミスは、1回の呼び出しにつき1回だけ計上されます。
+
+        Parameters
+        ----------
+        key: tuple
+          キャッシュのキー(id, step, subset, level)
+
+        Returns
+        -------
+        SPH.SPH: キャッシュされていたデータ、None: 呼び出し側が取得する
+        threading.Event: 登録したEvent(データを返した場合はNone)
+        '''
+        while True:
+            with self._lock:
+                evt = self._inflight.get(key)
+                if evt is None:
+                    sph = self._cache.get(key)
+                    if sph is not None:
+                        return (sph, None)
+                    evt = self._inflight[key] = threading.Event()
+                    return (None, evt)
+            evt.wait()
+            continue # end of while
+
+    def endFetch(self, key:tuple, evt:threading.Event) -> None:
+        ''' endFetch
+        beginFetchで登録した取得中のkeyの登録を解除し、待っているスレッドを
+        再開させます。
+
+        Parameters
+        ----------
+        key: tuple
+          キャッシュのキー
+        evt: threading.Event
+          beginFetchが返したEvent
+        '''
+        with self._lock:
+            if self._inflight.get(key) is evt:
+                del self._inflight[key]
+        evt.set()
         return
 
-    def getSPHdata(self, id:int, stp:int) -> [SPH.SPH]:
+    def openData(self, xuri:str):
+        ''' openData
+        TBの'/data'のURLを開く。圧縮(self._codec)が設定されている場合は
+        Accept-Encodingでそれを要求し、応答のContent-Encodingから、スラブが
+        圧縮されているかを判定する。
+
+        Parameters
+        ----------
+        xuri: str
+          '/data'のURL
+
+        Returns
+        -------
+        http.client.HTTPResponse: 応答
+        str: スラブの圧縮方式(SPH_binary.readFramesのcodec)、None: 圧縮なし
+        '''
+        hdrs = {}
+        if self._codec:
+            hdrs['Accept-Encoding'] = SPH_binary.acceptEncoding([self._codec])
+        response = urllib.request.urlopen(
+            urllib.request.Request(xuri, headers=hdrs))
+        return (response,
+                SPH_binary.selectCodec(response.headers.get('Content-Encoding')))
+
+    def getSPHvolume(self, id:int, stp:int, subset:tuple =None,
+                     level:int =0, timings:dict =None,
+                     cancel =None) -> SPH.SPH:
+        ''' getSPHvolume
+        TBより、idとstepを指定して(分割しない)SPHデータを取得する。
+        実際にアクセスするURLは'{uri}/data?id={id}&step={stp}&format=bin'
+        で、SPH_binary形式で受信したデータ部をコピーせずにSPHデータとする。
+        levelが1以上の場合は、level-1のデータを各軸方向に1/2に間引いたデータ
+        (ピラミッドのlevel段目)を返す。TBがそのlevelのピラミッドを同じ間引き方法で
+        保持している場合(メタデータの'levels', 'pyramid')で、部分データの指定が
+        ない場合は、TBから'&level={level}'を指定して取得する。
+        取得・間引きしたデータはキャッシュされ、同じid, step, 部分データの指定,
+        levelの要求にはキャッシュから返される。
+        timingsが指定された場合、TBの応答までの時間を'fetch'、データの受信と
+        復元の時間を'decode'、間引きの時間を'decimate'に加算する。
+        同じデータを他のスレッド(先読み等)が取得中の場合は、その終了を待つ。
+        cancelが指定された場合は、ストリーム形式('format=stream')で取得し、
+        スラブを受信する毎にcancel()がTrueを返せば取得を中止する(先読み用)。
+        圧縮(self._codec)が設定されている場合もストリーム形式で取得し、
+        圧縮されたスラブを受信しながら展開する。
+
+        Parameters
+        ----------
+        id: int
+          取得するSPHデータのID
+        step: int
+          取得するSPHデータのタイムステップインデックス番号
+        subset: tuple
+          部分データの指定(parseSubsetの戻り値、省略時は全体)
+        level: int
+          ピラミッドの段(0: 元の解像度)
+        timings: dict
+          段階毎の所要時間[s]を加算する辞書(省略可)
+        cancel: callable
+          取得を中止するかを返す関数(省略時は中止しない)
+
+        Returns
+        -------
+        SPH.SPH: 取得したデータ、None: 失敗または中止
+        '''
+        with self._lock:
+            if not self._tb_uri:
+                return None
+            xuri = self._tb_uri
+            remote = level > 0 and subset is None and \
+                self._meta_dic.get('levels', 1) > level and \
+                self._meta_dic.get('pyramid') == self._lod_mode
+        key = (id, stp, subset, level)
+        sph, evt = self.beginFetch(key)
+        if sph is not None:
+            if cancel is None:
+                self.prefetchUsed(key)
+            return sph
+        try:
+            if level > 0 and not remote:
+                src = self.getSPHvolume(id, stp, subset, level - 1, timings,
+                                        cancel)
+                if src is None:
+                    return None
+                t0 = time.perf_counter()
+                sph = SPH_filter.decimate(src, 2, self._lod_mode)
+                TB2C_server.addTiming(timings, 'decimate', t0)
+            else:
+                if xuri.endswith('/'):
+                    xuri += 'data'
+                else:
+                    xuri += '/data'
+                xuri += '?id={}'.format(id)
+                xuri += '&step={}'.format(stp)
+                stream = cancel is not None or self._codec is not None
+                xuri += '&format=stream' if stream else '&format=bin'
+                xuri += TB2C_server.subsetQuery(subset)
+                if level > 0:
+                    xuri += '&level={}'.format(level)
+                t0 = time.perf_counter()
+                response, codec = self.openData(xuri)
+                with response:
+                    t0 = TB2C_server.addTiming(timings, 'fetch', t0)
+                    if not stream:
+                        sph = SPH_binary.readFrom(response)
+                    else:
+                        res = SPH_binary.readHeader(response)
+                        if res is None:
+                            return None
+                        sph, fmt = res
+                        for kend in SPH_binary.readFrames(response, sph, fmt,
+                                                          codec):
+                            if cancel is not None and cancel():
+                                return None
+                            continue # end of for(kend)
+                TB2C_server.addTiming(timings, 'decode', t0)
+            if not sph:
+                return None
+            self._cache.put(key, sph, sph._data.nbytes)
+        finally:
+            self.endFetch(key, evt)
+        return sph
+
+    def divideVolume(self, sph:SPH.SPH, timings:dict =None) -> [SPH.SPH]:
+        ''' divideVolume
+        SPHデータを分割数(self._div)に従い分割する。
+        分割されたデータはsphのデータ部のビューとなる(コピーしない)。
+
+        Parameters
+        ----------
+        sph: SPH.SPH
+          分割するSPHデータ
+        timings: dict
+          分割の所要時間[s]を'divide'に加算する辞書(省略可)
+
+        Returns
+        -------
+        [SPH.SPH]: 分割したデータのリスト
+        '''
+        with self._lock:
+            div = tuple(self._div)
+        if div[0]*div[1]*div[2] > 1:
+            t0 = time.perf_counter()
+            sph_lst = SPH_filter.divideShareEdge(sph, div, view=True)
+            TB2C_server.addTiming(timings, 'divide', t0)
+            return sph_lst
+        return [sph]
+
+    def getSPHdata(self, id:int, stp:int, subset:tuple =None,
+                   level:int =0, timings:dict =None) -> [SPH.SPH]:
         ''' getSPHdata
-        TBより、idとstepを指定してSPHデータを取得する。
-        実際にアクセスするURLは'{uri}/data?id={id}&step={stp}'
+        TBより、idとstepを指定してSPHデータを取得し(getSPHvolume)、分割する。
 
         Parameters
         ----------
@@ -81,64 +432,835 @@ class TB2C_server:
           取得するSPHデータのID
         step: int
           取得するSPHデータのタイムステップインデックス番号
+        subset: tuple
+          部分データの指定(parseSubsetの戻り値、省略時は全体)
+        level: int
+          ピラミッドの段(0: 元の解像度)
+        timings: dict
+          段階毎の所要時間[s]を加算する辞書(省略可)
 
         Returns
         -------
         [SPH.SPH]: 取得したデータ(を分割したリスト)
         '''
-        if not self._tb_uri:
-            return None
-        if stp == self._last_step:
-            return self._last_sph_list
-        
-        xuri = self._tb_uri
-        if xuri.endswith('/'):
-            xuri += 'data'
-        else:
-            xuri += '/data'
-        xuri += '?id={}'.format(id)
-        xuri += '&step={}'.format(stp)
-        with urllib.request.urlopen(xuri) as response:
-            res_bin = response.read()
-        res_str = res_bin.decode()
-        res_dic = json.loads(res_str)
-        sph = SPH_filter.fromJSON(res_dic['data'])
-        if not sph:
+        sph = self.getSPHvolume(id, stp, subset, level, timings)
+        if sph is None:
             return []
-        if self.div[0]*self.div[1]*self.div[2] > 1:
-            self._last_sph_list = SPH_filter.divideShareEdge(sph, self.div)
-        else:
-            self._last_sph_list = [sph]
-        self._last_step = stp
-        return self._last_sph_list
+        sph_lst = self.divideVolume(sph, timings)
+        with self._lock:
+            self._last_sph_list = sph_lst
+            self._last_step = stp
+        return sph_lst
+
+    def streamSPHdata(self, id:int, stp:int, subset:tuple =None,
+                      timings:dict =None) -> (int, []):
+        ''' streamSPHdata
+        TBより、idとstepを指定してSPHデータをストリーム形式で取得する。
+        実際にアクセスするURLは'{uri}/data?id={id}&step={stp}&format=stream'
+        で、受信したスラブは確保済みのデータ部に直接格納される
+        (圧縮されたスラブは受信しながら展開して格納される)。
+        分割されたデータ(データ部のビュー)は、Z方向に必要な面を全て受信した
+        ものから順に返されるため、後続のスラブの受信中に等値面生成を開始できる。
+        全て受信できた場合はgetSPHvolumeと同様にキャッシュされる。
+        取得はbeginFetch/endFetchで登録されるため、同じデータを他のスレッドが
+        取得中の場合はその終了を待ち、受信中に同じデータを要求した
+        getSPHvolume(先読み等)は受信の終了を待つ。
+        キャッシュに存在する場合はキャッシュされたデータを分割したリストを返す。
+        timingsが指定された場合、TBの応答までの時間を'fetch'、全スラブの受信の
+        時間を'decode'(等値面生成と並行する)、分割の時間を'divide'に加算する。
+
+        Parameters
+        ----------
+        id: int
+          取得するSPHデータのID
+        step: int
+          取得するSPHデータのタイムステップインデックス番号
+        subset: tuple
+          部分データの指定(parseSubsetの戻り値、省略時は全体)
+        timings: dict
+          段階毎の所要時間[s]を加算する辞書(省略可)
+
+        Returns
+        -------
+        int: 分割されたデータの数、0: 失敗
+        iterable: 分割されたデータを順に返すイテレーター(またはリスト)
+          受信に失敗した場合は途中で終了します。
+        '''
+        with self._lock:
+            if not self._tb_uri:
+                return (0, [])
+            xuri = self._tb_uri
+            div = tuple(self._div)
+        key = (id, stp, subset, 0)
+        sph, evt = self.beginFetch(key)
+        if sph is not None:
+            self.prefetchUsed(key)
+            sph_lst = self.divideVolume(sph, timings)
+            with self._lock:
+                self._last_sph_list = sph_lst
+                self._last_step = stp
+            return (len(sph_lst), sph_lst)
+
+        if not xuri.endswith('/'):
+            xuri += '/'
+        xuri += 'data?id={}&step={}&format=stream'.format(id, stp)
+        xuri += TB2C_server.subsetQuery(subset)
+        response = None
+        try:
+            t0 = time.perf_counter()
+            response, codec = self.openData(xuri)
+            res = SPH_binary.readHeader(response)
+            t0 = TB2C_server.addTiming(timings, 'fetch', t0)
+            rng_lst = None
+            if res is not None:
+                sph, fmt = res
+                sph._data = np.empty(0, dtype=fmt.newbyteorder('='))
+                rng_lst = SPH_filter.blockRanges(sph, div)
+        except:
+            if response is not None:
+                response.close()
+            self.endFetch(key, evt)
+            raise
+        if not rng_lst:
+            response.close()
+            self.endFetch(key, evt)
+            return (0, [])
+
+        blkq = queue.Queue()
+        def reader():
+            sph_lst = []
+            nxt = 0
+            t_div = 0.0
+            try:
+                for kend in SPH_binary.readFrames(response, sph, fmt, codec):
+                    if not sph_lst:
+                        # divide once the data buffer has been allocated
+                        t1 = time.perf_counter()
+                        sph_lst = SPH_filter.divideShareEdge(sph, div,
+                                                             view=True)
+                        t_div = TB2C_server.addTiming(timings, 'divide', t1) \
+                            - t1
+                    # blocks whose all z-planes have been received
+                    while nxt < len(sph_lst) and \
+                          rng_lst[nxt][1][2] + rng_lst[nxt][2][2] <= kend:
+                        blkq.put(sph_lst[nxt])
+                        nxt += 1
+                        continue # end of while
+                    continue # end of for(kend)
+            except Exception as e:
+                print('streamSPHdata: receive failed: {}'.format(str(e)))
+                blkq.put(None)
+                self.endFetch(key, evt)
+                return
+            finally:
+                response.close()
+            if timings is not None:
+                timings['decode'] = timings.get('decode', 0.0) \
+                    + (time.perf_counter() - t0 - t_div)
+            self._cache.put(key, sph, sph._data.nbytes)
+            self.endFetch(key, evt)
+            with self._lock:
+                self._last_sph_list = sph_lst
+                self._last_step = stp
+            return
+        th = threading.Thread(target=reader)
+        th.daemon = True
+        th.start()
+
+        def blocks():
+            for _ in range(len(rng_lst)):
+                blk = blkq.get()
+                if blk is None:
+                    return
+                yield blk
+                continue # end of for
+            th.join() # wait for the cache update
+            return
+        return (len(rng_lst), blocks())
 
-    def generateIsosurf(self, value:float) -> bool:
+    @staticmethod
+    def parseSubset(visparam:dict) -> tuple:
+        ''' parseSubset
+        visparamから部分データの指定('roi': [i0, i1, j0, j1, k0, k1]、
+        'stride': [sx, sy, sz]または整数、'comp': 整数)を取り出します(static method)
+
+        Parameters
+        ----------
+        visparam: dict
+          可視化パラメータ
+
+        Returns
+        -------
+        tuple: (roi, stride, comp)、指定されなかった項目はNone
+          全て指定されなかった場合はNone。書式が不正な場合はValueErrorを送出します。
+        '''
+        roi = stride = comp = None
+        if visparam.get('roi') is not None:
+            roi = tuple([int(x) for x in visparam['roi']])
+            if len(roi) != 6:
+                raise ValueError('roi')
+        if visparam.get('stride') is not None:
+            stride = visparam['stride']
+            if isinstance(stride, (int, float, str)):
+                stride = [stride] * 3
+            stride = tuple([int(x) for x in stride])
+            if len(stride) != 3:
+                raise ValueError('stride')
+        if visparam.get('comp') is not None:
+            comp = int(visparam['comp'])
+        if roi is None and stride is None and comp is None:
+            return None
+        return (roi, stride, comp)
+
+    @staticmethod
+    def subsetQuery(subset:tuple) -> str:
+        ''' subsetQuery
+        部分データの指定をTBの'/data'のクエリ文字列に変換します(static method)
+
+        Parameters
+        ----------
+        subset: tuple
+          部分データの指定(parseSubsetの戻り値)
+
+        Returns
+        -------
+        str: '&roi=...&stride=...&comp=...'形式のクエリ文字列(指定なしの場合は'')
+        '''
+        if subset is None:
+            return ''
+        roi, stride, comp = subset
+        q = ''
+        if roi is not None:
+            q += '&roi=' + ','.join([str(x) for x in roi])
+        if stride is not None:
+            q += '&stride=' + ','.join([str(x) for x in stride])
+        if comp is not None:
+            q += '&comp={}'.format(comp)
+        return q
+
+    def generateIsosurf(self, value:float, sph_lst:[SPH.SPH] =None,
+                        outdir:str =None, reldir:str ='',
+                        count:int =None, index_lst:[tuple] =None,
+                        cancel =None) -> bool:
         ''' generateIsosurf
-        現在保持しているSPHデータに対し、valueで指定された値で等値面を生成し、
+        SPHデータに対し、valueで指定された値で等値面を生成し、
         3D-Tiles形式のファイルに出力します。
+        呼び出し側で_vis_lockを獲得している必要があります。
+
+        Parameters
+        ----------
+        value: float
+          等値面を生成する値
+        sph_lst: [SPH.SPH]
+          等値面を生成するSPHデータのリスト(省略時は現在保持しているデータ)
+        outdir: str
+          出力先ディレクトリ(省略時はself._out_dir)
+        reldir: str
+          self._out_dirからのoutdirの相対パス(レイヤーリストのURLに使用)
+        count: int
+          sph_lstがイテレーターの場合のデータ数
+        index_lst: [tuple]
+          各ブロックのブリックインデックスのリスト(省略時は生成する)
+        cancel: callable
+          生成を中止するかを返す関数(TB2C_visualize.isosurfを参照)
+
+        Returns
+        -------
+        bool: True=成功、False=失敗または中止
+        '''
+        with self._lock:
+            if sph_lst is None:
+                if self._last_step < 0:
+                    return False
+                sph_lst = self._last_sph_list
+            bbox = self._meta_dic['bbox']
+        if outdir is None:
+            outdir = self._out_dir
+        self._vis = TB2C_visualize.TB2C_visualize(outdir, bbox, reldir,
+                                                  self._native)
+        if not self._vis.isosurf(sph_lst, value, pool=self._pool,
+                                 count=count, index_lst=index_lst,
+                                 cancel=cancel):
+            return False
+        return True
+
+    def setupProcPool(self, nprocs:int) -> None:
+        ''' setupProcPool
+        ブロック毎の等値面生成を行うプロセスプールを作成します。
+        nprocsが1以下の場合はプロセスプールを使用しません(逐次処理)。
+        ワーカーはHTTPサーバのスレッドから独立させるため、spawnで起動されます。
+
+        Parameters
+        ----------
+        nprocs: int
+          ワーカープロセス数
+        '''
+        self.closeProcPool()
+        if nprocs <= 1:
+            return
+        self._nprocs = nprocs
+        self._pool = ProcessPoolExecutor(
+            max_workers=nprocs, mp_context=multiprocessing.get_context('spawn'))
+        return
+
+    def closeProcPool(self) -> None:
+        ''' closeProcPool
+        プロセスプールを停止します。
+        '''
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+            self._nprocs = 1
+        return
+
+    def setupIsosurfCache(self, budget:int) -> None:
+        ''' setupIsosurfCache
+        生成した等値面(3D-Tiles)のディスクキャッシュを
+        self._out_dir/ISOCACHE_DIR配下に設定します。
+        budgetが0以下の場合はキャッシュを使用しません。
+
+        Parameters
+        ----------
+        budget: int
+          キャッシュの容量(バイト数)
+        '''
+        if budget <= 0:
+            self._isocache = None
+            return
+        self._isocache = DiskLRUCache(
+            os.path.join(self._out_dir, TB2C_server.ISOCACHE_DIR), budget)
+        return
+
+    def isosurfKey(self, step:int, value:float, subset:tuple =None,
+                   lod:int =0) -> tuple:
+        ''' isosurfKey
+        等値面キャッシュのキーを生成します。
+        キーはデータ(TBのURIとID)、タイムステップ、そのステップのファイルの
+        識別子(メタデータの'fingerprints'、パス、更新時刻、サイズによる)、
+        等値面の値、分割数と、指定された場合は部分データの指定、詳細度から
+        なります。識別子により、異なるファイルリストで再起動したTBや、
+        再生成されたデータに対して古い等値面が返されることはありません。
+
+        Parameters
+        ----------
+        step: int
+          タイムステップインデックス番号
+        value: float
+          等値面を生成する値
+        subset: tuple
+          部分データの指定(parseSubsetの戻り値)
+        lod: int
+          詳細度(0: 元の解像度)
+
+        Returns
+        -------
+        tuple: キー
+        '''
+        with self._lock:
+            fps = self._meta_dic.get('fingerprints') or []
+            fp = fps[step] if 0 <= step < len(fps) else None
+            key = (self._meta_dic['uri'], self._meta_dic['id'], step, fp,
+                   float(value), tuple(self._div))
+        if subset is not None:
+            key += (subset,)
+        if lod > 0:
+            key += (('lod', lod),)
+        return key
+
+    def status(self) -> dict:
+        ''' status
+        サーバの状態(キャッシュの統計値等)を返します。
+
+        Returns
+        -------
+        dict: サーバの状態
+        '''
+        with self._lock:
+            stat = {
+                'tb': self._tb_uri,
+                'div': list(self._div),
+                'last_step': self._last_step,
+                'procs': self._nprocs,
+                'compress': self._codec,
+            }
+        stat['cache'] = self._cache.stats()
+        stat['index_cache'] = self._index_cache.stats()
+        with self._pf_cv:
+            stat['prefetch'] = dict(self._pf_stats, window=self._pf_window,
+                                    pending=len(self._pf_queue))
+        if self._isocache is not None:
+            stat['isocache'] = self._isocache.stats()
+        return stat
+
+    def metricFamilies(self) -> []:
+        ''' metricFamilies
+        サーバのメトリクス(キャッシュのヒット率、保持しているステップ数、
+        等値面を生成した回数と段階毎の所要時間の累計、先読みの結果)を返します。
+
+        Returns
+        -------
+        [(str, str, str, [])]: HTTPMetrics.renderに渡すメトリクスのリスト
+        '''
+        caches = {'step': self._cache.stats(),
+                  'index': self._index_cache.stats()}
+        if self._isocache is not None:
+            caches['isosurf'] = self._isocache.stats()
+        with self._lock:
+            vis_count = self._vis_count
+            totals = dict(self._stage_totals)
+            last_step = self._last_step
+        with self._pf_cv:
+            pf_stats = dict(self._pf_stats)
+        return [
+            ('resident_steps', 'gauge',
+             'step data (and decimated levels) held in the cache',
+             [('', None, caches['step']['entries'])]),
+            ('resident_bytes', 'gauge', 'bytes of step data held in the cache',
+             [('', None, caches['step']['bytes'])]),
+            ('last_step', 'gauge', 'time step index visualized last',
+             [('', None, last_step)]),
+            ('visualize_total', 'counter',
+             'isosurfaces generated (not served from the isosurface cache)',
+             [('', None, vis_count)]),
+            ('visualize_stage_seconds_total', 'counter',
+             'time spent in each stage of isosurface generation',
+             [('', {'stage': k}, t) for k, t in totals.items()]),
+            ('prefetch_total', 'counter',
+             'neighbouring step data prefetched, by result',
+             [('', {'result': k}, n) for k, n in pf_stats.items()]),
+        ] + HTTPMetrics.cacheFamilies(caches)
+
+    def visualize(self, step:int, value:float, subset:tuple =None,
+                  lod:int =0, cancel =None) -> ([], str, dict):
+        ''' visualize
+        stepで指定されたタイムステップのデータを取得し、valueで指定された値で
+        等値面を生成します。可視化処理は_vis_lockにより逐次実行されます。
+        等値面キャッシュが有効な場合、生成済みの等値面はキャッシュから返されます。
+        失敗したブロックがある場合、その結果はキャッシュされません。
+        lodが1以上の場合は、各軸方向に1/2**lodに間引いたデータ(ピラミッドの
+        lod段目)から等値面を生成します(プレビュー)。等値面キャッシュが有効な
+        場合は、プレビューの生成後に元の解像度の等値面がバックグラウンドで
+        生成されます(refine)。
+        生成中のrefineは、別の等値面の要求があると中止されます(cancelRefine)。
+        各ブロックのブリックインデックス(SPH_isosurf.brickIndex)は、ステップ、
+        部分データの指定、詳細度、分割数毎にキャッシュされ、同じステップの
+        別の値の等値面の生成では、値の範囲外のブロック、ブリックが
+        データを参照せずにスキップされます。
+        付加情報の'timings'(timingInfoを参照)には、各段階の所要時間[s]が
+        記録されます。段階は'wait'(_vis_lockの待ち)、'fetch'、'decode'、
+        'decimate'、'divide'(getSPHvolume、streamSPHdataを参照)、ブロック毎の
+        'vectorMag'、'index'、'isosurf'(マーチングキューブ)、'write'(3D-Tiles
+        またはOBJの出力)、'convert'(obj23dtiles)の全ブロックの合計、
+        'generate'(全ブロックの処理の経過時間)、'total'(全体の経過時間)です。
 
         Parameters
         ----------
+        step: int
+          タイムステップインデックス番号
+        value: float
+          等値面を生成する値
+        subset: tuple
+          部分データの指定(parseSubsetの戻り値、省略時は全体)
+        lod: int
+          詳細度(0: 元の解像度、N: 1/2**Nに間引いたデータ)
+        cancel: callable
+          生成を中止するかを返す関数(refine用、省略時は中止しない)
+          指定しない場合(クライアントの要求)は、生成中のrefineを中止させます。
+
+        Returns
+        -------
+        []: 生成された3D-Tilesのレイヤーリスト、None: 失敗または中止
+        str: 失敗時のエラーメッセージ
+        dict: 付加情報('block_errors': 失敗したブロックの[ブロック番号, メッセージ]
+          のリスト、'lod': 詳細度、'refine': バックグラウンドで元の解像度の等値面を
+          生成するか、'timings': 段階毎の所要時間と頂点数、三角形数(timingInfo)、
+          'block_stats': ブロック毎の[頂点数, 三角形数]、キャッシュから返した
+          場合はNone)
+        '''
+        t_start = time.perf_counter()
+        timings = {}
+        info = {'block_errors': [], 'lod': lod, 'refine': False,
+                'timings': None, 'block_stats': None}
+        key = self.isosurfKey(step, value, subset, lod)
+        if cancel is None:
+            self.cancelRefine((step, value, subset))
+        if self._isocache is not None:
+            layerList = self._isocache.get(key)
+            if layerList is not None:
+                if lod > 0:
+                    info['refine'] = self.requestRefine(step, value, subset)
+                TB2C_server.addTiming(timings, 'total', t_start)
+                info['timings'] = TB2C_server.timingInfo(timings, cached=True)
+                return (layerList, None, info)
+
+        t0 = time.perf_counter()
+        with self._vis_lock:
+            TB2C_server.addTiming(timings, 'wait', t0)
+            if self._isocache is not None and key in self._isocache:
+                # generated while waiting for the lock (e.g. by refine)
+                layerList = self._isocache.get(key)
+                if layerList is not None:
+                    if lod > 0:
+                        info['refine'] = self.requestRefine(step, value,
+                                                            subset)
+                    TB2C_server.addTiming(timings, 'total', t_start)
+                    info['timings'] = TB2C_server.timingInfo(timings,
+                                                             cached=True)
+                    return (layerList, None, info)
+            if cancel is not None and cancel():
+                return (None, 'cancelled.', info)
+            try:
+                if lod > 0 or not self._stream:
+                    sph_lst = self.getSPHdata(self.meta_dic['id'], step,
+                                              subset, lod, timings)
+                    count = len(sph_lst) if sph_lst else 0
+                else:
+                    count, sph_lst = self.streamSPHdata(self.meta_dic['id'],
+                                                        step, subset, timings)
+            except Exception as e:
+                return (None, 'can not get SPH data: {}'.format(str(e)), info)
+            if count < 1:
+                return (None, 'can not get SPH data.', info)
+            outdir = None
+            reldir = ''
+            if self._isocache is not None:
+                # written to a temporary directory, moved into the cache by put
+                outdir = self._isocache.tempDir(key)
+                reldir = os.path.join(TB2C_server.ISOCACHE_DIR,
+                                      os.path.basename(outdir))
+            elif lod > 0:
+                reldir = 'lod{}'.format(lod)
+                outdir = os.path.join(self._out_dir, reldir)
+            with self._lock:
+                ikey = (self.meta_dic['id'], step, subset, lod,
+                        tuple(self._div))
+            t0 = time.perf_counter()
+            try:
+                ok = self.generateIsosurf(value, sph_lst, outdir, reldir,
+                                          count, self._index_cache.get(ikey),
+                                          cancel)
+            except:
+                ok = False
+                if self._isocache is not None:
+                    self._isocache.discard(outdir)
+                raise
+            if not ok:
+                if self._isocache is not None:
+                    self._isocache.discard(outdir)
+                if cancel is not None and cancel():
+                    return (None, 'cancelled.', info)
+                return (None, 'generate isosurface(s) failed.', info)
+            TB2C_server.addTiming(timings, 'generate', t0)
+            index_lst = list(self._vis._indexList)
+            nbytes = sum([ix[1].nbytes + ix[2].nbytes
+                          for ix in index_lst if ix is not None])
+            if nbytes > 0:
+                self._index_cache.put(ikey, index_lst, nbytes)
+            layerList = list(self._vis._layerList)
+            info['block_errors'] = [list(e) for e in self._vis._errList]
+            TB2C_server.addTiming(timings, 'total', t_start)
+            info['timings'] = TB2C_server.timingInfo(timings,
+                                                     self._vis._statList)
+            info['block_stats'] = TB2C_server.blockStats(self._vis._statList)
+            with self._lock:
+                self._vis_count += 1
+                for stage, t in info['timings']['stages'].items():
+                    self._stage_totals[stage] \
+                        = self._stage_totals.get(stage, 0.0) + t
+            if info['block_errors']:
+                if self._isocache is None:
+                    pass
+                elif layerList:
+                    self.keepPartial(outdir)
+                else:
+                    self._isocache.discard(outdir)
+                if not layerList:
+                    return (None, 'generate isosurface failed in all blocks'
+                            ' with surface: {}'.format(info['block_errors']),
+                            info)
+            elif self._isocache is not None:
+                layerList = TB2C_server.relocateLayers(
+                    layerList, reldir, os.path.join(
+                        TB2C_server.ISOCACHE_DIR, DiskLRUCache.keyName(key)))
+                self._isocache.put(key, layerList, outdir)
+            if lod > 0 and self._isocache is not None:
+                # requested after the preview so that it does not take the lock
+                info['refine'] = self.requestRefine(step, value, subset)
+            return (layerList, None, info)
+
+    @staticmethod
+    def relocateLayers(layerList:[dict], src:str, dst:str) -> [dict]:
+        ''' relocateLayers
+        レイヤーリストのURLの、出力先ディレクトリの相対パスsrcをdstに
+        置き換えます(static method)
+
+        Parameters
+        ----------
+        layerList: [dict]
+          レイヤーリスト
+        src: str
+          置き換える相対パス
+        dst: str
+          置き換え後の相対パス
+
+        Returns
+        -------
+        [dict]: 置き換えたレイヤーリスト
+        '''
+        src = src.rstrip('/') + '/'
+        dst = dst.rstrip('/') + '/'
+        res = []
+        for layer in layerList:
+            layer = dict(layer)
+            layer['url'] = layer['url'].replace('/' + src, '/' + dst, 1)
+            res.append(layer)
+            continue # end of for(layer)
+        return res
+
+    def keepPartial(self, outdir:str) -> None:
+        ''' keepPartial
+        失敗したブロックがあり、キャッシュに登録しない等値面の一時ディレクトリを
+        保持し(応答したレイヤーリストが参照するため)、最近のPARTIAL_KEEP個より
+        古いものを削除します。
+        保持したディレクトリは、削除されなくとも次回起動時に等値面キャッシュ
+        から削除されます(DiskLRUCache.sweep)。
+
+        Parameters
+        ----------
+        outdir: str
+          保持する一時ディレクトリ
+        '''
+        with self._lock:
+            self._partial_dirs.append(outdir)
+            old = self._partial_dirs[:-TB2C_server.PARTIAL_KEEP]
+            del self._partial_dirs[:-TB2C_server.PARTIAL_KEEP]
+        for d in old:
+            self._isocache.discard(d)
+        return
+
+    def requestRefine(self, step:int, value:float, subset:tuple =None) -> bool:
+        ''' requestRefine
+        元の解像度の等値面の生成(refine)をバックグラウンドのスレッドに依頼します。
+        未処理の依頼は最新の1件のみ保持され(古い依頼は破棄されます)、
+        生成された等値面は等値面キャッシュに登録されます。
+        同じ等値面を生成中の場合は依頼しません。
+
+        Parameters
+        ----------
+        step: int
+          タイムステップインデックス番号
         value: float
           等値面を生成する値
+        subset: tuple
+          部分データの指定
 
         Returns
         -------
-        bool: True=成功、False=失敗
+        bool: True=依頼した、False=生成済み(キャッシュに存在する)
         '''
-        if self._last_step < 0:
+        if self._isocache is None:
             return False
-        self._vis = TB2C_visualize.TB2C_visualize(self._out_dir,
-                                                  self._meta_dic['bbox'])
-        if not self._vis.isosurf(self._last_sph_list, value):
+        if self.isosurfKey(step, value, subset) in self._isocache:
             return False
+        with self._refine_cv:
+            if self._refine_run == (step, value, subset) and \
+               not self._refine_cancel.is_set():
+                return True
+            self._refine_req = (step, value, subset)
+            if self._refine_th is None:
+                self._refine_th = threading.Thread(target=self.refineWorker)
+                self._refine_th.daemon = True
+                self._refine_th.start()
+            self._refine_cv.notify()
         return True
 
+    def cancelRefine(self, target:tuple) -> None:
+        ''' cancelRefine
+        生成中のrefineがtargetと異なる等値面であれば中止させます。
+        中止はブロック毎に確認されるため(TB2C_visualize.isosurf)、
+        後続の要求は_vis_lockを長く待たずに処理されます。
+
+        Parameters
+        ----------
+        target: tuple
+          要求された等値面(step, value, subset)
+        '''
+        with self._refine_cv:
+            if self._refine_run is not None and self._refine_run != target:
+                self._refine_cancel.set()
+        return
+
+    def refineWorker(self) -> None:
+        ''' refineWorker
+        バックグラウンドで元の解像度の等値面を生成するスレッドの処理です。
+        生成はcancelRefineにより中止されることがあります。
+        '''
+        while True:
+            with self._refine_cv:
+                while self._refine_req is None:
+                    self._refine_cv.wait()
+                step, value, subset = self._refine_req
+                self._refine_req = None
+                self._refine_run = (step, value, subset)
+                self._refine_cancel.clear()
+            try:
+                layerList, msg, info = self.visualize(
+                    step, value, subset, cancel=self._refine_cancel.is_set)
+            except Exception as e:
+                layerList, msg = None, str(e)
+            with self._refine_cv:
+                self._refine_run = None
+            if layerList is None:
+                print('refine: step {}, value {}: {}'.format(step, value, msg))
+            continue # end of while
+
+    def setupPrefetch(self, window:int) -> None:
+        ''' setupPrefetch
+        前後のタイムステップの先読みを設定します。
+        windowが0以下の場合は先読みしません。
+
+        Parameters
+        ----------
+        window: int
+          先読みする前後のステップ数(1: N-1とN+1)
+        '''
+        with self._pf_cv:
+            self._pf_window = max(0, window)
+            self._pf_queue = []
+        return
+
+    def requestPrefetch(self, step:int, subset:tuple =None, lod:int =0,
+                        start:bool =True) -> bool:
+        ''' requestPrefetch
+        stepの前後window個のタイムステップのデータの先読みを、バックグラウンドの
+        スレッドに依頼します。未処理の依頼は破棄され、取得中の先読みもstepの前後
+        window個の範囲外となった場合は中止されます。
+        同じstep, subsetに対して要求された詳細度の段が先読みされます
+        (1以上の段が先に、N+1, N-1, N+2, N-2, ...の順)。
+        startがFalseの場合は、範囲外の先読みの中止のみ行い、先読みを開始しません
+        (可視化要求の処理中にTBとの通信が競合しないようにするため)。
+
+        Parameters
+        ----------
+        step: int
+          要求されたタイムステップインデックス番号
+        subset: tuple
+          部分データの指定(parseSubsetの戻り値)
+        lod: int
+          要求された詳細度
+        start: bool
+          先読みを開始するか
+
+        Returns
+        -------
+        bool: True=依頼した、False=先読みしない設定、または接続していない
+        '''
+        with self._lock:
+            if not self._meta_dic:
+                return False
+            id = self._meta_dic['id']
+            nstep = self._meta_dic['steps']
+        with self._pf_cv:
+            if self._pf_window < 1:
+                return False
+            if self._pf_center != (step, subset):
+                self._pf_lods = set()
+            self._pf_center = (step, subset)
+            self._pf_lods.add(lod)
+            self._pf_queue = []
+            if not start:
+                return True
+            levels = sorted(self._pf_lods, reverse=True)
+            for d in range(1, self._pf_window + 1):
+                for stp in (step + d, step - d):
+                    if 0 <= stp < nstep:
+                        self._pf_queue.extend(
+                            [(id, stp, subset, lv) for lv in levels])
+                    continue # end of for(stp)
+                continue # end of for(d)
+            if self._pf_th is None:
+                self._pf_th = threading.Thread(target=self.prefetchWorker)
+                self._pf_th.daemon = True
+                self._pf_th.start()
+            self._pf_cv.notify()
+        return True
+
+    def isPrefetchRelevant(self, key:tuple) -> bool:
+        ''' isPrefetchRelevant
+        先読みのkeyが、最新の要求のステップの前後window個の範囲内か返します。
+
+        Parameters
+        ----------
+        key: tuple
+          キャッシュのキー(id, step, subset, level)
+
+        Returns
+        -------
+        bool: True=範囲内
+        '''
+        with self._pf_cv:
+            if self._pf_center is None:
+                return False
+            step, subset = self._pf_center
+            return key[2] == subset and \
+                abs(key[1] - step) <= self._pf_window
+
+    def prefetchUsed(self, key:tuple) -> None:
+        ''' prefetchUsed
+        キャッシュから返したデータが先読みしたものであれば、使用された数に
+        計上します。
+
+        Parameters
+        ----------
+        key: tuple
+          キャッシュのキー
+        '''
+        with self._pf_cv:
+            if key in self._pf_fetched:
+                self._pf_fetched.discard(key)
+                self._pf_stats['used'] += 1
+        return
+
+    def prefetchWorker(self) -> None:
+        ''' prefetchWorker
+        バックグラウンドで先読みを行うスレッドの処理です。
+        先読みしたデータはキャッシュ(_cache)に格納されます。
+        取得中に範囲外となった先読みは、スラブの受信毎に確認して中止されます。
+        '''
+        while True:
+            with self._pf_cv:
+                while not self._pf_queue:
+                    self._pf_cv.wait()
+                key = self._pf_queue.pop(0)
+            if key in self._cache:
+                continue
+            cancel = lambda: not self.isPrefetchRelevant(key)
+            try:
+                sph = self.getSPHvolume(*key, cancel=cancel)
+            except Exception as e:
+                print('prefetch: step {}: {}'.format(key[1], str(e)))
+                sph = None
+            with self._pf_cv:
+                if sph is not None:
+                    self._pf_stats['fetched'] += 1
+                    self._pf_fetched = set(
+                        [k for k in self._pf_fetched if k in self._cache])
+                    self._pf_fetched.add(key)
+                elif cancel():
+                    self._pf_stats['cancelled'] += 1
+                else:
+                    self._pf_stats['failed'] += 1
+            continue # end of while
+
 #-----------------------------------------------------------------------------
-class TB2C_server_ReqHandler(SimpleHTTPRequestHandler):
+class TB2C_server_ReqHandler(MetricsHandlerMixin, SimpleHTTPRequestHandler):
     ''' TB2C_server_ReqHandler
     TB2C server用のHTTPリクエストハンドラー実装クラスです。
+    リクエスト数、処理時間等はパス毎にサーバのHTTPMetricsに集計されます。
     '''
+    METRICS_PATHS = ('/', '/status', '/metrics', '/visualize', '/quit')
+    METRICS_PREFIXES = ('/visualized/',)
+
     def sendMsgRes(self, code:int, msg:str):
         ''' sendMsgRes
         HTTPアクセスに対するtext/plain形式のレスポンスを返す。
@@ -187,6 +1309,9 @@ class TB2C_server_ReqHandler(SimpleHTTPRequestHandler):
         ''' do_GET
         GETメソッド用のリクエストハンドラー
         要求されたパスが'/'の場合はメタデータを返し、'/quit'の場合は終了します。
+        '/status'の場合はキャッシュの統計値(ヒット/ミス/破棄数等)を返します。
+        '/metrics'の場合は、リクエストとキャッシュ等のメトリクスを
+        Prometheusのテキスト形式で返します。
         '''
         global g_app
         parsed_path = urlparse(self.path)
@@ -214,6 +1339,25 @@ class TB2C_server_ReqHandler(SimpleHTTPRequestHandler):
             self.wfile.write(body)
             return
 
+        elif parsed_path.path in ('/status', '/status/'):
+            # 状態要求 --- キャッシュの統計値を返す
+            if not g_app:
+                msg = 'no meta-data has hold.'
+                self.sendMsgRes(412, msg)
+                return
+            body = bytes(json.dumps(g_app.status()), 'utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-length', len(body))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        elif parsed_path.path == '/metrics':
+            # メトリクス要求
+            self.sendMetrics('tb2c', g_app.metricFamilies() if g_app else [])
+            return
+
         elif parsed_path.path == '/favicon.ico':
             # ignore
             return
@@ -238,7 +1382,8 @@ class TB2C_server_ReqHandler(SimpleHTTPRequestHandler):
                 if res_bin.decode() != 'ok':
                     msg += ' (TB not stopped)'
             self.sendMsgRes(200, msg)
-            sys.exit(0)
+            self.server.shutdownLater()
+            return
 
         msg = 'invalid URL specified.'
         self.sendMsgRes(404, msg)
@@ -248,6 +1393,21 @@ class TB2C_server_ReqHandler(SimpleHTTPRequestHandler):
         ''' do_POST
         POSTメソッド用のリクエストハンドラー
         要求されたパスが'/visualize'の場合はパラメータに従い可視化を行います。
+        visparamに'roi', 'stride', 'comp'が指定された場合は、TBからその部分データ
+        のみを取得して可視化します。
+        visparamに'lod'(N>0)が指定された場合は、1/2**Nに間引いたデータから
+        プレビューの等値面を生成し、レスポンスヘッダー'X-TB2C-LOD'にNを返します。
+        元の解像度の等値面がバックグラウンドで生成される場合は、
+        'X-TB2C-Refine: pending'を返します。
+        一部のブロックの処理に失敗した場合、[ブロック番号, エラーメッセージ]の
+        リスト(JSON)がレスポンスヘッダー'X-TB2C-Block-Errors'に格納されます。
+        各段階の所要時間と頂点数、三角形数の合計、最大のブロック
+        (TB2C_server.timingInfo)はJSONでレスポンスヘッダー'X-TB2C-Timings'に
+        格納されます。ヘッダーの大きさは分割数によりません。
+        visparamに'block_stats': trueが指定された場合は、レスポンスボディが
+        {'layers': レイヤーリスト, 'block_stats': ブロック毎の[頂点数, 三角形数]}
+        になります(等値面キャッシュから返した場合の'block_stats'はnull)。
+        応答した後、前後のタイムステップのデータの先読みを依頼します。
         '''
         content_length = int(self.headers['content-length'])
         parsed_path = urlparse(self.path)
@@ -274,15 +1434,21 @@ class TB2C_server_ReqHandler(SimpleHTTPRequestHandler):
                 msg = 'visparam[value] access failed.'
                 self.sendMsgRes(412, msg)
                 return
-
-            # get data of step, and do visualize
-            sph_lst = g_app.getSPHdata(g_app.meta_dic['id'], step)
-            if len(sph_lst) < 1:
-                msg = 'can not get SPH data.'
+            try:
+                subset = TB2C_server.parseSubset(visparam)
+                block_stats = bool(visparam.get('block_stats', False))
+                lod = int(visparam.get('lod', 0))
+                if lod < 0:
+                    raise ValueError('lod')
+            except:
+                msg = 'visparam[roi|stride|comp|lod] invalid.'
                 self.sendMsgRes(412, msg)
                 return
-            if not g_app.generateIsosurf(isoval):
-                msg = 'generate isosurface(s) failed.'
+
+            # get data of step, and do visualize
+            g_app.requestPrefetch(step, subset, lod, start=False)
+            layerList, msg, info = g_app.visualize(step, isoval, subset, lod)
+            if layerList is None:
                 self.sendMsgRes(412, msg)
                 return
             
@@ -292,13 +1458,31 @@ class TB2C_server_ReqHandler(SimpleHTTPRequestHandler):
             return
 
         # ok
-        meta_str = json.dumps(g_app._vis._layerList)
+        if block_stats:
+            meta_str = json.dumps({'layers': layerList,
+                                   'block_stats': info['block_stats']})
+        else:
+            meta_str = json.dumps(layerList)
         body = bytes(meta_str, 'utf-8')
         self.send_response(200)
         self.send_header('Content-Type', 'application/json')
         self.send_header('Content-length', len(body))
+        if info['block_errors']:
+            self.send_header('X-TB2C-Block-Errors',
+                             json.dumps(info['block_errors']))
+        self.send_header('X-TB2C-LOD', str(info['lod']))
+        if info['refine']:
+            self.send_header('X-TB2C-Refine', 'pending')
+        if info['timings']:
+            self.send_header('X-TB2C-Timings',
+                             json.dumps(info['timings'],
+                                        separators=(',', ':')))
         self.end_headers()
         self.wfile.write(body)
+        self.wfile.flush()
+
+        # prefetch the neighbouring steps after the response
+        g_app.requestPrefetch(step, subset, lod)
         return
 
 
@@ -310,8 +1494,13 @@ if __name__ == '__main__':
     # parse argv
     parser = argparse.ArgumentParser(description='TB2C server',
       usage='%(prog)s [--port 4000] [--tb http://localhost:4001/]'\
-        + '\n        [--odir ./] [--dx divX] [--dy divY] [--dz divZ]')
+        + '\n        [--odir ./] [--dx divX] [--dy divY] [--dz divZ]'\
+        + '\n        [--cache-mb 1024] [--isocache-mb 1024] [--workers 4]'\
+        + '\n        [--procs 1] [--prefetch 1] [--obj23dtiles] [--no-stream]'\
+        + '\n        [--compress {zlib,lzma}]')
     parser.add_argument('--port', help='port number', type=int, default='4000')
+    parser.add_argument('--workers', help='number of HTTP worker threads',
+                        type=int, default=4)
     parser.add_argument('--tb', help='URL of TB to connect', type=str,
                         default='http://localhost:4001/')
     parser.add_argument('--odir', type=str, default='.',
@@ -322,12 +1511,38 @@ if __name__ == '__main__':
                         help='Number of divisions in the Y-axis direction')
     parser.add_argument('--dz', type=int, default=1,
                         help='Number of divisions in the Z-axis direction')
+    parser.add_argument('--cache-mb', type=int, default=1024,
+                        help='Memory budget of the step data cache in MB')
+    parser.add_argument('--isocache-mb', type=int, default=1024,
+                        help='Disk budget of the isosurface cache in MB'\
+                        + ' (0: disabled)')
+    parser.add_argument('--procs', type=int, default=1,
+                        help='Number of processes generating isosurfaces of'\
+                        + ' divided blocks in parallel (1: sequential)')
+    parser.add_argument('--prefetch', type=int, default=1,
+                        help='Number of time steps before and after the'\
+                        + ' requested one to prefetch from TB (0: disabled)')
+    parser.add_argument('--no-stream', action='store_true',
+                        help='Fetch step data from TB in one piece instead of'\
+                        + ' streaming z-slabs')
+    parser.add_argument('--compress', choices=SPH_binary.CODECS, default=None,
+                        help='Request z-slabs from TB compressed with the'\
+                        + ' codec (after byte-shuffle)')
+    parser.add_argument('--obj23dtiles', action='store_true',
+                        help='Convert isosurfaces to 3D-Tiles with obj23dtiles'\
+                        + ' command instead of the native writer')
     args = parser.parse_args()
 
     # create TB2C_server and get metadata
-    g_app = TB2C_server()
+    g_app = TB2C_server(cache_bytes=args.cache_mb*1024*1024)
     g_app._div[:] = [args.dx, args.dy, args.dz]
     g_app._out_dir = args.odir
+    g_app._native = not args.obj23dtiles
+    g_app._stream = not args.no_stream
+    g_app._codec = args.compress
+    g_app.setupIsosurfCache(args.isocache_mb*1024*1024)
+    g_app.setupProcPool(args.procs)
+    g_app.setupPrefetch(args.prefetch)
     try:
         g_app.connectTB(args.tb)
     except Exception as e:
@@ -338,15 +1553,19 @@ if __name__ == '__main__':
     host = '0.0.0.0'
     port = args.port
     try:
-        httpd = HTTPServer((host, port), TB2C_server_ReqHandler)
+        httpd = PooledHTTPServer((host, port), TB2C_server_ReqHandler,
+                                 nworkers=args.workers)
     except Exception as e:
         print('{}: invoke httpd failed: {}'.format(prog, str(e)))
         sys.exit(1)
-    print('{}: started at http://localhost:{}/'.format(prog, port))
+    print('{}: started at http://localhost:{}/ ({} workers)'\
+          .format(prog, port, httpd.nworkers))
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
-        sys.exit(0)
+        pass
+    httpd.server_close()
+    g_app.closeProcPool()
 
     sys.exit(0)
     
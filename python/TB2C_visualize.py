@@ -7,13 +7,18 @@ import os, sys
 import shutil
 import json
 import subprocess
+import threading
+import time
 from math import log10
+from concurrent.futures import Executor
 from collections import OrderedDict as OD
+import numpy as np
 
 from utilMath import *
 from pySPH import SPH
 from SPH_isosurf import SPH_isosurf
 from SPH_filter import SPH_filter
+from tiles3d import Tiles3D
 
 LONG = 6378137.0
 
@@ -21,13 +26,23 @@ LONG = 6378137.0
 class TB2C_visualize:
     ''' TB2C_visualize:
     TB2Cサーバ用の、可視化機能実装クラスです。
-    SPHデータに対する可視化(等値面生成)結果をジオメトリ(OBJ)ファイルに出力し、
-    obj23dtilesコマンドを使用して3D-Tilesに変換します。
+    SPHデータに対する可視化(等値面生成)結果を、Tiles3Dを使用して直接
+    3D-Tiles(b3dm, tileset.json)に出力します。
+    native=Falseの場合は、ジオメトリ(OBJ)ファイルに出力し、obj23dtilesコマンドを
+    使用して3D-Tilesに変換します。
     '''
-    def __init__(self, outdir:str ='.', bbox =[[0,0,0],[1,1,1]]):
+    _local = threading.local() # per-thread work buffers of isosurfBlock
+
+    def __init__(self, outdir:str ='.', bbox =[[0,0,0],[1,1,1]],
+                 reldir:str ='', native:bool =True):
         self._outDir = outdir
+        self._relDir = reldir
+        self._native = native
         self._obj23dt_ver = None
         self._layerList = []
+        self._errList = []
+        self._indexList = []
+        self._statList = []
         self._bbox = [Vec3(bbox[0]), Vec3(bbox[1])]
         return
 
@@ -68,9 +83,10 @@ class TB2C_visualize:
             return False
         return True
 
-    def bbox2Box(self, bbox:[[float],[float]]) -> [float]:
+    @staticmethod
+    def bbox2Box(bbox:[[float],[float]]) -> [float]:
         ''' bbox2Box
-        バウンディングボックスデータを、3D-Tileの"Box"形式に変換します。
+        バウンディングボックスデータを、3D-Tileの"Box"形式に変換します(static method)
 
         Parameters
         ----------
@@ -90,14 +106,283 @@ class TB2C_visualize:
         box.extend([0.0, 0.0, hl[2]])
         return box
 
+    @staticmethod
+    def obj23dtiles(obj_path:str, ts_path:str, bbox:[[float],[float]],
+                    v:[float], f:[int], n:[float], times:dict =None) -> bool:
+        ''' obj23dtiles
+        等値面をOBJファイルに出力し、obj23dtilesコマンドを使用して3D-Tilesに
+        変換した後、tileset.jsonを修正します(static method)
+
+        Parameters
+        ----------
+        obj_path: str
+          OBJファイルのパス
+        ts_path: str
+          obj23dtilesが出力するtileset.jsonのパス
+        bbox: [[float],[float]]
+          等値面のバウンディングボックス
+        v: float[]
+          等値面の頂点リスト
+        f: int[]
+          等値面の三角形の頂点リスト
+        n: float[]
+          等値面の頂点の法線ベクトルリスト
+        times: dict
+          指定された場合、OBJファイルの出力('write')と3D-Tilesへの変換
+          ('convert')の所要時間[s]を格納する
+
+        Returns
+        -------
+        bool: True=成功、False=失敗
+        '''
+        t0 = time.perf_counter()
+        # save objfile
+        try:
+            obj_f = open(obj_path, 'w')
+            SPH_isosurf.saveOBJ(obj_f, v, f, n)
+            obj_f.close()
+        except Exception as e:
+            return False
+        t1 = time.perf_counter()
+        # convert to b3dm
+        print('exec: obj23dtiles --tileset -i {} ... '\
+              .format(obj_path), end='')
+        sys.stdout.flush()
+        try:
+            subprocess.call(['obj23dtiles', '--tileset', '-i', obj_path])
+        except Exception as e:
+            return False
+        # remove objfile
+        os.remove(obj_path)
+
+        # modify tileset.json
+        try:
+            ts_f = open(ts_path, 'r')
+            ts_dict = json.load(ts_f, object_pairs_hook=OD)
+            ts_f.close()
+        except Exception as e:
+            return False
+        ts_dict['asset']['gltfUpAxis'] = 'Z'
+        ts_dict['root']['transform'] = [
+            1, 0, 0, 0,  0, 1, 0, 0,  0, 0, 1, 0,  0, 0, 0, 1]
+        ts_dict['root']['boundingVolume']['box'] \
+            = TB2C_visualize.bbox2Box(bbox)
+        del ts_dict['root']['boundingVolume']['region']
+        try:
+            ts_f = open(ts_path, 'w')
+            json.dump(ts_dict, ts_f, indent=4)
+            ts_f.close()
+        except Exception as e:
+            return False
+        if times is not None:
+            times['write'] = t1 - t0
+            times['convert'] = time.perf_counter() - t1
+        return True
+
+    @staticmethod
+    def workBuffer(size:int, dtype) -> np.ndarray:
+        ''' workBuffer
+        スレッド(プロセス)毎に再利用される作業用配列を返します(static method)
+        同じdtypeで要求された中で最大のサイズの配列を保持し、その先頭sizeの要素を
+        返すため、ブロック毎のvectorMagの結果の領域が使い回されます。
+
+        Parameters
+        ----------
+        size: int
+          要素数
+        dtype: numpy.dtype
+          要素の型
+
+        Returns
+        -------
+        numpy.ndarray: 1次元の連続配列
+        '''
+        bufs = getattr(TB2C_visualize._local, 'bufs', None)
+        if bufs is None:
+            bufs = TB2C_visualize._local.bufs = {}
+        dtype = np.dtype(dtype)
+        buf = bufs.get(dtype)
+        if buf is None or buf.size < size:
+            buf = bufs[dtype] = np.empty(size, dtype=dtype)
+        return buf[:size]
+
+    @staticmethod
+    def outOfRange(index:tuple, value:float) -> bool:
+        ''' outOfRange
+        ブリックインデックスから、ブロックの値の範囲がvalueを含まない(等値面が
+        ない)ことが分かるかを返します(static method)
+
+        Parameters
+        ----------
+        index: tuple
+          ブロックのブリックインデックス(None可)
+        value: float
+          等値面を生成する値
+
+        Returns
+        -------
+        bool: True=等値面なし、False=不明(indexがない)または範囲内
+        '''
+        if index is None:
+            return False
+        vmin, vmax = SPH_isosurf.indexRange(index)
+        return not vmin <= value <= vmax
+
+    @staticmethod
+    def isosurfBlock(sph:SPH.SPH, value:float, scale:float, trans:[float],
+                     b3dmDir:str, path_base:str, native:bool =True,
+                     index:tuple =None) -> (bool, str, tuple, dict):
+        ''' isosurfBlock
+        1ブロックのSPHデータに対して等値面を生成し、正規化した後に
+        b3dmDir/Batchedpath_base/tileset.jsonとして3D-Tilesに出力します(static method)
+        プロセスプールのワーカーからも呼び出せるよう、インスタンスの状態を参照しません。
+        valueがブロックの値の範囲外の場合は、等値面なし(エラーではない)となります。
+        等値面はブロックのブリックインデックス(SPH_isosurf.brickIndex、ベクトルの
+        場合は大きさのもの)のアクティブなブリックについてのみ生成されます。
+        indexが指定された場合、値の範囲外のブロックはデータを参照せずに
+        等値面なしとなります。指定されない場合は生成して返します。
+        各段階の所要時間と等値面の頂点数、三角形数は統計値として返されます。
+
+        Parameters
+        ----------
+        sph: SPH.SPH
+          等値面を生成するSPHデータ(ベクトルの場合は大きさを使用)
+        value: float
+          等値面を生成する値
+        scale: float
+          頂点座標の拡大率
+        trans: [float]
+          拡大後の頂点座標の平行移動量
+        b3dmDir: str
+          出力先ディレクトリ
+        path_base: str
+          出力ファイルのベース名
+        native: bool
+          True=Tiles3Dで出力、False=obj23dtilesコマンドで変換
+        index: tuple
+          ブロックのブリックインデックス(省略時は生成する)
+
+        Returns
+        -------
+        bool: True=等値面を出力した、False=等値面なしまたは失敗
+        str: 失敗時のエラーメッセージ、None: 成功または等値面なし
+        tuple: ブロックのブリックインデックス、None: 生成できなかった
+        dict: 統計値('verts': 頂点数、'tris': 三角形数、'times': 段階名
+          ('vectorMag', 'index', 'isosurf', 'write', 'convert')をキーとする
+          所要時間[s]、実行した段階のみ)
+        '''
+        obj_path = os.path.join(b3dmDir, path_base + '.obj')
+        ts_path = os.path.join(b3dmDir, 'Batched'+path_base, 'tileset.json')
+        stat = {'verts': 0, 'tris': 0, 'times': {}}
+        times = stat['times']
+        # generate isosurface
+        try:
+            if TB2C_visualize.outOfRange(index, value):
+                return (False, None, index, stat) # empty
+            if sph._veclen == 1:
+                xsph = sph
+            else:
+                t0 = time.perf_counter()
+                dimSz = sph._dims[0] * sph._dims[1] * sph._dims[2]
+                ftype = np.float64 if sph._dtype == SPH.SPH.DT_DOUBLE \
+                        else np.float32
+                xsph = SPH_filter.vectorMag(
+                    sph, out=TB2C_visualize.workBuffer(dimSz, ftype))
+                times['vectorMag'] = time.perf_counter() - t0
+            if xsph is None:
+                return (False, 'vectorMag failed', index, stat)
+            if index is None:
+                t0 = time.perf_counter()
+                index = SPH_isosurf.brickIndex(xsph)
+                if index is not None:
+                    vmin, vmax = SPH_isosurf.indexRange(index)
+                else:
+                    vmin = np.nanmin(xsph._data)
+                    vmax = np.nanmax(xsph._data)
+                times['index'] = time.perf_counter() - t0
+                if not vmin <= value <= vmax:
+                    return (False, None, index, stat) # empty
+            t0 = time.perf_counter()
+            v, f, n = SPH_isosurf.generate(xsph, value, index)
+            times['isosurf'] = time.perf_counter() - t0
+        except Exception as e:
+            return (False, 'generate failed: {}'.format(str(e)), index, stat)
+        if v is None or len(v) < 1 or len(f) < 1:
+            return (False, None, index, stat) # empty
+        stat['verts'] = len(v)
+        stat['tris'] = len(f)
+        # normalize vertices
+        t0 = time.perf_counter()
+        v = v * scale
+        v = v + trans
+        bbox = [[v[:,0].min(), v[:,1].min(), v[:,2].min()],
+                [v[:,0].max(), v[:,1].max(), v[:,2].max()]]
+        # write 3D-Tiles
+        if native:
+            ok = Tiles3D.write(ts_path, path_base + '.b3dm',
+                               TB2C_visualize.bbox2Box(bbox), v, f, n)
+            times['write'] = time.perf_counter() - t0
+            if not ok:
+                return (False, 'write 3D-Tiles failed', index, stat)
+        elif not TB2C_visualize.obj23dtiles(obj_path, ts_path, bbox, v, f, n,
+                                            times):
+            return (False, 'obj23dtiles conversion failed', index, stat)
+        return (True, None, index, stat)
+
+    @staticmethod
+    def sumStats(stat_lst:[dict]) -> dict:
+        ''' sumStats
+        isosurfBlockが返したブロック毎の統計値を集計します(static method)
+        所要時間は全ブロックの合計のため、プロセスプールで並行して処理した場合は
+        経過時間より大きくなります。
+
+        Parameters
+        ----------
+        stat_lst: [dict]
+          ブロック毎の統計値のリスト(Noneは無視されます)
+
+        Returns
+        -------
+        dict: 'verts', 'tris': 全ブロックの合計、'times': 段階毎の所要時間の合計[s]
+        '''
+        total = {'verts': 0, 'tris': 0, 'times': {}}
+        for stat in stat_lst:
+            if stat is None:
+                continue
+            total['verts'] += stat['verts']
+            total['tris'] += stat['tris']
+            for stage, t in stat['times'].items():
+                total['times'][stage] = total['times'].get(stage, 0.0) + t
+            continue # end of for(stat)
+        return total
+
     def isosurf(self, sph_lst:[SPH.SPH], value:float,
-                fnbase:str='isosurf') -> bool:
+                fnbase:str='isosurf', pool:Executor =None,
+                count:int =None, index_lst:[tuple] =None,
+                cancel =None) -> bool:
         ''' isosurf
         sph_lstで渡されたSPHデータ群に対し、valueで指定された値で等値面を生成し、
-        OBJファイルに出力した後、obj23dtilesコマンドを使用して3D-Tilesに変換します。
+        3D-Tilesに出力します(self._nativeがFalseの場合はOBJファイルに出力した後、
+        obj23dtilesコマンドを使用して3D-Tilesに変換します)。
         self._out_dir配下に、以下のファイルが作成されます。
           b3dm/Batchedfnbase_nnn/fnbase_nnn.b3dm
           b3dm/Batchedfnbase_nnn/tileset.json
+        レイヤーリストのURLには、self._relDir(公開ディレクトリからの
+        self._outDirの相対パス)が前置されます。
+        poolが指定された場合、各ブロックはpool(ProcessPoolExecutor等)で
+        並行して処理されますが、レイヤーリストはブロック順に作成されます。
+        sph_lstはイテレーター(ブロックの受信順に生成するもの等)でも良く、その場合は
+        countにブロック数を指定します。各ブロックは取り出され次第処理されます。
+        失敗したブロック(イテレーターが途中で終了した場合の残りのブロックを含む)は
+        (ブロック番号, エラーメッセージ)としてself._errListに記録されます。
+        各ブロックのブリックインデックスはself._indexListに記録されるため、
+        同じデータに対する次回の呼び出しでindex_lstとして渡すことができます。
+        各ブロックの統計値(isosurfBlockを参照、処理されなかったブロックはNone)は
+        self._statListに記録されます。
+        index_lstから値の範囲外と分かるブロックは、poolに渡さずに(データを
+        ワーカーに送らずに)等値面なしとします。
+        cancelが指定された場合、ブロック毎にcancel()を確認し、Trueを返せば
+        未処理のブロック(poolで実行待ちのものを含む)を中止してFalseを返します。
 
         Parameters
         ----------
@@ -107,17 +392,33 @@ class TB2C_visualize:
           等値面を生成する値
         fnbase: str
           等値面ファイルのベース名(省略時:"isosurf")
+        pool: concurrent.futures.Executor
+          ブロック毎の処理を実行するExecutor(省略時は逐次処理)
+        count: int
+          ブロック数(省略時はlen(sph_lst))
+        index_lst: [tuple]
+          各ブロックのブリックインデックスのリスト(省略時は生成する)
+        cancel: callable
+          生成を中止するかを返す関数(省略時は中止しない)
 
         Returns
         -------
-        bool: True=成功、False=失敗
+        bool: True=成功、False=失敗または中止
         '''
-        if len(sph_lst) < 1:
+        self._layerList = []
+        self._errList = []
+        self._indexList = []
+        self._statList = []
+        if count is None:
+            count = len(sph_lst)
+        if count < 1:
             return False
-        ndigit = int(log10(len(sph_lst)) +1)
+        if index_lst is None or len(index_lst) != count:
+            index_lst = [None] * count
+        ndigit = int(log10(count) +1)
         if not self.checkB3dmDir():
             return False
-        if not self.checkObj23dtiles():
+        if not self._native and not self.checkObj23dtiles():
             return False
 
         whole_bbox = self._bbox
@@ -125,73 +426,64 @@ class TB2C_visualize:
         scale = LONG * 2 / bblen / 1.732 if bblen > 1e-8 else 1.0
         centr = (whole_bbox[1] + whole_bbox[0]) * 0.5
         trans = centr * (-scale)
-        
-        self._layerList = []
+
         b3dmDir = os.path.join(self._outDir, 'b3dm')
-        cnt = 0
-        for sph in sph_lst:
-            # pathes
-            path_base = fnbase+'_{}'.format(str(cnt).zfill(ndigit))
-            obj_path = os.path.join(b3dmDir, path_base + '.obj')
-            ts_path = os.path.join(b3dmDir, 'Batched'+path_base, 'tileset.json')
-            ts_rpath = os.path.join('b3dm', 'Batched'+path_base, 'tileset.json')
-            # generate isosurface
-            if sph._veclen == 1:
-                xsph = sph
-            else:
-                xsph = SPH_filter.vectorMag(sph)
-            try:
-                v, f, n = SPH_isosurf.generate(xsph, value)
-            except Exception as e: # maybe empty
-                cnt += 1
-                continue
-            # normalize vertices
-            v = v * scale
-            v = v + trans.m_v
-            # save objfile
-            try:
-                obj_f = open(obj_path, 'w')
-                SPH_isosurf.saveOBJ(obj_f, v, f, n)
-                obj_f.close()
-            except Exception as e:
-                cnt += 1
-                continue
-            # convert to b3dm
-            print('exec: obj23dtiles --tileset -i {} ... '\
-                  .format(obj_path), end='')
-            sys.stdout.flush()
+        path_bases = [fnbase+'_{}'.format(str(cnt).zfill(ndigit))
+                      for cnt in range(count)]
+        results = [(False, 'block data not received', None, None)] * count
+        futures = []
+        cancelled = False
+        try:
+            for cnt, sph in enumerate(sph_lst):
+                if cnt >= count:
+                    break
+                if cancel is not None and cancel():
+                    cancelled = True
+                    break
+                if TB2C_visualize.outOfRange(index_lst[cnt], value):
+                    # empty by the cached index: the voxels are not touched
+                    results[cnt] = (False, None, index_lst[cnt],
+                                    {'verts': 0, 'tris': 0, 'times': {}})
+                    continue
+                args = (sph, value, scale, trans.m_v, b3dmDir, path_bases[cnt],
+                        self._native, index_lst[cnt])
+                if pool is None:
+                    results[cnt] = TB2C_visualize.isosurfBlock(*args)
+                else:
+                    futures.append((cnt, pool.submit(
+                        TB2C_visualize.isosurfBlock, *args)))
+                continue # end of for(cnt, sph)
+        except Exception as e: # failed to get the next block
+            print('isosurf: getting block data failed: {}'.format(str(e)))
+        for cnt, fut in futures:
+            if not cancelled and cancel is not None and cancel():
+                cancelled = True
+            if cancelled and fut.cancel():
+                continue # not started yet
             try:
-                subprocess.call(['obj23dtiles', '--tileset', '-i', obj_path])
-            except Exception as e:
-                cnt += 1
-                continue
-            # remove objfile
-            os.remove(obj_path)
+                results[cnt] = fut.result()
+            except Exception as e: # e.g. worker process died
+                results[cnt] = (False, 'worker failed: {}'.format(str(e)),
+                                index_lst[cnt], None)
+            continue # end of for(cnt, fut)
+        if cancelled:
+            print('isosurf: cancelled')
+            return False
 
-            # modify tileset.json
-            try:
-                ts_f = open(ts_path, 'r')
-                ts_dict = json.load(ts_f, object_pairs_hook=OD)
-                ts_f.close()
-            except Exception as e:
-                cnt += 1
-                continue
-            ts_dict['asset']['gltfUpAxis'] = 'Z'
-            ts_dict['root']['transform'] = [
-                1, 0, 0, 0,  0, 1, 0, 0,  0, 0, 1, 0,  0, 0, 0, 1]
-            bbox = [[v[:,0].min(), v[:,1].min(), v[:,2].min()],
-                    [v[:,0].max(), v[:,1].max(), v[:,2].max()]]
-            ts_dict['root']['boundingVolume']['box'] = self.bbox2Box(bbox)
-            del ts_dict['root']['boundingVolume']['region']
-            try:
-                ts_f = open(ts_path, 'w')
-                json.dump(ts_dict, ts_f, indent=4)
-                ts_f.close()
-            except Exception as e:
-                cnt += 1
+        self._indexList = [res[2] for res in results]
+        self._statList = [res[3] for res in results]
+        for cnt, (path_base, res) in enumerate(zip(path_bases, results)):
+            ok, err = res[:2]
+            if err is not None:
+                print('isosurf: block {} ({}): {}'.format(cnt, path_base, err))
+                self._errList.append((cnt, err))
                 continue
+            if not ok:
+                continue # empty
 
             # add tileLayer to layerList
+            ts_rpath = os.path.join(self._relDir, 'b3dm', 'Batched'+path_base,
+                                    'tileset.json')
             tileLayer = {}
             tileLayer['id'] = path_base
             tileLayer['type'] = '3dtile'
@@ -199,9 +491,7 @@ class TB2C_visualize:
             tileLayer['sseThreshold'] = 0
             tileLayer['url'] = 'http://localhost/data/' + ts_rpath
             self._layerList.append(tileLayer)
-            
-            cnt += 1
-            continue # end of for(sph)
+            continue # end of for(cnt)
 
         # done
         return True
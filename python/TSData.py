@@ -12,6 +12,7 @@ class TSData:
     '''
     def __init__(self) -> None:
         self._evt = threading.Event()
+        self._lock = threading.RLock()
         self.reset()
         return
 
@@ -30,6 +31,8 @@ class TSData:
         self._minMaxList = []
         self._minMaxVeclen = None
         self._hasMinMax = False
+        self._numFiles = 0
+        self._numLoaded = 0
         self._evt.clear()
         return
 
@@ -77,10 +80,22 @@ class TSData:
         else:
             return None
     
+    @property
+    def lock(self):
+        return self._lock
+
     @property
     def is_working(self):
         return self._evt.is_set()
 
+    @property
+    def numFiles(self):
+        return self._numFiles
+
+    @property
+    def numLoaded(self):
+        return self._numLoaded
+
     @property
     def numSteps(self):
         if self.is_ready:
@@ -124,11 +139,12 @@ class TSData:
         -------
         object: データ
         '''
-        if not self.is_ready:
-            return None
-        if stpIdx < 0 or stpIdx >= self.numSteps:
-            return None
-        return self._dataList[stpIdx]
+        with self._lock:
+            if not self.is_ready:
+                return None
+            if stpIdx < 0 or stpIdx >= self.numSteps:
+                return None
+            return self._dataList[stpIdx]
 
     def getDataStp(self, stp):
         ''' getDataStp
@@ -5,18 +5,40 @@ TSDataSPH time-series data with SPH file
 """
 
 import os, sys
+import hashlib
+import threading
 import numpy as np
 import _pickle as pickle
 from TSData import TSData
 from pySPH import SPH
+from SPH_filter import SPH_filter
 from typing import Iterable
+from concurrent.futures import ThreadPoolExecutor
 
 class TSDataSPH(TSData):
     ''' TSDataSPH
     時系列SPHファイル群を扱うクラスです。
+    各ステップのデータについて、各軸方向に1/2ずつ間引いたデータの
+    ピラミッド(level 1, 2, ...)を保持できます(setupPyramid)。
     '''
+    PYRAMID_MODES = ('mean', 'min', 'max')
+    PYRAMID_STORES = ('memory', 'file')
+
     def __init__(self) -> None:
+        self._numLevels = 1
+        self._pyrMode = 'mean'
+        self._pyrStore = 'memory'
+        self._pyramid = {}
+        self._pyrLocks = {}
+        self._pyrHits = 0
+        self._pyrMisses = 0
+        self._mmap = False
+        self._mmPending = []
+        self._mmWorkers = 1
+        self._mmResolve = threading.Lock() # held while resolving min/max
+        self._mmBusy = False
         super().__init__()
+        self._mmCv = threading.Condition(self._lock)
         return
 
     def reset(self) -> None:
@@ -26,15 +48,419 @@ class TSDataSPH(TSData):
         super().reset()
         self._dtype = 'SPH'
         self._dims = [0, 0, 0]
+        self._pyramid = {}
+        self._pyrLocks = {}
+        self._mmPending = []
+        self._fpList = []
         return
 
     @property
     def dims(self):
         return self._dims
+
+    @property
+    def numLevels(self):
+        return self._numLevels
+
+    @property
+    def pyramidMode(self):
+        return self._pyrMode
+
+    def setupPyramid(self, levels: int, mode: str ='mean',
+                     store: str ='memory') -> bool:
+        ''' setupPyramid
+        ピラミッドの段数、間引き方法、保存先を設定します。
+        level n(n>0)のデータは、level n-1のデータをSPH_filter.decimateで
+        各軸方向に1/2に間引いたもので、最初に要求された時(またはbuildPyramid)に
+        生成されます。level 0は元のデータそのものです。
+        storeが'file'の場合、生成したデータは元のSPHファイルと同じディレクトリの
+        '<元のファイル名>.L<n>'(例: data.sph.L1)に保存され、元のファイルより新しい
+        ものが存在すればそれを読み込みます(mmap指定時はメモリマップされます)。
+        設定を変更すると、生成済みのピラミッドは破棄されます。
+
+        Parameters
+        ----------
+        levels: int
+          ピラミッドの段数(level 0を含む、1以上)
+        mode: str
+          間引き方法('mean', 'min', 'max'のいずれか、省略時は'mean')
+        store: str
+          保存先('memory', 'file'のいずれか、省略時は'memory')
+
+        Returns
+        -------
+        bool: True=成功、False=失敗(引数が不正)
+        '''
+        if levels < 1 or mode not in TSDataSPH.PYRAMID_MODES or \
+           store not in TSDataSPH.PYRAMID_STORES:
+            return False
+        with self._lock:
+            self._numLevels = levels
+            self._pyrMode = mode
+            self._pyrStore = store
+            self._pyramid = {}
+            self._pyrLocks = {}
+        return True
+
+    @staticmethod
+    def levelPath(fn: str, level: int) -> str:
+        ''' levelPath
+        ピラミッドのlevel段目のデータを保存するファイルのパスを返します(static method)
+        入力ファイルの指定('*.sph'等)に一致しないよう、元のファイル名に
+        '.L<n>'を付加したものになります。
+
+        Parameters
+        ----------
+        fn: str
+          元のSPHファイルのパス
+        level: int
+          ピラミッドの段(>0)
+
+        Returns
+        -------
+        str: ファイルのパス
+        '''
+        return fn + '.L{}'.format(level)
+
+    @property
+    def fingerprints(self):
+        return self._fpList
+
+    @staticmethod
+    def fingerprint(fn: str) -> str:
+        ''' fingerprint
+        SPHファイルの識別子(絶対パス、更新時刻、サイズのハッシュ)を返します
+        (static method)
+        同じパスのファイルが再生成された場合や、異なるファイルリストで
+        再起動した場合に、生成済みの結果(等値面キャッシュ等)を区別するために
+        使用されます。
+
+        Parameters
+        ----------
+        fn: str
+          SPHファイルのパス
+
+        Returns
+        -------
+        str: 識別子(16桁の16進数)、ファイルが存在しない場合はNone
+        '''
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return None
+        src = '{}|{}|{}'.format(os.path.abspath(fn), st.st_mtime_ns,
+                                st.st_size)
+        return hashlib.sha1(src.encode('utf-8')).hexdigest()[:16]
+
+    @property
+    def numMinMaxPending(self):
+        with self._lock:
+            return len(self._mmPending)
+
+    @property
+    def minMax(self):
+        self.resolveMinMax()
+        return super().minMax
+
+    @property
+    def minMaxVeclen(self):
+        self.resolveMinMax()
+        return super().minMaxVeclen
+
+    def mergeMinMax(self, sph: SPH.SPH) -> None:
+        ''' mergeMinMax
+        SPHデータのmin/maxを時系列全体のmin/maxに反映します(ロック獲得済みで
+        呼び出します)。
+
+        Parameters
+        ----------
+        sph: SPH.SPH
+          SPHデータ(min/maxが確定していること)
+        '''
+        if not self._hasMinMax:
+            self._minMaxList = [[sph._min[i], sph._max[i]]
+                                for i in range(self.datalen)]
+            if self.datalen > 1:
+                self._minMaxVeclen \
+                    = [0.0, np.linalg.norm(sph._max, ord=self.datalen)]
+            else:
+                self._minMaxVeclen = None
+            self._hasMinMax = True
+            return
+        for i in range(self.datalen):
+            if self._minMaxList[i][0] > sph._min[i]:
+                self._minMaxList[i][0] = sph._min[i]
+            if self._minMaxList[i][1] < sph._max[i]:
+                self._minMaxList[i][1] = sph._max[i]
+        if self.datalen > 1:
+            vnorm = np.linalg.norm(sph._max, ord=self.datalen)
+            if vnorm > self._minMaxVeclen[1]:
+                self._minMaxVeclen[1] = vnorm
+        return
+
+    def resolveMinMax(self, nworkers: int =None, save: bool =False) -> None:
+        ''' resolveMinMax
+        min/maxが確定していない(mmapで読み込み、サイドカーファイル(.minmax)が
+        なかった)ステップのmin/maxを計算し、時系列全体のmin/maxに反映します。
+        計算はデータ部全体を読むため、最初に必要になるまで(またはバックグラウンド
+        で、resolveMinMaxAsync)遅延されます。
+        計算は_lockを獲得せずに行われますが、各ステップは全体のmin/maxに
+        反映されてから未確定のリストから除かれます。また、計算中は_mmResolveを
+        保持するため、並行して呼び出された場合は全ての反映が終わるまで待ちます。
+
+        Parameters
+        ----------
+        nworkers: int
+          計算スレッド数(省略時はsetupFilesの読み込みスレッド数)
+        save: bool
+          計算したmin/maxをサイドカーファイルに保存するかどうか(省略時はFalse)
+        '''
+        if nworkers is None:
+            nworkers = self._mmWorkers
+        with self._mmResolve:
+            with self._lock:
+                pending = list(self._mmPending)
+                self._mmBusy = bool(pending)
+            if not pending:
+                return
+            def calc(sph):
+                sph._min; sph._max
+                if save:
+                    sph.saveMinMax()
+                return sph
+            try:
+                with ThreadPoolExecutor(max_workers=max(1, nworkers)) as pool:
+                    for sph in pool.map(calc, pending):
+                        with self._mmCv:
+                            if sph in self._mmPending: # not reset meanwhile
+                                self.mergeMinMax(sph)
+                                self._mmPending.remove(sph)
+                            self._mmCv.notify_all()
+                        continue # end of for(sph)
+            finally:
+                with self._mmCv:
+                    self._mmBusy = False
+                    self._mmCv.notify_all()
+        return
+
+    def resolveMinMaxAsync(self, nworkers: int =None) -> bool:
+        ''' resolveMinMaxAsync
+        resolveMinMaxをバックグラウンドのスレッドで開始します。
+        計算中に参照したmin/max(currentMinMax)は、反映済みのステップのみの
+        値になります。
+
+        Parameters
+        ----------
+        nworkers: int
+          計算スレッド数(省略時はsetupFilesの読み込みスレッド数)
+
+        Returns
+        -------
+        bool: True=開始した(または計算中)、False=未確定のステップがない
+        '''
+        with self._lock:
+            if not self._mmPending:
+                return False
+            if self._mmBusy:
+                return True
+            self._mmBusy = True
+        th = threading.Thread(target=self.resolveMinMax, args=(nworkers,))
+        th.daemon = True
+        th.start()
+        return True
+
+    def currentMinMax(self, wait: bool =True) -> ([[float]], [float], int):
+        ''' currentMinMax
+        反映済みのステップのmin/maxと、未確定のステップ数を返します。
+        未確定のステップがある場合はバックグラウンドの計算を開始し
+        (resolveMinMaxAsync)、waitがTrueであれば少なくとも1ステップが
+        反映されるまで待ちます。
+
+        Parameters
+        ----------
+        wait: bool
+          min/maxが1ステップも確定していない場合に待つかどうか(省略時はTrue)
+
+        Returns
+        -------
+        [[float]]: 成分毎の[min, max]のリスト(確定していない場合はNone)
+        [float]: ベクトル長の[min, max](スカラーまたは確定していない場合はNone)
+        int: 未確定のステップ数
+        '''
+        self.resolveMinMaxAsync()
+        with self._mmCv:
+            while wait and not self._hasMinMax and self._mmPending \
+                  and self._mmBusy:
+                self._mmCv.wait()
+            if not self._hasMinMax:
+                return (None, None, len(self._mmPending))
+            mm = [list(x) for x in self._minMaxList]
+            mmv = list(self._minMaxVeclen) if self._minMaxVeclen else None
+            return (mm, mmv, len(self._mmPending))
+
+    def getDataLevel(self, stpIdx: int, level: int =0) -> SPH.SPH:
+        ''' getDataLevel
+        stpIdxで指定されたタイムステップインデックス番号の、ピラミッドの
+        level段目のデータを返します。生成されていない場合は生成します。
+        同じステップ、段の生成は1度だけ行われ、他のステップ、段の要求は
+        生成を待たずに処理されます。
+
+        Parameters
+        ----------
+        stpIdx: int
+          タイムステップインデックス番号
+        level: int
+          ピラミッドの段(0: 元のデータ、省略時は0)
+
+        Returns
+        -------
+        SPH.SPH: データ、None: 失敗
+        '''
+        if level == 0:
+            return self.getDataIdx(stpIdx)
+        key = (stpIdx, level)
+        with self._lock:
+            if level < 0 or level >= self._numLevels or \
+               stpIdx < 0 or stpIdx >= len(self._dataList):
+                return None
+            sph = self._pyramid.get(key)
+            if sph is not None:
+                self._pyrHits += 1
+                return sph
+            self._pyrMisses += 1
+            lck = self._pyrLocks.setdefault(key, threading.Lock())
+            (mode, store) = (self._pyrMode, self._pyrStore)
+            fn = self._fileList[stpIdx]
+
+        with lck:
+            with self._lock:
+                sph = self._pyramid.get(key)
+            if sph is not None:
+                return sph
+            src = self.getDataLevel(stpIdx, level - 1)
+            if src is None:
+                return None
+            path = TSDataSPH.levelPath(fn, level)
+            sph = None
+            if store == 'file':
+                sph = self.loadLevel(path, fn, src)
+            if sph is None:
+                sph = SPH_filter.decimate(src, 2, mode)
+                if sph is None:
+                    return None
+                sph._min; sph._max
+                if store == 'file' and sph.save(path + '.tmp'):
+                    os.replace(path + '.tmp', path)
+            with self._lock:
+                if self._pyrLocks.get(key) is lck:
+                    self._pyramid[key] = sph
+        return sph
+
+    def residentStats(self) -> dict:
+        ''' residentStats
+        保持しているデータ(_dataList)とピラミッドの統計値を返します。
+        mmapで読み込んだデータのバイト数は'mapped_bytes'に計上されます。
+
+        Returns
+        -------
+        dict: steps, bytes, mapped_bytes, pyramid_entries, pyramid_bytes,
+          pyramid_mapped_bytes, pyramid_hits, pyramid_misses
+        '''
+        def nbytes(lst):
+            mem = mapped = 0
+            for sph in lst:
+                if sph is None or sph._data is None:
+                    continue
+                if sph._mmap:
+                    mapped += sph._data.nbytes
+                else:
+                    mem += sph._data.nbytes
+                continue # end of for(sph)
+            return (mem, mapped)
+        with self._lock:
+            data = list(self._dataList)
+            pyr = list(self._pyramid.values())
+            stat = {'steps': len(data),
+                    'pyramid_entries': len(pyr),
+                    'pyramid_hits': self._pyrHits,
+                    'pyramid_misses': self._pyrMisses}
+        stat['bytes'], stat['mapped_bytes'] = nbytes(data)
+        stat['pyramid_bytes'], stat['pyramid_mapped_bytes'] = nbytes(pyr)
+        return stat
+
+    def loadLevel(self, path: str, fn: str, src: SPH.SPH) -> SPH.SPH:
+        ''' loadLevel
+        ファイルに保存されたピラミッドのデータを読み込みます。
+        元のSPHファイル(fn)より古いもの、格子(格子点数、原点、格子間隔)、
+        ベクトル長が間引き後のものと一致しないものは使用しません。
+
+        Parameters
+        ----------
+        path: str
+          ピラミッドのデータのファイルのパス
+        fn: str
+          元のSPHファイルのパス
+        src: SPH.SPH
+          1つ上の段のデータ
+
+        Returns
+        -------
+        SPH.SPH: 読み込んだデータ、None: 使用できるファイルが存在しない
+        '''
+        try:
+            if os.path.getmtime(path) < os.path.getmtime(fn):
+                return None
+        except OSError:
+            return None
+        sph = SPH.SPH()
+        if not sph.load(path, mmap=self._mmap):
+            return None
+        dims, org, pitch = SPH_filter.decimateGrid(src, 2)
+        if list(sph._dims) != dims or sph._veclen != src._veclen:
+            return None
+        if not np.allclose(sph._org, org) or not np.allclose(sph._pitch, pitch):
+            return None # e.g. written with a different grid placement
+        sph._step = src._step
+        sph._time = src._time
+        sph._min; sph._max
+        return sph
+
+    def buildPyramid(self, nworkers: int =1) -> bool:
+        ''' buildPyramid
+        全ステップについて、ピラミッドの全ての段を生成します。
+        ステップ毎にnworkers個のスレッドで並行して生成されます。
+
+        Parameters
+        ----------
+        nworkers: int
+          生成スレッド数(省略時は1)
+
+        Returns
+        -------
+        bool: True=成功、False=失敗
+        '''
+        with self._lock:
+            nstep = len(self._dataList)
+            top = self._numLevels - 1
+        if top < 1:
+            return True
+        with ThreadPoolExecutor(max_workers=max(1, nworkers)) as pool:
+            res = pool.map(lambda i: self.getDataLevel(i, top), range(nstep))
+            return all([sph is not None for sph in res])
     
-    def setupFiles(self, fnlist: Iterable, basedir: str ='.') -> bool:
+    def setupFiles(self, fnlist: Iterable, basedir: str ='.',
+                   mmap: bool =False, nworkers: int =1) -> bool:
         ''' setupFiles
         SPHファイルエントリーのリストからクラスパラメータを設定します。
+        mmapがTrueの場合、各SPHファイルはヘッダーのみ読み込まれ、データ部は
+        メモリマップされます(クライアントが要求したページのみ読み込まれます)。
+        SPHファイルはnworkers個のスレッドで並行して読み込まれますが、
+        dims/veclenのチェック、min/max、bboxの集計はfnlistの順に行われるため、
+        結果はスレッド数によらず同一です。
+        mmapの場合、サイドカーファイル(.minmax)のないファイルのmin/maxは
+        データ部全体を読まないよう、最初に必要になるまで遅延されます
+        (resolveMinMax)。
+        読み込みの進捗はnumLoaded/numFilesで参照できます。
 
         Parameters
         ----------
@@ -42,70 +468,100 @@ class TSDataSPH(TSData):
           SPHファイルエントリーのリスト
         basedir: str
           SPHファイルが存在するディレクトリ(省略時は'.')
+        mmap: bool
+          データ部をメモリマップするかどうか(省略時はFalse)
+        nworkers: int
+          読み込みスレッド数(省略時は1)
 
         Returns
         -------
         bool: True=成功、False=失敗
         '''
-        self.reset()
-        self._evt.set()
-        
-        # read the first data
-        try:
-            fn = fnlist[0]
-        except:
-            return False
-        if basedir and len(basedir) > 0:
-            fn = os.path.join(basedir, fn)
-        sph = SPH.SPH()
-        if not sph.load(fn):
-            sph = None
-            return False
-        self._dims[:] = sph._dims[:]
-        self.datalen = sph._veclen
-        if self.datalen > 1:
-            self._minMaxVeclen \
-                = [0.0, np.linalg.norm(sph._max, ord=self.datalen)]
-        else:
-            self._minMaxVeclen = None
-        for i in range(self.datalen):
-            self._minMaxList.append([sph._min[i], sph._max[i]])
-        self._bbox[0] = sph._org
-        self._bbox[1] = [sph._org[0] + sph._pitch[0] * (sph._dims[0]-1),
-                         sph._org[1] + sph._pitch[1] * (sph._dims[1]-1),
-                         sph._org[2] + sph._pitch[2] * (sph._dims[2]-1)]
-        self._stepList.append(sph._step)
-        self._timeList.append(sph._time)
-        self._fileList.append(fn)
-        self._dataList.append(sph)
-        self._hasMinMax = True
-        self._ready = True
-
-        # read following data
-        for idx in range(1, len(fnlist)):
-            fn = fnlist[idx]
+        with self._lock:
+            self.reset()
+            self._mmap = mmap
+            self._mmWorkers = max(1, nworkers)
+            self._evt.set()
+
+        fns = []
+        for fn in fnlist:
             if basedir and len(basedir) > 0:
                 fn = os.path.join(basedir, fn)
+            fns.append(fn)
+        if len(fns) < 1:
+            self.reset()
+            return False
+        self._numFiles = len(fns)
+
+        def load(fn):
             sph = SPH.SPH()
-            if not sph.load(fn):
-                self.reset()
-                return False
+            if not sph.load(fn, mmap=mmap):
+                return None
+            with self._lock:
+                self._numLoaded += 1
+            return sph
+
+        with ThreadPoolExecutor(max_workers=max(1, nworkers)) as pool:
+            futs = [pool.submit(load, fn) for fn in fns]
+            for idx in range(len(fns)):
+                sph = futs[idx].result()
+                if sph is None or not self.addData(fns[idx], sph):
+                    for f in futs:
+                        f.cancel()
+                    self.reset()
+                    return False
+                continue # end of for(idx)
+
+        self._evt.clear()
+        return True
+
+    def addData(self, fn: str, sph: SPH.SPH) -> bool:
+        ''' addData
+        読み込まれたSPHデータを時系列の末尾に追加し、min/max、bboxを更新します。
+        min/maxが確定していないデータ(mmap)は、resolveMinMaxまで反映を
+        遅延します。
+        2つ目以降のデータは、dimsとveclenが最初のデータと一致しなければなりません。
+
+        Parameters
+        ----------
+        fn: str
+          SPHファイルのパス
+        sph: SPH.SPH
+          SPHデータ
+
+        Returns
+        -------
+        bool: True=成功、False=失敗(dimsまたはveclenが一致しない)
+        '''
+        with self._lock:
+            if len(self._dataList) == 0:
+                self._dims[:] = sph._dims[:]
+                self.datalen = sph._veclen
+                if sph._vmin is None or sph._vmax is None:
+                    self._mmPending.append(sph)
+                else:
+                    self.mergeMinMax(sph)
+                self._bbox[0] = list(sph._org)
+                self._bbox[1] = [sph._org[0] + sph._pitch[0] * (sph._dims[0]-1),
+                                 sph._org[1] + sph._pitch[1] * (sph._dims[1]-1),
+                                 sph._org[2] + sph._pitch[2] * (sph._dims[2]-1)]
+                self._stepList.append(sph._step)
+                self._timeList.append(sph._time)
+                self._fileList.append(fn)
+                self._fpList.append(TSDataSPH.fingerprint(fn))
+                self._dataList.append(sph)
+                self._ready = True
+                return True
+
             if self._dims[0] != sph._dims[0] or \
                self._dims[1] != sph._dims[1] or self._dims[2] != sph._dims[2]:
-                self.reset()
                 return False
             if self.datalen != sph._veclen:
-                self.reset()
                 return False
-            for i in range(self.datalen):
-                if self._minMaxList[i][0] > sph._min[i]:
-                    self._minMaxList[i][0] = sph._min[i]
-                if self._minMaxList[i][1] < sph._max[i]:
-                    self._minMaxList[i][1] = sph._max[i]
-            if self.datalen > 1:
-                vnorm = np.linalg.norm(sph._max, ord=self.datalen)
-                if vnorm > self._minMaxVeclen[1]:
-                    self._minMaxVeclen[1] = vnorm
+            if sph._vmin is None or sph._vmax is None:
+                self._mmPending.append(sph)
+            else:
+                self.mergeMinMax(sph)
             if self._bbox[0][0] > sph._org[0]: self._bbox[0][0] = sph._org[0]
             if self._bbox[0][1] > sph._org[1]: self._bbox[0][1] = sph._org[1]
             if self._bbox[0][2] > sph._org[2]: self._bbox[0][2] = sph._org[2]
@@ -120,9 +576,7 @@ class TSDataSPH(TSData):
                 self._stepList[-1] = self._stepList[-2] + 1
             self._timeList.append(sph._time)
             self._fileList.append(fn)
+            self._fpList.append(TSDataSPH.fingerprint(fn))
             self._dataList.append(sph)
-            continue # en of for(idx)
-
-        self._evt.clear()
         return True
     
@@ -6,6 +6,8 @@ import sys
 import json
 import metabinary
 import threading
+import concurrent.futures
+from collections import OrderedDict
 import time
 import urllib
 
@@ -27,48 +29,104 @@ def JSONRPC(method, forBinary = False):
 # 非同期メッセージ用カウンタを初期化
 JSONRPC.id_counter = 1
 
+# ChOWDERがエラーを返したリクエストのFutureに設定される例外
+class ChOWDERError(Exception):
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
 # ChOWDERと通信するクラス
+# send_json, send_binaryはconcurrent.futures.Futureを返す.
+# Futureは応答受信時にresultで解決され, エラー応答の場合はChOWDERError,
+# 切断された場合はConnectionErrorが設定される.
 class ChOWDER:
+    # waitで参照できるように保持する, 応答済みのリクエストのFutureの数
+    DONE_KEEP = 1024
+
     def __init__(self):
         # websocket connection
         self.connection = None
         self.is_open = False
         self.callback_dict = {}
+        self._done_dict = OrderedDict()
+        self._lock = threading.Lock()
+        self._open_evt = threading.Event()
+        self._close_evt = threading.Event()
+        self._close_evt.set()
+        self._error = None
 
     def _on_message(self):
         def func(ws, message):
             res = json.loads(message)
-            if res != None:
-                if 'id' in res and res['id'] in self.callback_dict:
-                    err = None
-                    result = None
-                    if 'error' in res:
-                        err = res['error']
-                    if 'result' in res:
-                        result = res['result']
-                    self.callback_dict[res['id']](err, result)
-                    del self.callback_dict[res['id']]
+            if res != None and 'id' in res:
+                ent = self._pop(res['id'])
+                if ent is None:
+                    return
+                fut, callback = ent
+                err = None
+                result = None
+                if 'error' in res:
+                    err = res['error']
+                if 'result' in res:
+                    result = res['result']
+                try:
+                    if callback:
+                        callback(err, result)
+                finally:
+                    if err is not None:
+                        fut.set_exception(ChOWDERError(err))
+                    else:
+                        fut.set_result(result)
         return func
 
     def _on_error(self):
         def func(ws, error):
-            raise Exception(error)
+            self._error = error
+            # connect待ちを解除する
+            self._open_evt.set()
         return func
 
     def _on_close(self):
-        def func(ws):
+        def func(ws, *args):
             self.is_open = False
+            self._open_evt.set()
+            self._close_evt.set()
+            self._fail_all(ConnectionError('ChOWDER connection closed'))
         return func
 
     def _on_open(self):
         def func(ws):
             self.is_open = True
+            self._close_evt.clear()
+            self._open_evt.set()
         return func
 
+    # 応答待ちのリクエストを応答済みに移し, (Future, callback)を返す
+    def _pop(self, id):
+        with self._lock:
+            ent = self.callback_dict.pop(id, None)
+            if ent is not None:
+                self._done_dict[id] = ent[0]
+                while len(self._done_dict) > ChOWDER.DONE_KEEP:
+                    self._done_dict.popitem(last=False)
+        return ent
+
+    # 応答待ちのリクエストのFutureを全てexcで終了させる
+    def _fail_all(self, exc):
+        with self._lock:
+            ids = list(self.callback_dict.keys())
+        for id in ids:
+            ent = self._pop(id)
+            if ent is not None:
+                ent[0].set_exception(exc)
+
     # ChOWDERサーバに接続
-    def connect(self, host):
+    # @param timeout 接続完了を待つ秒数(Noneの場合は無制限)
+    def connect(self, host, timeout = None):
         #websocket.enableTrace(True)
         url = CHOWDER_SERVER.format(host)
+        self._error = None
+        self._open_evt.clear()
         self.connection =  websocket.WebSocketApp(url,\
                                     on_message=self._on_message(),\
                                     on_error=self._on_error(),\
@@ -77,39 +135,94 @@ class ChOWDER:
         wst = threading.Thread(target=self.connection.run_forever)
         wst.daemon = True
         wst.start()
-        while not self.is_open:
-            time.sleep(1)
+        self._open_evt.wait(timeout)
+        if not self.is_open:
+            raise ConnectionError('connect to {} failed: {}'.format(
+                url, self._error if self._error else 'timeout'))
 
     # 切断
     def disconnect(self):
         if self.connection:
             self.connection.close()
             self.is_open = False
+            self._close_evt.set()
+            self._fail_all(ConnectionError('ChOWDER connection closed'))
+
+    # リクエストのFutureを登録する
+    def _register(self, req, callback):
+        fut = concurrent.futures.Future()
+        fut.set_running_or_notify_cancel()
+        with self._lock:
+            self.callback_dict[req['id']] = (fut, callback)
+        return fut
 
     # JSONRPC2形式でリクエストを送る
     # @param req リクエストを含んだdict. 
     # 　　　　　　reqはJSONRPC()によって作成可能.
-    def send_json(self, req, callback = lambda : None):
-        self.callback_dict[req['id']] = callback
-        self.connection.send(json.dumps(req))
+    # @param callback 応答受信時に(err, result)で呼ばれる関数(省略可)
+    # @returns 応答で解決されるFuture
+    def send_json(self, req, callback = None):
+        fut = self._register(req, callback)
+        try:
+            self.connection.send(json.dumps(req))
+        except Exception as e:
+            self._discard(req, e)
+        return fut
 
     # JSONRPC2形式でリクエストを送る
     # @param req リクエストを含んだdict. 
     # @param binary 画像などのコンテンツデータ（バイナリデータ）. 
-    def send_binary(self, req, binary, callback = lambda : None):
+    # @param callback 応答受信時に(err, result)で呼ばれる関数(省略可)
+    # @returns 応答で解決されるFuture
+    def send_binary(self, req, binary, callback = None):
         # metabinaryにまとめる
         mb = metabinary.MetaBinary().createMetaBinary(req, binary)
-        self.callback_dict[req['id']] = callback
-        self.connection.send(mb, opcode=websocket.ABNF.OPCODE_BINARY)
+        fut = self._register(req, callback)
+        try:
+            self.connection.send(mb, opcode=websocket.ABNF.OPCODE_BINARY)
+        except Exception as e:
+            self._discard(req, e)
+        return fut
+
+    # 送信に失敗したリクエストのFutureを例外で終了させる
+    def _discard(self, req, exc):
+        ent = self._pop(req['id'])
+        if ent is not None:
+            ent[0].set_exception(exc)
 
     # 切断されるまで待機
-    def wait_until_close(self):
-        while self.is_open:
-            time.sleep(1)
+    def wait_until_close(self, timeout = None):
+        return self._close_evt.wait(timeout)
 
     # send_json, send_binaryしたリクエストが終了したかどうか
     def is_done(self, req):
-        return not(req['id'] in self.callback_dict)
+        with self._lock:
+            return not(req['id'] in self.callback_dict)
+
+    # send_json, send_binaryしたリクエストの応答を待ち, resultを返す
+    # @param req リクエストを含んだdict.
+    # @param timeout 待機する秒数(Noneの場合は無制限)
+    # @returns 応答のresult(送信していないリクエストの場合はNone)
+    # エラー応答の場合はChOWDERError, 切断された場合はConnectionError,
+    # タイムアウトの場合はconcurrent.futures.TimeoutErrorを送出する.
+    # タイムアウトしたリクエストは応答済みに移され(is_doneがTrueになる),
+    # FutureにもTimeoutErrorが設定される. 後から届いた応答は無視される.
+    def wait(self, req, timeout = None):
+        with self._lock:
+            ent = self.callback_dict.get(req['id'])
+            fut = ent[0] if ent is not None \
+                else self._done_dict.get(req['id'])
+        if fut is None:
+            return None
+        try:
+            return fut.result(timeout)
+        except concurrent.futures.TimeoutError:
+            ent = self._pop(req['id'])
+            if ent is None: # the response arrived just now
+                return fut.result()
+            ent[0].set_exception(concurrent.futures.TimeoutError(
+                'no response from ChOWDER for request {}'.format(req['id'])))
+            raise
 
 
 def add3DTilesContent(ch, layerList:[], image_data):
@@ -12,7 +12,7 @@ def divide(sph: SPH.SPH, div: [], outbase: str) -> bool:
     if div[0]*div[1]*div[2] < 1:
         return False
     
-    sph_lst = SPH_filter.divideShareEdge(sph, div)
+    sph_lst = SPH_filter.divideShareEdge(sph, div, view=True)
 
     path_tmpl = outbase.replace('%I','{I:0=3}') \
                        .replace('%J','{J:0=3}') \
@@ -5,6 +5,8 @@ SPH data representation for Sphere framework
 """
 from __future__ import print_function
 import sys
+import os
+import json
 import struct
 import numpy
 
@@ -17,6 +19,9 @@ class SPH:
     """ data type """
     (DT_SINGLE, DT_DOUBLE) = (1, 2)
 
+    """ numpy byte order of BOM characters of 'struct' module """
+    BYTEORDER = {'@': '=', '=': '=', '<': '<', '>': '>', '!': '>'}
+
     def __init__(self):
         """
         class initializer
@@ -39,16 +44,49 @@ class SPH:
         self._max = [0.0]
         self._data = None
         self._path = None
+        self._mmap = False
         return
 
-    def load(self, path):
+    @property
+    def _min(self):
+        """
+        min value of each vector component (calculated lazily in mmap mode)
+        """
+        if self._vmin is None:
+            self.calcMinMax()
+        return self._vmin
+
+    @_min.setter
+    def _min(self, val):
+        self._vmin = val
+
+    @property
+    def _max(self):
+        """
+        max value of each vector component (calculated lazily in mmap mode)
+        """
+        if self._vmax is None:
+            self.calcMinMax()
+        return self._vmax
+
+    @_max.setter
+    def _max(self, val):
+        self._vmax = val
+
+    def load(self, path, mmap=False):
         """
         load from .sph file
          @param path: file path of the .sph file
+         @param mmap: if True, only the header is read and _data is set as
+                      a read-only numpy.memmap over the data record.
+                      min/max are read from the sidecar file (path.minmax)
+                      if it is up to date, otherwise calculated at the
+                      first access to _min/_max.
          @returns: True for succeed or False for failed.
         """
         self._data = None
         self._path = None
+        self._mmap = False
 
         # open file
         try:
@@ -133,58 +171,131 @@ class SPH:
         # skip data sz
         ifp.read(4)
 
+        # read whole data record at once
         dimSz = self._dims[0] * self._dims[1] * self._dims[2]
-        if ( svType == 1 ):
-            self._min = [0.0,]
-            self._max = [0.0,]
-            if ( dType == 1 ):
-                packStr = 'f'
-                dlen = 4
-                self._data = numpy.array(0, dtype=numpy.float32)
-            else:
-                packStr = 'd'
-                dlen = 8
-                self._data = numpy.array(0, dtype=numpy.float64)
+        if ( dType == 1 ):
+            ftype = numpy.dtype(numpy.float32)
         else:
-            self._min = [0.0, 0.0, 0.0]
-            self._max = [0.0, 0.0, 0.0]
-            if ( dType == 1 ):
-                packStr = 'fff'
-                dlen = 12
-                self._data = numpy.array(0, dtype=numpy.float32)
-            else:
-                packStr = 'ddd'
-                dlen = 24
-                self._data = numpy.array(0, dtype=numpy.float64)
-        self._data.resize(dimSz*self._veclen)
+            ftype = numpy.dtype(numpy.float64)
+        if mmap:
+            try:
+                self._data = numpy.memmap(path, dtype=ftype.newbyteorder(bo),
+                                          mode='r', offset=ifp.tell(),
+                                          shape=(dimSz*self._veclen,))
+            except:
+                print("SPH.load: mmap failed: %s" % path)
+                ifp.close()
+                return False
+            ifp.close()
+            self._path = path
+            self._mmap = True
+            if not self.loadMinMax():
+                self._min = None
+                self._max = None
+            return True
+        try:
+            arr = numpy.fromfile(ifp, dtype=ftype.newbyteorder(bo),
+                                 count=dimSz*self._veclen)
+        except:
+            print("SPH.load: data read failed: %s" % path)
+            ifp.close()
+            return False
+        if arr.size != dimSz*self._veclen or arr.size < 1:
+            print("SPH.load: data record too short: %s" % path)
+            ifp.close()
+            return False
+        self._data = arr.astype(ftype, copy=False)
 
-        # read the first data
-        vals = struct.unpack(bo+packStr, ifp.read(dlen))
-        for l in range(0, self._veclen):
-            self._data[l] = vals[l]
-            self._min[l] = vals[l]
-            self._max[l] = vals[l]
-
-        # read datas folowing
-        for i in range(1, dimSz):
-            vals = struct.unpack(bo+packStr, ifp.read(dlen))
-            for l in range(0, self._veclen):
-                self._data[i*self._veclen + l] = vals[l]
-                if ( self._min[l] > vals[l] ):
-                    self._min[l] = vals[l]
-                elif ( self._max[l] < vals[l] ):
-                    self._max[l] = vals[l]
+        # min/max of each component
+        self.calcMinMax()
 
         # done
         ifp.close()
         self._path = path
         return True
 
-    def save(self, path =None, dtype =None):
+    def calcMinMax(self):
+        """
+        calculate min/max value of each vector component of the data
+        NaN values are ignored, except that a NaN at the first voxel makes
+        the min/max of the component NaN.
+         @returns: True for succeed or False for failed.
+        """
+        if self._data is None or self._data.size < self._veclen:
+            return False
+        arr = self._data.reshape((-1, self._veclen))
+        vmin = [0.0]*self._veclen
+        vmax = [0.0]*self._veclen
+        for l in range(0, self._veclen):
+            col = arr[:, l]
+            if numpy.isnan(col[0]):
+                vmin[l] = vmax[l] = float(col[0])
+                continue
+            vmin[l] = float(numpy.fmin.reduce(col))
+            vmax[l] = float(numpy.fmax.reduce(col))
+            continue # end of for(l)
+        self._min = vmin
+        self._max = vmax
+        return True
+
+    def minMaxPath(self, path =None):
+        """
+        path of the min/max sidecar file of the .sph file
+         @param path: file path of the .sph file. if None, use self._path
+         @returns: path of the sidecar file, or None.
+        """
+        xpath = path
+        if xpath is None: xpath = self._path
+        if xpath is None: return None
+        return xpath + ".minmax"
+
+    def loadMinMax(self):
+        """
+        load min/max from the sidecar file of self._path
+        the sidecar file is used only if it is newer than the .sph file.
+         @returns: True for succeed or False for failed.
+        """
+        mpath = self.minMaxPath()
+        if mpath is None: return False
+        try:
+            if os.path.getmtime(mpath) < os.path.getmtime(self._path):
+                return False
+            with open(mpath, "r") as f:
+                mm = json.load(f)
+            vmin = [float(v) for v in mm["min"]]
+            vmax = [float(v) for v in mm["max"]]
+        except:
+            return False
+        if len(vmin) != self._veclen or len(vmax) != self._veclen:
+            return False
+        self._min = vmin
+        self._max = vmax
+        return True
+
+    def saveMinMax(self):
+        """
+        save min/max to the sidecar file of self._path
+        the sidecar file is never written implicitly (load and calcMinMax do
+        not call this), since the data directory may be read-only.
+         @returns: True for succeed or False for failed.
+        """
+        mpath = self.minMaxPath()
+        if mpath is None or self._vmin is None or self._vmax is None:
+            return False
+        try:
+            with open(mpath, "w") as f:
+                json.dump({"min": self._vmin, "max": self._vmax}, f)
+        except:
+            return False
+        return True
+
+    def save(self, path =None, dtype =None, writev =False):
         """
         save to .sph file
          @param path: file path of the .sph file. if None, use self._path
          @param dtype: file dtype of the .sph file. if None, use self._dtype
+         @param writev: if True, the data record is written with os.writev
+                        (markers and data at once) instead of buffered writes
          @returns: True for succeed or False for failed.
         """
         if self._data is None: return False
@@ -248,29 +359,12 @@ class SPH:
             ofp.write(struct.pack('iifi', 8, self._step, self._time, 8))
 
         # data record
-        dimSz = self._dims[0] * self._dims[1] * self._dims[2]
-        dimVX = self._veclen * self._dims[0]
-        k = 0
-        if self._dtype == SPH.DT_DOUBLE:
-            dfmt = '%dd' % dimVX
-            ofp.write(struct.pack('i', dimSz*self._veclen*8))
-            for i in range(self._dims[2]):
-                for j in range(self._dims[1]):
-                    ofp.write(struct.pack(dfmt, *self._data[k:k+dimVX]))
-                    k = k + dimVX
-                    continue # end of for(j)
-                continue # end of for(i)
-            ofp.write(struct.pack('i', dimSz*self._veclen*8))
-        else:
-            dfmt = '%df' % dimVX
-            ofp.write(struct.pack('i', dimSz*self._veclen*4))
-            for i in range(self._dims[2]):
-                for j in range(self._dims[1]):
-                    ofp.write(struct.pack(dfmt, *self._data[k:k+dimVX]))
-                    k = k + dimVX
-                    continue # end of for(j)
-                continue # end of for(i)
-            ofp.write(struct.pack('i', dimSz*self._veclen*4))
+        arr = self.fileArray(self._dtype)
+        if arr is None:
+            print("SPH.save: data size mismatch: %s" % xpath)
+            ofp.close()
+            return False
+        SPH.writeRecord(ofp, arr, writev=writev)
 
         ofp.close()
         self._path = xpath
@@ -362,32 +456,27 @@ class SPH:
         self._step = step
 
         # check min/max
-        self._min = [0.0]*veclen
-        self._max = [0.0]*veclen
-        for l in range(0, self._veclen):
-            self._min[l] = self._data[l]
-            self._max[l] = self._data[l]
-        for i in range(1, vdimSz):
-            for l in range(0, self._veclen):
-                val = self._data[i*self._veclen + l]
-                if self._min[l] > val:
-                    self._min[l] = val
-                elif self._max[l] < val:
-                    self._max[l] = val
+        self.calcMinMax()
         # done
         return True
 
-    def saveToFort(self, path, dtype =None, endian='@'):
+    def saveToFort(self, path, dtype =None, endian='@', writev =False):
         """
         save to FORTRAN Unformatted file
          @param path: file path to write
          @param dtype: file dtype of the .sph file. if None, use self._dtype
          @param endian: BOM character according to 'struct' module
+         @param writev: if True, the record is written with os.writev
+                        (markers and data at once) instead of buffered writes
          @returns: True for succeed or False for failed.
         """
         xtype = dtype
         if xtype is None: xtype = self._dtype
         if xtype is None: return False
+        arr = self.fileArray(xtype, endian)
+        if arr is None:
+            print("SPH.saveToFort: data size mismatch: %s" % path)
+            return False
 
         # open output file
         try:
@@ -397,33 +486,60 @@ class SPH:
             return False
         
         # data record
-        dimSz = self._dims[0] * self._dims[1] * self._dims[2]
-        dimVX = self._veclen * self._dims[0]
-        k = 0
-        if xtype == SPH.DT_DOUBLE:
-            dfmt = endian + '%dd' % dimVX
-            ofp.write(struct.pack(endian+'i', dimSz*self._veclen*8))
-            for i in range(self._dims[2]):
-                for j in range(self._dims[1]):
-                    ofp.write(struct.pack(dfmt, *self._data[k:k+dimVX]))
-                    k = k + dimVX
-                    continue # end of for(j)
-                continue # end of for(i)
-            ofp.write(struct.pack(endian+'i', dimSz*self._veclen*8))
-        else:
-            dfmt = '%df' % dimVX
-            ofp.write(struct.pack(endian+'i', dimSz*self._veclen*4))
-            for i in range(self._dims[2]):
-                for j in range(self._dims[1]):
-                    ofp.write(struct.pack(dfmt, *self._data[k:k+dimVX]))
-                    k = k + dimVX
-                    continue # end of for(j)
-                continue # end of for(i)
-            ofp.write(struct.pack(endian+'i', dimSz*self._veclen*4))
+        SPH.writeRecord(ofp, arr, endian, writev)
 
         ofp.close()
         return True
 
+    def fileArray(self, xtype, endian='@'):
+        """
+        get the data record body as a contiguous array of the file dtype
+        (no copy if self._data already is)
+         @param xtype: file dtype (DT_SINGLE or DT_DOUBLE)
+         @param endian: BOM character according to 'struct' module
+         @returns: 1-D numpy.ndarray of dims*veclen elements, or None if
+                   self._data is too short.
+        """
+        cnt = self._dims[0] * self._dims[1] * self._dims[2] * self._veclen
+        data = self._data.reshape((-1))
+        if data.size < cnt:
+            return None
+        ftype = numpy.dtype(numpy.float64 if xtype == SPH.DT_DOUBLE
+                            else numpy.float32)
+        ftype = ftype.newbyteorder(SPH.BYTEORDER.get(endian, '='))
+        return numpy.ascontiguousarray(data[:cnt], dtype=ftype)
+
+    @staticmethod
+    def writeRecord(ofp, arr, endian='@', writev=False):
+        """
+        write a FORTRAN Unformatted record (marker, arr, marker) with a single
+        buffer write of arr, or a single os.writev call if writev is True
+         @param ofp: file object opened in binary mode
+         @param arr: contiguous numpy.ndarray of the record body
+         @param endian: BOM character of the markers according to 'struct' module
+         @param writev: if True, use os.writev (falls back if not available)
+        """
+        body = arr.reshape((-1)).view(numpy.uint8)
+        marker = struct.pack(endian+'i', body.size)
+        if writev and hasattr(os, 'writev'):
+            ofp.flush()
+            bufs = [memoryview(marker), memoryview(body), memoryview(marker)]
+            while bufs:
+                n = os.writev(ofp.fileno(), bufs)
+                # partial write: drop written buffers and retry the rest
+                while bufs and n >= len(bufs[0]):
+                    n -= len(bufs[0])
+                    bufs.pop(0)
+                if bufs and n > 0:
+                    bufs[0] = bufs[0][n:]
+                continue # end of while
+            ofp.seek(0, os.SEEK_END)
+        else:
+            ofp.write(marker)
+            ofp.write(body)
+            ofp.write(marker)
+        return
+
     def setNdarray(self, arr):
         """
         setup from numpy.ndarray
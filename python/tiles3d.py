@@ -0,0 +1,204 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+tiles3d - binary glTF/b3dm and tileset.json writer for 3D-Tiles
+"""
+import os
+import struct
+import json
+import numpy as np
+
+
+class Tiles3D:
+    ''' Tiles3D
+    三角形メッシュ(頂点、面、法線の配列)から、3D-Tilesのb3dmファイル
+    (バイナリglTF 2.0を格納)とtileset.jsonを直接出力するクラスです。
+    頂点・法線はfloat32、インデックスはuint32のパックされたバッファとして格納されます。
+    '''
+    GLB_MAGIC = b'glTF'
+    B3DM_MAGIC = b'b3dm'
+    (CHUNK_JSON, CHUNK_BIN) = (0x4E4F534A, 0x004E4942)
+    (GL_FLOAT, GL_UNSIGNED_INT) = (5126, 5125)
+    (GL_ARRAY_BUFFER, GL_ELEMENT_ARRAY_BUFFER) = (34962, 34963)
+    BASE_COLOR = [0.8, 0.8, 0.8, 1.0]
+
+    @staticmethod
+    def pad(b: bytes, align: int, fill: bytes =b' ') -> bytes:
+        ''' pad
+        バイト列をalignバイト境界までfillで埋める(static method)
+        '''
+        n = (align - len(b) % align) % align
+        return b + fill * n
+
+    @staticmethod
+    def glb(verts, faces, normals) -> bytes:
+        ''' glb
+        三角形メッシュからバイナリglTF(GLB)を生成する(static method)
+
+        Parameters
+        ----------
+        verts: float[][3]
+          頂点リスト
+        faces: int[][3]
+          三角形の頂点インデックスリスト
+        normals: float[][3]
+          頂点の法線ベクトルリスト
+
+        Returns
+        -------
+        bytes: GLBデータ
+        '''
+        pos = np.ascontiguousarray(verts, dtype=np.float32).reshape((-1, 3))
+        nrm = np.ascontiguousarray(normals, dtype=np.float32).reshape((-1, 3))
+        nlen = np.sqrt((nrm * nrm).sum(axis=1, keepdims=True))
+        nlen[nlen == 0.0] = 1.0
+        nrm = nrm / nlen
+        idx = np.ascontiguousarray(faces, dtype=np.uint32).reshape((-1))
+        pos_b = pos.astype('<f4', copy=False).tobytes()
+        nrm_b = nrm.astype('<f4', copy=False).tobytes()
+        idx_b = Tiles3D.pad(idx.astype('<u4', copy=False).tobytes(), 4, b'\0')
+        bin_b = pos_b + nrm_b + idx_b
+
+        gltf = {
+            'asset': {'version': '2.0', 'generator': 'TB2C tiles3d'},
+            'scene': 0,
+            'scenes': [{'nodes': [0]}],
+            'nodes': [{'mesh': 0}],
+            'meshes': [{'primitives': [{
+                'attributes': {'POSITION': 0, 'NORMAL': 1},
+                'indices': 2,
+                'material': 0,
+                'mode': 4,
+            }]}],
+            'materials': [{
+                'pbrMetallicRoughness': {
+                    'baseColorFactor': Tiles3D.BASE_COLOR,
+                    'metallicFactor': 0.0,
+                    'roughnessFactor': 1.0,
+                },
+                'doubleSided': True,
+            }],
+            'buffers': [{'byteLength': len(bin_b)}],
+            'bufferViews': [
+                {'buffer': 0, 'byteOffset': 0, 'byteLength': len(pos_b),
+                 'target': Tiles3D.GL_ARRAY_BUFFER},
+                {'buffer': 0, 'byteOffset': len(pos_b),
+                 'byteLength': len(nrm_b),
+                 'target': Tiles3D.GL_ARRAY_BUFFER},
+                {'buffer': 0, 'byteOffset': len(pos_b) + len(nrm_b),
+                 'byteLength': idx.size * 4,
+                 'target': Tiles3D.GL_ELEMENT_ARRAY_BUFFER},
+            ],
+            'accessors': [
+                {'bufferView': 0, 'componentType': Tiles3D.GL_FLOAT,
+                 'count': pos.shape[0], 'type': 'VEC3',
+                 'min': pos.min(axis=0).tolist() if pos.size else [0, 0, 0],
+                 'max': pos.max(axis=0).tolist() if pos.size else [0, 0, 0]},
+                {'bufferView': 1, 'componentType': Tiles3D.GL_FLOAT,
+                 'count': nrm.shape[0], 'type': 'VEC3'},
+                {'bufferView': 2, 'componentType': Tiles3D.GL_UNSIGNED_INT,
+                 'count': idx.size, 'type': 'SCALAR'},
+            ],
+        }
+        json_b = Tiles3D.pad(json.dumps(gltf, separators=(',', ':'))
+                             .encode('utf-8'), 4)
+        length = 12 + 8 + len(json_b) + 8 + len(bin_b)
+        return b''.join([
+            struct.pack('<4sII', Tiles3D.GLB_MAGIC, 2, length),
+            struct.pack('<II', len(json_b), Tiles3D.CHUNK_JSON), json_b,
+            struct.pack('<II', len(bin_b), Tiles3D.CHUNK_BIN), bin_b])
+
+    @staticmethod
+    def b3dm(glb: bytes) -> bytes:
+        ''' b3dm
+        GLBデータをBatched 3D Model(b3dm)形式に格納する(static method)
+        バッチテーブルは持たず、フィーチャーテーブルはBATCH_LENGTH=0のみです。
+
+        Parameters
+        ----------
+        glb: bytes
+          GLBデータ
+
+        Returns
+        -------
+        bytes: b3dmデータ
+        '''
+        ft_json = json.dumps({'BATCH_LENGTH': 0}).encode('utf-8')
+        ft_json += b' ' * ((8 - (28 + len(ft_json)) % 8) % 8)
+        glb = Tiles3D.pad(glb, 8, b'\0')
+        length = 28 + len(ft_json) + len(glb)
+        header = struct.pack('<4sIIIIII', Tiles3D.B3DM_MAGIC, 1, length,
+                             len(ft_json), 0, 0, 0)
+        return header + ft_json + glb
+
+    @staticmethod
+    def tileset(box: [float], content_url: str,
+                geometricError: float =200.0) -> dict:
+        ''' tileset
+        1つのb3dmを持つtileset.jsonの内容を生成する(static method)
+        gltfUpAxisは'Z'、ルートのtransformは単位行列です。
+
+        Parameters
+        ----------
+        box: [float]
+          ルートタイルのboundingVolume("box"形式)
+        content_url: str
+          b3dmファイルのURL(tileset.jsonからの相対パス)
+        geometricError: float
+          タイルセットのgeometricError
+
+        Returns
+        -------
+        dict: tileset.jsonの内容
+        '''
+        return {
+            'asset': {'version': '1.0', 'gltfUpAxis': 'Z'},
+            'geometricError': geometricError,
+            'root': {
+                'transform': [1, 0, 0, 0,  0, 1, 0, 0,
+                              0, 0, 1, 0,  0, 0, 0, 1],
+                'boundingVolume': {'box': box},
+                'geometricError': 0.0,
+                'refine': 'ADD',
+                'content': {'url': content_url},
+            },
+        }
+
+    @staticmethod
+    def write(ts_path: str, b3dm_name: str, box: [float],
+              verts, faces, normals) -> bool:
+        ''' write
+        三角形メッシュをb3dmファイルに出力し、それを参照するtileset.jsonを
+        ts_pathに出力する(static method)
+        b3dmファイルはtileset.jsonと同じディレクトリに出力されます。
+
+        Parameters
+        ----------
+        ts_path: str
+          tileset.jsonのパス
+        b3dm_name: str
+          b3dmファイル名
+        box: [float]
+          ルートタイルのboundingVolume("box"形式)
+        verts: float[][3]
+          頂点リスト
+        faces: int[][3]
+          三角形の頂点インデックスリスト
+        normals: float[][3]
+          頂点の法線ベクトルリスト
+
+        Returns
+        -------
+        bool: True=成功、False=失敗
+        '''
+        ts_dir = os.path.dirname(ts_path)
+        try:
+            os.makedirs(ts_dir, exist_ok=True)
+            with open(os.path.join(ts_dir, b3dm_name), 'wb') as f:
+                f.write(Tiles3D.b3dm(Tiles3D.glb(verts, faces, normals)))
+            with open(ts_path, 'w') as f:
+                json.dump(Tiles3D.tileset(box, b3dm_name), f, indent=4)
+        except Exception as e:
+            print('Tiles3D.write: failed: {}'.format(str(e)))
+            return False
+        return True
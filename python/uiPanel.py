@@ -43,6 +43,15 @@ class TB2C_UIPanel(wx.Panel):
         self._isovalSlider.Bind(wx.EVT_SCROLL_THUMBRELEASE, self.OnIsovalSlider)
         self._isovalTxt.Bind(wx.EVT_TEXT_ENTER, self.OnIsovalTxt)
 
+        topSizer.Add(wx.StaticLine(self, -1, size=(2,2)), flag=wx.EXPAND|wx.ALL)
+
+        # timings textbox
+        topSizer.Add(wx.StaticText(self, label='timings'), border=3,
+                     flag=wx.ALIGN_LEFT|wx.ALL)
+        self._timingTxt = wx.TextCtrl(self, size=wx.Size(-1, 200),
+                                      style=wx.TE_MULTILINE|wx.TE_READONLY)
+        topSizer.Add(self._timingTxt, border=3, flag=wx.EXPAND|wx.ALL)
+
         self.SetSizer(topSizer)
         return
 
@@ -140,6 +149,34 @@ class TB2C_UIPanel(wx.Panel):
         '''
         self._infoTxt.SetValue(info)
 
+    def setTimings(self, timings:dict, lod:int =0) -> None:
+        ''' setTimings
+        可視化の所要時間表示欄の表示内容設定。
+        TB2Cサーバが返した段階毎の所要時間と、頂点数、三角形数(最大のブロック)を
+        表示します。
+
+        Parameters
+        ----------
+        timings: dict
+          TB2Cサーバのレスポンスヘッダー'X-TB2C-Timings'の内容、None: 情報なし
+        lod: int
+          詳細度
+        '''
+        if not timings:
+            self._timingTxt.SetValue('no timings.')
+            return
+        txt = 'lod={}{}\n'.format(lod,
+                                  ' (cached)' if timings.get('cached') else '')
+        for stage, t in timings.get('stages', {}).items():
+            txt += '{:<10}{:10.3f} [ms]\n'.format(stage, t * 1000.0)
+        txt += 'verts={} tris={}\n'.format(timings.get('verts', 0),
+                                           timings.get('tris', 0))
+        mblk = timings.get('max_block')
+        if mblk:
+            txt += 'blocks={} max tris={} (block {})'.format(
+                timings.get('blocks', 0), mblk[2], mblk[0])
+        self._timingTxt.SetValue(txt)
+
     def setTimeStepRange(self, steps:int) -> bool:
         ''' setTimeStepRange
         タイムステップ数の設定。
@@ -0,0 +1,423 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+utilCache - cache utilities for TB2C_server
+"""
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    ''' LRUCache
+    バイト数で容量を制限したLRUキャッシュクラスです。
+    エントリーのバイト数は登録時に呼び出し側が指定します。
+    容量を超えた場合は最も古くアクセスされたエントリーから破棄されますが、
+    最後に登録されたエントリーは容量を超えていても保持されます。
+    '''
+    def __init__(self, budget:int =0) -> None:
+        self._lock = threading.RLock()
+        self._budget = budget
+        self._entries = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        return
+
+    @property
+    def budget(self):
+        return self._budget
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key, default=None):
+        ''' get
+        keyに対応する値を返し、そのエントリーを最新にします。
+
+        Parameters
+        ----------
+        key: hashable
+          キー
+        default: object
+          keyが存在しない場合に返す値
+
+        Returns
+        -------
+        object: 値、またはdefault
+        '''
+        with self._lock:
+            ent = self._entries.get(key)
+            if ent is None:
+                self._misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return ent[0]
+
+    def put(self, key, value, nbytes:int) -> None:
+        ''' put
+        エントリーを登録し、容量を超えた分の古いエントリーを破棄します。
+
+        Parameters
+        ----------
+        key: hashable
+          キー
+        value: object
+          値
+        nbytes: int
+          エントリーのバイト数
+        '''
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (value, nbytes)
+            self._size += nbytes
+            while self._size > self._budget and len(self._entries) > 1:
+                _, ent = self._entries.popitem(last=False)
+                self._size -= ent[1]
+                self._evictions += 1
+                continue # end of while
+        return
+
+    def pop(self, key, default=None):
+        ''' pop
+        エントリーを削除し、その値を返します。
+
+        Parameters
+        ----------
+        key: hashable
+          キー
+        default: object
+          keyが存在しない場合に返す値
+
+        Returns
+        -------
+        object: 値、またはdefault
+        '''
+        with self._lock:
+            ent = self._entries.pop(key, None)
+            if ent is None:
+                return default
+            self._size -= ent[1]
+            return ent[0]
+
+    def clear(self) -> None:
+        ''' clear
+        全エントリーを破棄します(統計値は保持されます)。
+        '''
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+        return
+
+    def stats(self) -> dict:
+        ''' stats
+        キャッシュの統計値を返します。
+
+        Returns
+        -------
+        dict: entries, bytes, budget, hits, misses, evictions, hit_ratio
+        '''
+        with self._lock:
+            nreq = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'budget': self._budget,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_ratio': (self._hits / nreq) if nreq > 0 else 0.0,
+            }
+
+
+class DiskLRUCache:
+    ''' DiskLRUCache
+    ディレクトリ単位でファイル群を保持する、容量制限付きのディスクLRUキャッシュクラスです。
+    各エントリーはbasedir配下のキーのハッシュ名のディレクトリにファイル群を持ち、
+    JSON化可能な値(value)と共にインデックスファイル(basedir/index.json)に
+    記録されます。インデックスは再起動後も引き継がれます。
+    容量(ディレクトリ配下のファイルサイズの合計)を超えた場合は、最も古くアクセス
+    されたエントリーからディレクトリごと削除されます。
+    エントリーのファイル群は一時ディレクトリ(tempDir)に出力し、putで
+    エントリーのディレクトリに移動して登録します。登録されなかった
+    一時ディレクトリ、インデックスにないディレクトリは起動時に削除されます。
+    '''
+    INDEX_FILE = 'index.json'
+    TMP_SUFFIX = '.tmp'
+
+    def __init__(self, basedir:str, budget:int =0) -> None:
+        self._lock = threading.RLock()
+        self._basedir = basedir
+        self._budget = budget
+        self._entries = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self.loadIndex()
+        self.sweep()
+        return
+
+    @property
+    def basedir(self):
+        return self._basedir
+
+    @property
+    def budget(self):
+        return self._budget
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        name = DiskLRUCache.keyName(key)
+        with self._lock:
+            return name in self._entries and \
+                os.path.isdir(os.path.join(self._basedir, name))
+
+    @staticmethod
+    def keyName(key) -> str:
+        ''' keyName
+        キーからエントリーのディレクトリ名を生成します(static method)
+
+        Parameters
+        ----------
+        key: object
+          キー(reprで文字列化されます)
+
+        Returns
+        -------
+        str: ディレクトリ名
+        '''
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:20]
+
+    def entryDir(self, key) -> str:
+        ''' entryDir
+        エントリーのディレクトリのパスを返します。
+
+        Parameters
+        ----------
+        key: object
+          キー
+
+        Returns
+        -------
+        str: エントリーのディレクトリのパス
+        '''
+        return os.path.join(self._basedir, DiskLRUCache.keyName(key))
+
+    def tempDir(self, key) -> str:
+        ''' tempDir
+        エントリーのファイル群を出力する一時ディレクトリを作成し、そのパスを
+        返します。出力後はput(key, value, tmpdir)で登録し、登録しない場合は
+        discardで削除します。
+
+        Parameters
+        ----------
+        key: object
+          キー
+
+        Returns
+        -------
+        str: 一時ディレクトリのパス
+        '''
+        os.makedirs(self._basedir, exist_ok=True)
+        return tempfile.mkdtemp(prefix=DiskLRUCache.keyName(key) + '.',
+                                suffix=DiskLRUCache.TMP_SUFFIX,
+                                dir=self._basedir)
+
+    def discard(self, tmpdir:str) -> None:
+        ''' discard
+        登録しない一時ディレクトリ(tempDir)を削除します。
+
+        Parameters
+        ----------
+        tmpdir: str
+          一時ディレクトリのパス
+        '''
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        return
+
+    def sweep(self) -> None:
+        ''' sweep
+        basedir配下の、インデックスに登録されていないディレクトリ(登録前に
+        中断された一時ディレクトリ等)を削除します。
+        '''
+        try:
+            names = os.listdir(self._basedir)
+        except OSError:
+            return
+        with self._lock:
+            for name in names:
+                path = os.path.join(self._basedir, name)
+                if name in self._entries or not os.path.isdir(path):
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+                continue # end of for(name)
+        return
+
+    def loadIndex(self) -> bool:
+        ''' loadIndex
+        インデックスファイルを読み込みます。ディレクトリが存在しないエントリーは
+        無視されます。
+
+        Returns
+        -------
+        bool: True=成功、False=失敗
+        '''
+        path = os.path.join(self._basedir, DiskLRUCache.INDEX_FILE)
+        try:
+            with open(path, 'r') as f:
+                idx = json.load(f)
+        except:
+            return False
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            for ent in idx:
+                if not os.path.isdir(os.path.join(self._basedir, ent['name'])):
+                    continue
+                self._entries[ent['name']] = (ent['value'], ent['bytes'])
+                self._size += ent['bytes']
+                continue # end of for(ent)
+            self.evict()
+        return True
+
+    def saveIndex(self) -> bool:
+        ''' saveIndex
+        インデックスファイルを書き出します(古いエントリーから順に記録されます)。
+
+        Returns
+        -------
+        bool: True=成功、False=失敗
+        '''
+        path = os.path.join(self._basedir, DiskLRUCache.INDEX_FILE)
+        with self._lock:
+            idx = [{'name': k, 'value': v[0], 'bytes': v[1]}
+                   for k, v in self._entries.items()]
+        try:
+            os.makedirs(self._basedir, exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(idx, f)
+            os.replace(path + '.tmp', path)
+        except:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        ''' get
+        keyに対応する値を返し、そのエントリーを最新にします。
+
+        Parameters
+        ----------
+        key: object
+          キー
+        default: object
+          keyが存在しない場合に返す値
+
+        Returns
+        -------
+        object: 値、またはdefault
+        '''
+        name = DiskLRUCache.keyName(key)
+        with self._lock:
+            ent = self._entries.get(name)
+            if ent is None or \
+               not os.path.isdir(os.path.join(self._basedir, name)):
+                self._misses += 1
+                return default
+            self._entries.move_to_end(name)
+            self._hits += 1
+            return ent[0]
+
+    def put(self, key, value, tmpdir:str =None) -> None:
+        ''' put
+        entryDir(key)に出力済みのファイル群をエントリーとして登録し、
+        容量を超えた分の古いエントリーを削除します。
+        tmpdirが指定された場合は、それをentryDir(key)に移動して登録します
+        (既存のエントリーのディレクトリは置き換えられます)。
+
+        Parameters
+        ----------
+        key: object
+          キー
+        value: object
+          値(JSON化可能であること)
+        tmpdir: str
+          ファイル群を出力した一時ディレクトリ(tempDirの戻り値、省略可)
+        '''
+        name = DiskLRUCache.keyName(key)
+        edir = os.path.join(self._basedir, name)
+        nbytes = 0
+        src = tmpdir if tmpdir else edir
+        for root, dirs, files in os.walk(src):
+            for fn in files:
+                nbytes += os.path.getsize(os.path.join(root, fn))
+        with self._lock:
+            if tmpdir:
+                shutil.rmtree(edir, ignore_errors=True)
+                os.replace(tmpdir, edir)
+            old = self._entries.pop(name, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[name] = (value, nbytes)
+            self._size += nbytes
+            self.evict()
+        self.saveIndex()
+        return
+
+    def evict(self) -> None:
+        ''' evict
+        容量を超えた分の古いエントリーをディレクトリごと削除します。
+        最後に登録されたエントリーは容量を超えていても保持されます。
+        '''
+        with self._lock:
+            while self._size > self._budget and len(self._entries) > 1:
+                name, ent = self._entries.popitem(last=False)
+                self._size -= ent[1]
+                self._evictions += 1
+                shutil.rmtree(os.path.join(self._basedir, name),
+                              ignore_errors=True)
+                continue # end of while
+        return
+
+    def stats(self) -> dict:
+        ''' stats
+        キャッシュの統計値を返します。
+
+        Returns
+        -------
+        dict: entries, bytes, budget, hits, misses, evictions, hit_ratio
+        '''
+        with self._lock:
+            nreq = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'budget': self._budget,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_ratio': (self._hits / nreq) if nreq > 0 else 0.0,
+            }
@@ -0,0 +1,75 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+utilHttp - HTTP server utilities for TB and TB2C_server
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer
+
+from utilMetrics import HTTPMetrics
+
+
+class PooledHTTPServer(HTTPServer):
+    ''' PooledHTTPServer
+    スレッドプールでリクエストを並行処理するHTTPサーバクラスです。
+    同時に処理されるリクエスト数はワーカー数(nworkers)で制限され、
+    それを超えたリクエストはプールの空きを待ちます。
+    リクエストの集計値(HTTPMetrics)を保持し、utilMetrics.MetricsHandlerMixinを
+    継承したハンドラーはmetricsに集計します。
+    '''
+    def __init__(self, server_address, RequestHandlerClass,
+                 nworkers:int =4, bind_and_activate:bool =True):
+        super().__init__(server_address, RequestHandlerClass,
+                         bind_and_activate)
+        self._nworkers = max(1, nworkers)
+        self._pool = ThreadPoolExecutor(max_workers=self._nworkers,
+                                        thread_name_prefix='httpd')
+        self._metrics = HTTPMetrics()
+        return
+
+    @property
+    def nworkers(self):
+        return self._nworkers
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    def process_request(self, request, client_address):
+        ''' process_request
+        socketserver.BaseServer.process_requestのオーバーロードメソッド。
+        リクエストの処理をスレッドプールに投入します。
+        '''
+        self._pool.submit(self.process_request_thread, request, client_address)
+        return
+
+    def process_request_thread(self, request, client_address):
+        ''' process_request_thread
+        スレッドプールのワーカーで1リクエストを処理します。
+        '''
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+        return
+
+    def shutdownLater(self):
+        ''' shutdownLater
+        別スレッドからserve_foreverを停止させます。
+        リクエストハンドラー(ワーカースレッド)内から呼び出すためのものです。
+        '''
+        th = threading.Thread(target=self.shutdown)
+        th.daemon = True
+        th.start()
+        return
+
+    def server_close(self):
+        ''' server_close
+        ソケットを閉じ、処理中のリクエストの終了を待ってからスレッドプールを停止します。
+        '''
+        super().server_close()
+        self._pool.shutdown(wait=True)
+        return
@@ -0,0 +1,320 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+utilMetrics - request metrics in the Prometheus text format for TB and
+TB2C_server
+"""
+import time
+import threading
+from bisect import bisect_left
+from urllib.parse import urlparse
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class HTTPMetrics:
+    ''' HTTPMetrics
+    HTTPサーバのパス毎のリクエスト数(ステータスコード毎)、処理時間の
+    ヒストグラム、送受信バイト数と、処理中のリクエスト数を集計するクラスです。
+    集計は1リクエストにつき1回(end)、ロックを獲得して辞書を更新するのみです。
+    renderでPrometheusのテキスト形式に変換します。
+    '''
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0, 30.0) # [sec]
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._requests = {}  # (path, code) -> count
+        self._latency = {}   # path -> [count of each bucket, ..., sum]
+        self._sent = {}      # path -> bytes
+        self._received = {}  # path -> bytes
+        return
+
+    def begin(self) -> None:
+        ''' begin
+        リクエストの処理開始を記録します(処理中のリクエスト数を増やします)。
+        '''
+        with self._lock:
+            self._inflight += 1
+        return
+
+    def end(self, path:str, code:int, sec:float,
+            sent:int, received:int) -> None:
+        ''' end
+        リクエストの処理終了を記録します。
+
+        Parameters
+        ----------
+        path: str
+          パス(ラベル)
+        code: int
+          レスポンスのステータスコード(送信しなかった場合は0)
+        sec: float
+          処理時間[s]
+        sent: int
+          送信バイト数
+        received: int
+          受信バイト数
+        '''
+        ib = bisect_left(HTTPMetrics.BUCKETS, sec)
+        with self._lock:
+            self._inflight -= 1
+            key = (path, code)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            hist = self._latency.get(path)
+            if hist is None:
+                hist = self._latency[path] \
+                    = [0] * (len(HTTPMetrics.BUCKETS) + 1) + [0.0]
+            hist[ib] += 1
+            hist[-1] += sec
+            self._sent[path] = self._sent.get(path, 0) + sent
+            self._received[path] = self._received.get(path, 0) + received
+        return
+
+    @staticmethod
+    def formatFamily(name:str, mtype:str, help:str, samples:[]) -> str:
+        ''' formatFamily
+        1つのメトリクスをPrometheusのテキスト形式に変換します(static method)
+
+        Parameters
+        ----------
+        name: str
+          メトリクス名
+        mtype: str
+          型('counter', 'gauge', 'histogram')
+        help: str
+          説明
+        samples: [(str, dict, float)]
+          (名前の接尾辞, ラベル, 値)のリスト、ラベルはNone可
+
+        Returns
+        -------
+        str: テキスト形式のメトリクス
+        '''
+        lines = ['# HELP {} {}'.format(name, help),
+                 '# TYPE {} {}'.format(name, mtype)]
+        for suffix, labels, val in samples:
+            lbl = ''
+            if labels:
+                lbl = '{' + ','.join(['{}="{}"'.format(
+                    k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for k, v in labels.items()]) + '}'
+            lines.append('{}{}{} {}'.format(name, suffix, lbl, val))
+            continue # end of for(suffix, labels, val)
+        return '\n'.join(lines) + '\n'
+
+    def render(self, prefix:str, families:[] =None) -> str:
+        ''' render
+        集計値と、呼び出し側が指定したメトリクスをPrometheusのテキスト形式に
+        変換します。
+
+        Parameters
+        ----------
+        prefix: str
+          メトリクス名の接頭辞('tb', 'tb2c'等)
+        families: [(str, str, str, [])]
+          追加するメトリクスの(接頭辞以降の名前, 型, 説明, サンプルのリスト)の
+          リスト(サンプルはformatFamilyを参照)
+
+        Returns
+        -------
+        str: テキスト形式のメトリクス
+        '''
+        with self._lock:
+            inflight = self._inflight
+            requests = dict(self._requests)
+            latency = {p: list(h) for p, h in self._latency.items()}
+            sent = dict(self._sent)
+            received = dict(self._received)
+        fams = []
+        fams.append(('http_requests_total', 'counter',
+                     'HTTP requests by path and status code',
+                     [('', {'path': p, 'code': c}, n)
+                      for (p, c), n in sorted(requests.items())]))
+        samples = []
+        for path, hist in sorted(latency.items()):
+            acc = 0
+            for le, n in zip(HTTPMetrics.BUCKETS + ('+Inf',), hist[:-1]):
+                acc += n
+                samples.append(('_bucket', {'path': path, 'le': le}, acc))
+            samples.append(('_sum', {'path': path}, hist[-1]))
+            samples.append(('_count', {'path': path}, acc))
+            continue # end of for(path, hist)
+        fams.append(('http_request_duration_seconds', 'histogram',
+                     'HTTP request latency by path', samples))
+        fams.append(('http_sent_bytes_total', 'counter',
+                     'bytes sent by path',
+                     [('', {'path': p}, n) for p, n in sorted(sent.items())]))
+        fams.append(('http_received_bytes_total', 'counter',
+                     'bytes received by path',
+                     [('', {'path': p}, n)
+                      for p, n in sorted(received.items())]))
+        fams.append(('http_requests_in_flight', 'gauge',
+                     'HTTP requests being processed', [('', None, inflight)]))
+        if families:
+            fams.extend(families)
+        return ''.join([HTTPMetrics.formatFamily(prefix + '_' + name, *fam)
+                        for name, *fam in fams])
+
+    @staticmethod
+    def cacheFamilies(caches:dict) -> []:
+        ''' cacheFamilies
+        キャッシュ名をキーとする統計値(LRUCache.stats等の戻り値)から、
+        キャッシュのメトリクスを作成します(static method)
+
+        Parameters
+        ----------
+        caches: dict
+          キャッシュ名 -> 統計値(entries, bytes, hits, misses, evictions,
+          hit_ratio)
+
+        Returns
+        -------
+        [(str, str, str, [])]: renderに渡すメトリクスのリスト
+        '''
+        defs = (('cache_hits_total', 'counter', 'cache hits', 'hits'),
+                ('cache_misses_total', 'counter', 'cache misses', 'misses'),
+                ('cache_evictions_total', 'counter', 'cache evictions',
+                 'evictions'),
+                ('cache_hit_ratio', 'gauge', 'cache hit ratio', 'hit_ratio'),
+                ('cache_entries', 'gauge', 'cache entries', 'entries'),
+                ('cache_bytes', 'gauge', 'bytes held in the cache', 'bytes'))
+        return [(name, mtype, help,
+                 [('', {'cache': cname}, stat[key])
+                  for cname, stat in caches.items()])
+                for name, mtype, help, key in defs]
+
+
+class CountingReader:
+    ''' CountingReader
+    読み込んだバイト数を数える、リクエストハンドラーのrfileのラッパーです。
+    '''
+    def __init__(self, f) -> None:
+        self._f = f
+        self.nbytes = 0
+        return
+
+    def read(self, *args):
+        b = self._f.read(*args)
+        self.nbytes += len(b)
+        return b
+
+    def readline(self, *args):
+        b = self._f.readline(*args)
+        self.nbytes += len(b)
+        return b
+
+    def readinto(self, b):
+        n = self._f.readinto(b)
+        if n:
+            self.nbytes += n
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+class CountingWriter:
+    ''' CountingWriter
+    書き込んだバイト数を数える、リクエストハンドラーのwfileのラッパーです。
+    '''
+    def __init__(self, f) -> None:
+        self._f = f
+        self.nbytes = 0
+        return
+
+    def write(self, b):
+        n = self._f.write(b)
+        self.nbytes += len(b) if n is None else n
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+class MetricsHandlerMixin:
+    ''' MetricsHandlerMixin
+    BaseHTTPRequestHandlerの派生クラスに、サーバ(PooledHTTPServer)の
+    HTTPMetricsへのリクエスト毎の集計を追加するmix-inクラスです。
+    パスのラベルは、METRICS_PATHSに含まれるものはそのまま、METRICS_PREFIXESの
+    いずれかで始まるものはその接頭辞+'*'、それ以外は'other'になります。
+    送受信バイト数はリクエスト毎にrfile, wfileのラッパーで数えられ、
+    終了時にまとめて集計されます。
+    '''
+    METRICS_PATHS = ('/', '/metrics')
+    METRICS_PREFIXES = ()
+
+    def setup(self):
+        super().setup()
+        self.rfile = CountingReader(self.rfile)
+        self.wfile = CountingWriter(self.wfile)
+        return
+
+    def metricsPath(self) -> str:
+        ''' metricsPath
+        要求されたパスから、メトリクスのパスのラベルを返します。
+
+        Returns
+        -------
+        str: パスのラベル
+        '''
+        path = urlparse(getattr(self, 'path', '')).path
+        if len(path) > 1:
+            path = path.rstrip('/')
+        if path in self.METRICS_PATHS:
+            return path
+        for pre in self.METRICS_PREFIXES:
+            if path.startswith(pre):
+                return pre + '*'
+        return 'other'
+
+    def send_response(self, code, message=None):
+        self._mt_code = code
+        super().send_response(code, message)
+        return
+
+    def parse_request(self):
+        metrics = getattr(self.server, 'metrics', None)
+        if metrics is not None and self._mt_start is None:
+            self._mt_start = time.perf_counter()
+            metrics.begin()
+        return super().parse_request()
+
+    def handle_one_request(self):
+        self._mt_start = None
+        self._mt_code = 0
+        self.path = '' # not parsed yet
+        nread = self.rfile.nbytes
+        nwrite = self.wfile.nbytes
+        try:
+            super().handle_one_request()
+        finally:
+            if self._mt_start is not None:
+                self.server.metrics.end(
+                    self.metricsPath(), self._mt_code,
+                    time.perf_counter() - self._mt_start,
+                    self.wfile.nbytes - nwrite, self.rfile.nbytes - nread)
+        return
+
+    def sendMetrics(self, prefix:str, families:[] =None) -> None:
+        ''' sendMetrics
+        サーバの集計値とfamiliesをPrometheusのテキスト形式で返します。
+
+        Parameters
+        ----------
+        prefix: str
+          メトリクス名の接頭辞
+        families: []
+          追加するメトリクスのリスト(HTTPMetrics.renderを参照)
+        '''
+        metrics = getattr(self.server, 'metrics', None)
+        if metrics is None:
+            metrics = HTTPMetrics()
+        body = metrics.render(prefix, families).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+        return